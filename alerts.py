@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from metrics import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+SEVERITY_ICONS = {
+    'critical': '🔴',
+    'warning': '🟠',
+    'info': '🔵'
+}
+
+
+class AlertManager:
+    """Оповещения администраторам с дедупликацией, ограничением частоты и пакетной доставкой.
+
+    Состояния (ipsec недоступен, высокая скорость пользователя) активны, пока их не
+    сняли через resolve(); события (шторм подключений, медленная запись в БД)
+    повторяются не чаще ALERT_REPEAT_INTERVAL и забываются сами.
+    """
+
+    def __init__(self):
+        self.batch_interval = Config.ALERT_BATCH_INTERVAL
+        self.repeat_interval = Config.ALERT_REPEAT_INTERVAL
+        self.active = {}  # {key: {'text', 'severity', 'event', 'first', 'last', 'count', 'notified_at'}}
+        self.pending = {}  # {key: alert} - ждут ближайшей отправки
+        self.resolved = []  # тексты снятых оповещений для ближайшей отправки
+        self.last_delivery = 0
+        self.notifier = None
+        self.lock = threading.Lock()
+
+    def set_notifier(self, callback):
+        """callback(chat_id, text) - доставка в Telegram"""
+        self.notifier = callback
+
+    def raise_alert(self, key, text, severity='warning', event=False):
+        """Поднимает оповещение; повтор с тем же key только увеличивает счетчик"""
+        now = time.time()
+        with self.lock:
+            alert = self.active.get(key)
+            if alert is None:
+                alert = {'text': text, 'severity': severity, 'event': event,
+                         'first': now, 'last': now, 'count': 1, 'notified_at': 0}
+                self.active[key] = alert
+                self.pending[key] = alert
+                logger.warning(f"Оповещение [{key}]: {text}")
+            else:
+                alert['text'] = text
+                alert['severity'] = severity
+                alert['last'] = now
+                alert['count'] += 1
+                if alert['notified_at'] and now - alert['notified_at'] >= self.repeat_interval:
+                    self.pending[key] = alert
+
+        metrics.inc('vpnbot_alerts_total', alert=key.split(':')[0], severity=severity)
+
+    def resolve(self, key, text=None):
+        """Снимает активное оповещение; администраторы узнают, если видели его"""
+        with self.lock:
+            alert = self.active.pop(key, None)
+            if alert is None:
+                return
+            self.pending.pop(key, None)
+            if alert['notified_at']:
+                self.resolved.append(text or f"Снято: {alert['text']}")
+            logger.info(f"Оповещение [{key}] снято")
+
+    def resolve_prefix(self, prefix, keep=()):
+        """Снимает все оповещения вида prefix*, кроме перечисленных в keep"""
+        with self.lock:
+            keys = [key for key in self.active if key.startswith(prefix) and key not in keep]
+        for key in keys:
+            self.resolve(key)
+
+    def _expire_events(self, now):
+        for key in [key for key, alert in self.active.items()
+                    if alert['event'] and key not in self.pending and now - alert['last'] >= self.repeat_interval]:
+            del self.active[key]
+
+    def _build_message(self, alerts, resolved):
+        lines = [f"🚨 Оповещения ({len(alerts)}):" if alerts else "✅ Оповещения сняты:", ""]
+
+        limit = Config.ALERT_MAX_PER_MESSAGE
+        for key, alert in alerts[:limit]:
+            icon = SEVERITY_ICONS.get(alert['severity'], '⚪')
+            repeat = f" (×{alert['count']})" if alert['count'] > 1 else ""
+            lines.append(f"{icon} {alert['text']}{repeat}")
+        if len(alerts) > limit:
+            lines.append(f"... и еще {len(alerts) - limit}")
+
+        if resolved:
+            if alerts:
+                lines.append("")
+            for text in resolved[:limit]:
+                lines.append(f"✅ {text}")
+            if len(resolved) > limit:
+                lines.append(f"... и еще {len(resolved) - limit}")
+
+        return "\n".join(lines)
+
+    def _get_recipients(self):
+        if Config.ALERT_RECIPIENTS == 'super':
+            return [Config.SUPER_ADMIN_ID]
+        from database import db
+        return [admin[0] for admin in db.get_all_admins()]
+
+    def flush(self, force=False):
+        """Отправляет накопленные оповещения одним сообщением (не чаще ALERT_BATCH_INTERVAL)"""
+        now = time.time()
+        with self.lock:
+            self._expire_events(now)
+            if not self.pending and not self.resolved:
+                return False
+            if not force and now - self.last_delivery < self.batch_interval:
+                return False
+
+            alerts = sorted(self.pending.items(),
+                            key=lambda item: (item[1]['severity'] != 'critical', item[1]['first']))
+            resolved = self.resolved
+            for _, alert in alerts:
+                alert['notified_at'] = now
+            self.pending = {}
+            self.resolved = []
+            self.last_delivery = now
+
+        text = self._build_message(alerts, resolved)
+        if self.notifier is None:
+            logger.info(f"Оповещения без получателя:\n{text}")
+            return False
+
+        threading.Thread(target=self._deliver, args=(text,), daemon=True, name="AlertDelivery").start()
+        return True
+
+    def _deliver(self, text):
+        try:
+            recipients = self._get_recipients()
+        except Exception as e:
+            logger.error(f"Ошибка получения списка администраторов для оповещений: {str(e)}")
+            recipients = [Config.SUPER_ADMIN_ID]
+
+        for chat_id in recipients:
+            try:
+                self.notifier(chat_id, text)
+            except Exception as e:
+                logger.error(f"Ошибка доставки оповещения {chat_id}: {str(e)}")
+
+    def get_active(self):
+        """Активные оповещения для /alerts: [(key, alert)]"""
+        with self.lock:
+            self._expire_events(time.time())
+            return sorted(((key, dict(alert)) for key, alert in self.active.items()),
+                          key=lambda item: item[1]['first'])
+
+    @staticmethod
+    def format_time(timestamp):
+        return datetime.fromtimestamp(timestamp).strftime("%d.%m %H:%M:%S")
+
+
+# Глобальный экземпляр оповещений
+alerts = AlertManager()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Сравнение векторизованной аналитики (traffic_analytics) с построчным Python.
+
+Генерирует синтетическую историю (traffic_log по дням и user_stats по сессиям),
+считает одни и те же агрегаты обоими способами, сверяет результаты и печатает время.
+
+    python3 analytics_benchmark.py [пользователей] [дней] [сессий]
+"""
+import sys
+import time
+import random
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+from traffic_analytics import (TrafficWindow, user_percentiles, weekly_heatmap, growth_trends,
+                               duration_distribution, DURATION_BINS)
+
+PERCENTILES = (50, 90, 99)
+
+
+def generate(users, days, sessions):
+    random.seed(42)
+    date_to = date(2024, 6, 30)
+    date_from = date_to - timedelta(days=days - 1)
+    names = [f"user{i}" for i in range(users)]
+
+    log_rows = []
+    for name in names:
+        activity = random.random()
+        for day in range(days):
+            if random.random() < activity:
+                log_date = (date_from + timedelta(days=day)).isoformat()
+                log_rows.append((name, log_date, random.randint(1, 5 * 1024 ** 3)))
+
+    session_rows = []
+    start = datetime.combine(date_from, datetime.min.time())
+    for _ in range(sessions):
+        started = start + timedelta(seconds=random.randint(0, days * 86400 - 1))
+        session_rows.append((random.choice(names), started.strftime("%Y-%m-%d %H:%M:%S"),
+                             int(random.expovariate(1 / 1800)), random.randint(0, 1024 ** 3)))
+
+    return date_from, date_to, log_rows, session_rows
+
+
+# ---------- Построчные эквиваленты ----------
+
+def py_percentile(values, q):
+    ordered = sorted(values)
+    position = q / 100 * (len(ordered) - 1)
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def py_daily(date_from, days, usernames, log_rows):
+    daily = {username: [0] * days for username in usernames}
+    for username, log_date, value in log_rows:
+        daily[username][(date.fromisoformat(log_date) - date_from).days] += value
+    return daily
+
+
+def py_user_percentiles(date_from, days, usernames, log_rows):
+    result = {}
+    for username, values in py_daily(date_from, days, usernames, log_rows).items():
+        result[username] = {'total': sum(values), 'max': max(values)}
+        for q in PERCENTILES:
+            result[username][q] = py_percentile(values, q)
+    return result
+
+
+def py_heatmap(session_rows):
+    heatmap = [[0] * 24 for _ in range(7)]
+    for _, started, _, value in session_rows:
+        # Начало сессии хранится в UTC, карта строится по местному времени
+        moment = datetime.strptime(started, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).astimezone()
+        heatmap[moment.weekday()][moment.hour] += value
+    return heatmap
+
+
+def py_trends(date_from, days, usernames, log_rows):
+    daily_by_user = py_daily(date_from, days, usernames, log_rows)
+    x_mean = (days - 1) / 2
+    denominator = sum((x - x_mean) ** 2 for x in range(days))
+
+    slopes = {}
+    server = [0] * days
+    for username, values in daily_by_user.items():
+        y_mean = sum(values) / days
+        slopes[username] = sum((x - x_mean) * (y - y_mean) for x, y in enumerate(values)) / denominator
+        for day, value in enumerate(values):
+            server[day] += value
+    return server, slopes
+
+
+def py_durations(session_rows):
+    counts = [0] * len(DURATION_BINS)
+    durations = []
+    for _, _, duration, _ in session_rows:
+        durations.append(duration)
+        for i in range(len(DURATION_BINS) - 1, -1, -1):
+            if duration >= DURATION_BINS[i]:
+                counts[i] += 1
+                break
+    return counts, {q: py_percentile(durations, q) for q in PERCENTILES}
+
+
+# ---------- Замеры ----------
+
+def measure(function, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+    sessions = int(sys.argv[3]) if len(sys.argv) > 3 else 200000
+
+    date_from, date_to, log_rows, session_rows = generate(users, days, sessions)
+    print(f"📊 Пользователей: {users}, дней: {days}, строк traffic_log: {len(log_rows)}, сессий: {sessions}\n")
+
+    load_time, window = measure(lambda: TrafficWindow.from_rows(date_from, date_to, log_rows, session_rows))
+    print(f"{'загрузка в массивы':<24} {load_time * 1000:9.1f} мс\n")
+    print(f"{'агрегат':<24} {'NumPy':>10} {'Python':>10} {'ускорение':>10}")
+
+    def fresh():
+        # Матрица дней кэшируется в окне - для честного замера считаем ее заново
+        window._matrix = None
+        return window
+
+    checks = []
+
+    np_time, np_result = measure(lambda: user_percentiles(fresh(), PERCENTILES))
+    usernames = {row[0] for row in log_rows} | {row[0] for row in session_rows}
+    py_time, py_result = measure(lambda: py_user_percentiles(date_from, days, usernames, log_rows))
+    index = {name: i for i, name in enumerate(window.usernames)}
+    checks.append(all(np.isclose(np_result[key][index[name]], values[key])
+                      for name, values in py_result.items() for key in ('total', 'max') + PERCENTILES))
+    rows = [("перцентили по юзерам", np_time, py_time)]
+
+    np_time, np_result = measure(lambda: weekly_heatmap(window))
+    py_time, py_result = measure(lambda: py_heatmap(session_rows))
+    checks.append(np.allclose(np_result, np.array(py_result)))
+    rows.append(("тепловая карта 7x24", np_time, py_time))
+
+    np_time, np_result = measure(lambda: growth_trends(fresh()))
+    py_time, (py_server, py_slopes) = measure(lambda: py_trends(date_from, days, usernames, log_rows))
+    checks.append(np.allclose(np_result['daily'], py_server) and all(
+        np.isclose(np_result['user_slopes'][index[name]], slope, rtol=1e-6, atol=1e-3)
+        for name, slope in py_slopes.items()))
+    rows.append(("тренды роста", np_time, py_time))
+
+    np_time, np_result = measure(lambda: duration_distribution(window, PERCENTILES))
+    py_time, (py_counts, py_percentiles) = measure(lambda: py_durations(session_rows))
+    checks.append(list(np_result['counts']) == py_counts and all(
+        np.isclose(np_result[q], py_percentiles[q]) for q in PERCENTILES))
+    rows.append(("длительность сессий", np_time, py_time))
+
+    for name, np_time, py_time in rows:
+        print(f"{name:<24} {np_time * 1000:8.1f}мс {py_time * 1000:8.1f}мс {py_time / np_time:9.1f}x")
+
+    print(f"\n{'✅ Результаты совпадают' if all(checks) else '❌ Результаты расходятся: ' + str(checks)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,30 @@
 import sqlite3
 import logging
 import time
-import json
 import shutil
-import hashlib
 import re
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime
 from sqlite3 import OperationalError
 from pathlib import Path
 from config import Config
+from metrics import metrics
+from storage import Storage, UserRow, UserSummary, UserStatus, USER_SUMMARY_COLUMNS, EXPORT_TABLES
 
 logger = logging.getLogger(__name__)
 
 
-class Database:
+def _row_factory(row_class):
+    make = row_class._make
+    return lambda cursor, row: make(row)
+
+
+class Database(Storage):
+    """Хранилище в SQLite (по умолчанию): одно соединение на процесс, WAL"""
+
     def __init__(self):
+        super().__init__()
         self.db_path = Config.DB_PATH
-        self.backup_dir = Config.BACKUP_DIR
         self.max_retries = 5
         self.retry_delay = 1
         self.conn = self._create_connection()
@@ -30,6 +38,9 @@ class Database:
                     check_same_thread=False,
                     timeout=30.0
                 )
+                # auto_vacuum применяется только к новой БД (до создания таблиц),
+                # существующая переводится один раз при запуске (enable_incremental_vacuum)
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
                 conn.execute("PRAGMA journal_mode=WAL")
                 conn.execute("PRAGMA busy_timeout=30000")
                 conn.execute("PRAGMA foreign_keys = OFF")  # Временно отключаем
@@ -49,8 +60,16 @@ class Database:
         cursor.execute(query, params)
         return cursor
 
+    def fetch_rows(self, row_class, query, params=()):
+        """Выполняет запрос; строки результата - экземпляры row_class (namedtuple)"""
+        cursor = self.conn.cursor()
+        cursor.row_factory = _row_factory(row_class)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
     def commit(self):
-        self.conn.commit()
+        with metrics.timer('vpnbot_sqlite_commit_seconds'):
+            self.conn.commit()
 
     def restore_from_backup_file(self, backup_file_path):
         """Восстанавливает текущую БД из файла бэкапа."""
@@ -74,6 +93,9 @@ class Database:
                 shm_file.unlink()
 
             self.conn = self._create_connection()
+            # В старом бэкапе может не быть индексов поиска
+            self._create_tables()
+            self.users_version += 1
             return True, "База данных восстановлена из бэкапа"
         except Exception as e:
             logger.error(f"Ошибка восстановления БД: {str(e)}")
@@ -99,7 +121,11 @@ class Database:
                               total_bytes_sent BIGINT DEFAULT 0,
                               total_bytes_received BIGINT DEFAULT 0,
                               is_active BOOLEAN DEFAULT 0,
-                              last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                              last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                              quota_daily BIGINT DEFAULT 0,
+                              quota_monthly BIGINT DEFAULT 0,
+                              quota_total BIGINT DEFAULT 0,
+                              quota_action TEXT DEFAULT 'warn'
                            )''')
             else:
                 # Проверяем колонки
@@ -111,6 +137,17 @@ class Database:
                     except:
                         pass
 
+                # Квоты трафика (0 - без ограничения)
+                for column, definition in (('quota_daily', 'BIGINT DEFAULT 0'),
+                                           ('quota_monthly', 'BIGINT DEFAULT 0'),
+                                           ('quota_total', 'BIGINT DEFAULT 0'),
+                                           ('quota_action', "TEXT DEFAULT 'warn'")):
+                    if column not in columns:
+                        try:
+                            self.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+                        except:
+                            pass
+
             # Таблица администраторов
             if 'admins' not in existing_tables:
                 self.execute('''CREATE TABLE admins (
@@ -191,6 +228,64 @@ class Database:
                               backup_reason TEXT
                            )''')
 
+            # Служебное состояние монитора (seq журнала трафика и т.п.)
+            if 'monitor_state' not in existing_tables:
+                self.execute('''CREATE TABLE monitor_state (
+                              key TEXT PRIMARY KEY,
+                              value TEXT,
+                              updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                           )''')
+
+            # Дневные агрегаты сессий (сюда сжимаются старые строки user_stats)
+            if 'user_stats_daily' not in existing_tables:
+                self.execute('''CREATE TABLE user_stats_daily (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              username TEXT NOT NULL,
+                              stat_date DATE NOT NULL,
+                              sessions_count INTEGER DEFAULT 0,
+                              duration_seconds INTEGER DEFAULT 0,
+                              bytes_sent BIGINT DEFAULT 0,
+                              bytes_received BIGINT DEFAULT 0,
+                              UNIQUE(username, stat_date)
+                           )''')
+
+            # Узлы флота и размещение пользователей по узлам (режим агрегатора)
+            if 'fleet_nodes' not in existing_tables:
+                self.execute('''CREATE TABLE fleet_nodes (
+                              node_id TEXT PRIMARY KEY,
+                              url TEXT,
+                              last_seq INTEGER DEFAULT 0,
+                              users_count INTEGER DEFAULT 0,
+                              last_push TIMESTAMP,
+                              epoch TEXT
+                           )''')
+            else:
+                cursor = self.execute("PRAGMA table_info(fleet_nodes)")
+                if 'epoch' not in [col[1] for col in cursor.fetchall()]:
+                    self.execute("ALTER TABLE fleet_nodes ADD COLUMN epoch TEXT")
+            if 'user_nodes' not in existing_tables:
+                self.execute('''CREATE TABLE user_nodes (
+                              username TEXT PRIMARY KEY,
+                              node_id TEXT NOT NULL
+                           )''')
+                self.execute("CREATE INDEX IF NOT EXISTS idx_user_nodes_node ON user_nodes (node_id)")
+
+            # Индексы для выборок по пользователю и для политики хранения
+            self.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_username ON user_stats (username, session_id, status)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_start ON user_stats (connection_start)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_session_backup_username ON session_backup (username)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_session_backup_end ON session_backup (end_time)")
+
+            # Индексы поиска пользователей (search_users): префикс имени без учета регистра,
+            # создатель, статус и последнее подключение
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_created_by ON users (created_by, username COLLATE NOCASE)")
+            self.execute('''CREATE INDEX IF NOT EXISTS idx_users_admin_nocase
+                            ON users (created_by_username COLLATE NOCASE, username COLLATE NOCASE)''')
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users (is_active, username COLLATE NOCASE)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_last_connected ON users (last_connected)")
+            self._ensure_users_fts()
+
             self.commit()
             logger.info("Все таблицы созданы/проверены")
 
@@ -198,6 +293,32 @@ class Database:
             logger.error(f"Ошибка при создании таблиц: {str(e)}")
             raise
 
+    def _ensure_users_fts(self):
+        """FTS5-индекс (триграммы) по именам для поиска подстроки; без FTS5 поиск идет через LIKE"""
+        try:
+            exists = self.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'").fetchone()
+            if not exists:
+                self.execute('''CREATE VIRTUAL TABLE users_fts USING fts5(
+                              username, content='users', content_rowid='id', tokenize='trigram'
+                           )''')
+                self.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+            # Внешнее содержимое: индекс следует за users через триггеры
+            self.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+                              INSERT INTO users_fts (rowid, username) VALUES (new.id, new.username);
+                           END''')
+            self.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+                              INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', old.id, old.username);
+                           END''')
+            self.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users BEGIN
+                              INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', old.id, old.username);
+                              INSERT INTO users_fts (rowid, username) VALUES (new.id, new.username);
+                           END''')
+            self.users_fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 недоступен, поиск по подстроке будет без индекса: {str(e)}")
+            self.users_fts = False
+
     # ========== МЕТОДЫ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ==========
 
     def user_exists(self, username):
@@ -209,6 +330,7 @@ class Database:
             self.execute("INSERT INTO users (username, created_by, created_by_username) VALUES (?, ?, ?)",
                          (username, created_by, created_by_username))
             self.commit()
+            self.users_version += 1
             logger.info(f"Пользователь {username} добавлен")
             return True
         except sqlite3.IntegrityError:
@@ -216,12 +338,97 @@ class Database:
             return False
 
     def get_all_users(self):
-        cursor = self.execute("SELECT * FROM users ORDER BY created_at DESC")
-        return cursor.fetchall()
+        return self.fetch_rows(UserRow, f"SELECT {', '.join(UserRow._fields)} FROM users ORDER BY created_at DESC")
 
     def get_user(self, username):
-        cursor = self.execute("SELECT * FROM users WHERE username = ?", (username,))
-        return cursor.fetchone()
+        rows = self.fetch_rows(UserRow, f"SELECT {', '.join(UserRow._fields)} FROM users WHERE username = ?",
+                               (username,))
+        return rows[0] if rows else None
+
+    def get_user_summaries(self, created_by=None, order_by_traffic=False, limit=None):
+        """Пользователи для списков: только отображаемые колонки"""
+        query = f"SELECT {USER_SUMMARY_COLUMNS} FROM users"
+        params = []
+        if created_by is not None:
+            query += " WHERE created_by = ?"
+            params.append(created_by)
+        if order_by_traffic:
+            query += " ORDER BY COALESCE(total_bytes_sent, 0) + COALESCE(total_bytes_received, 0) DESC"
+        else:
+            query += " ORDER BY created_at DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.fetch_rows(UserSummary, query, params)
+
+    def get_user_statuses(self, created_by=None):
+        """Пользователи для кнопок выбора: имя, кто создал, активен ли"""
+        query = "SELECT username, created_by_username, COALESCE(is_active, 0) FROM users"
+        params = ()
+        if created_by is not None:
+            query += " WHERE created_by = ?"
+            params = (created_by,)
+        return self.fetch_rows(UserStatus, query + " ORDER BY created_at DESC", params)
+
+    def search_users(self, name=None, substring=False, admin=None, is_active=None, seen_within=None,
+                     unseen_for=None, order_by_name=False, limit=None, offset=0):
+        """Поиск пользователей по фильтрам (все необязательны, объединяются через AND).
+
+        name - начало имени или, при substring=True, часть имени (без учета регистра);
+        admin - id создавшего администратора или начало его имени; seen_within и
+        unseen_for - секунды с последнего подключения (подключался за / не подключался
+        за, включая тех, кто не подключался ни разу). Возвращает UserSummary.
+        """
+        conditions = []
+        params = []
+
+        if name:
+            if not substring:
+                # Диапазон по индексу NOCASE вместо LIKE: в именах бывает '_'
+                conditions.append("username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE")
+                params.extend((name, name + '\uffff'))
+            elif self.users_fts and len(name) >= 3:
+                conditions.append("id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)")
+                params.append('"' + name.replace('"', '""') + '"')
+            else:
+                # Меньше трех символов - триграммы не помогут, короткий скан
+                conditions.append("username LIKE ? ESCAPE '\\'")
+                params.append('%' + re.sub(r'([%_\\])', r'\\\1', name) + '%')
+
+        if isinstance(admin, int):
+            conditions.append("created_by = ?")
+            params.append(admin)
+        elif admin:
+            conditions.append("created_by_username >= ? COLLATE NOCASE AND created_by_username < ? COLLATE NOCASE")
+            params.extend((admin, admin + '\uffff'))
+
+        if is_active is not None:
+            conditions.append("is_active = ?")
+            params.append(1 if is_active else 0)
+
+        if seen_within:
+            conditions.append("last_connected >= datetime('now', ?)")
+            params.append(f"-{int(seen_within)} seconds")
+        if unseen_for:
+            conditions.append("(last_connected IS NULL OR last_connected < datetime('now', ?))")
+            params.append(f"-{int(unseen_for)} seconds")
+
+        query = f"SELECT {USER_SUMMARY_COLUMNS} FROM users"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY username COLLATE NOCASE" if order_by_name else " ORDER BY created_at DESC"
+        if limit:
+            query += " LIMIT ? OFFSET ?"
+            params.extend((limit, offset))
+        with metrics.timer('vpnbot_user_search_seconds'):
+            return self.fetch_rows(UserSummary, query, params)
+
+    def get_usernames(self, created_by=None):
+        if created_by is None:
+            cursor = self.execute("SELECT username FROM users ORDER BY username")
+        else:
+            cursor = self.execute("SELECT username FROM users WHERE created_by = ? ORDER BY username", (created_by,))
+        return [row[0] for row in cursor.fetchall()]
 
     def delete_user(self, username):
         try:
@@ -234,6 +441,9 @@ class Database:
             deleted = cursor.rowcount > 0
 
             if deleted:
+                self.maintenance_requested = True
+                self.quota_version += 1
+                self.users_version += 1
                 logger.info(f"Пользователь {username} удален из БД")
             return deleted
 
@@ -251,10 +461,14 @@ class Database:
             self.execute("DELETE FROM session_backup")
             self.execute("DELETE FROM active_sessions")
             self.execute("DELETE FROM user_stats")
+            self.execute("DELETE FROM user_stats_daily")
             self.execute("DELETE FROM traffic_log")
             self.execute("DELETE FROM users")
 
             self.commit()
+            self.maintenance_requested = True
+            self.quota_version += 1
+            self.users_version += 1
             logger.info("Все пользователи удалены из БД")
             return True
 
@@ -266,15 +480,61 @@ class Database:
         cursor = self.execute("SELECT COUNT(*) FROM users")
         return cursor.fetchone()[0] or 0
 
+    # ========== МЕТОДЫ ДЛЯ КВОТ ==========
+
+    def get_user_quotas(self):
+        """Возвращает квоты пользователей, у которых задано хотя бы одно ограничение"""
+        cursor = self.execute('''SELECT username, created_by, quota_daily, quota_monthly, quota_total, quota_action
+                              FROM users
+                              WHERE quota_daily > 0 OR quota_monthly > 0 OR quota_total > 0''')
+        return {
+            row[0]: {
+                'created_by': row[1],
+                'daily': row[2] or 0,
+                'monthly': row[3] or 0,
+                'total': row[4] or 0,
+                'action': row[5] or 'warn'
+            }
+            for row in cursor.fetchall()
+        }
+
+    def set_user_quota(self, username, kind=None, limit=None, action=None):
+        """Задает лимит квоты (daily/monthly/total, 0 - снять) и/или действие при превышении"""
+        try:
+            if kind is not None:
+                if kind not in ('daily', 'monthly', 'total'):
+                    return False
+                self.execute(f"UPDATE users SET quota_{kind} = ? WHERE username = ?", (int(limit or 0), username))
+            if action is not None:
+                self.execute("UPDATE users SET quota_action = ? WHERE username = ?", (action, username))
+            self.commit()
+            self.quota_version += 1
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка изменения квоты {username}: {str(e)}")
+            return False
+
+    def get_quota_usage(self, username, day, month_start):
+        """Возвращает (за день, за месяц, всего) байт из итогов БД - начальные значения счетчиков квот"""
+        cursor = self.execute('''SELECT
+                                  COALESCE(SUM(CASE WHEN log_date = ? THEN bytes_sent + bytes_received END), 0),
+                                  COALESCE(SUM(bytes_sent + bytes_received), 0)
+                              FROM traffic_log
+                              WHERE username = ? AND log_date >= ?''',
+                              (day, username, month_start))
+        daily, monthly = cursor.fetchone()
+
+        cursor = self.execute("SELECT total_bytes_sent + total_bytes_received FROM users WHERE username = ?",
+                              (username,))
+        row = cursor.fetchone()
+        return daily, monthly, (row[0] or 0) if row else 0
+
     # ========== МЕТОДЫ ДЛЯ АДМИНИСТРАТОРОВ ==========
 
     def is_admin(self, user_id):
         cursor = self.execute("SELECT id FROM admins WHERE user_id = ?", (user_id,))
         return cursor.fetchone() is not None
 
-    def is_super_admin(self, user_id):
-        return user_id == Config.SUPER_ADMIN_ID
-
     def get_all_admins(self):
         cursor = self.execute('''SELECT a.user_id, a.username, a.added_at, 
                                COALESCE(s.username, 'Супер-админ') as added_by_name
@@ -303,40 +563,173 @@ class Database:
 
     # ========== МЕТОДЫ ДЛЯ СТАТИСТИКИ И ТРАФИКА ==========
 
+    def _add_traffic(self, username, bytes_sent_diff, bytes_received_diff, log_date=None):
+        """Добавляет трафик к итогам пользователя и дневному логу (без commit)"""
+        # Обновляем общий трафик
+        self.execute('''UPDATE users 
+                     SET total_bytes_sent = total_bytes_sent + ?,
+                         total_bytes_received = total_bytes_received + ?,
+                         last_updated = CURRENT_TIMESTAMP
+                     WHERE username = ?''',
+                     (bytes_sent_diff, bytes_received_diff, username))
+
+        # Обновляем ежедневную статистику
+        today = log_date or datetime.now().date()
+        self.execute('''INSERT OR REPLACE INTO traffic_log 
+                     (username, log_date, bytes_sent, bytes_received, connections_count)
+                     VALUES (?, ?, 
+                             COALESCE((SELECT bytes_sent FROM traffic_log WHERE username = ? AND log_date = ?), 0) + ?,
+                             COALESCE((SELECT bytes_received FROM traffic_log WHERE username = ? AND log_date = ?), 0) + ?,
+                             COALESCE((SELECT connections_count FROM traffic_log WHERE username = ? AND log_date = ?), 0)
+                     )''',
+                     (username, today, username, today, bytes_sent_diff,
+                      username, today, bytes_received_diff, username, today))
+        self.users_version += 1
+
     def update_traffic(self, username, bytes_sent_diff, bytes_received_diff, connection_id=None):
         """Обновляет общий трафик пользователя"""
         try:
-            # Обновляем общий трафик
-            self.execute('''UPDATE users 
-                         SET total_bytes_sent = total_bytes_sent + ?,
-                             total_bytes_received = total_bytes_received + ?,
-                             last_updated = CURRENT_TIMESTAMP
-                         WHERE username = ?''',
-                         (bytes_sent_diff, bytes_received_diff, username))
-
-            # Обновляем ежедневную статистику
-            today = datetime.now().date()
-            self.execute('''INSERT OR REPLACE INTO traffic_log 
-                         (username, log_date, bytes_sent, bytes_received, connections_count)
-                         VALUES (?, ?, 
-                                 COALESCE((SELECT bytes_sent FROM traffic_log WHERE username = ? AND log_date = ?), 0) + ?,
-                                 COALESCE((SELECT bytes_received FROM traffic_log WHERE username = ? AND log_date = ?), 0) + ?,
-                                 COALESCE((SELECT connections_count FROM traffic_log WHERE username = ? AND log_date = ?), 0)
-                         )''',
-                         (username, today, username, today, bytes_sent_diff,
-                          username, today, bytes_received_diff, username, today))
-
+            self._add_traffic(username, bytes_sent_diff, bytes_received_diff)
             self.commit()
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления трафика для {username}: {str(e)}")
             return False
 
-    def create_session_hash(self, username, connection_id, client_ip):
-        """Создает уникальный хэш для сессии"""
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        data = f"{username}_{connection_id}_{client_ip}_{timestamp}"
-        return hashlib.md5(data.encode()).hexdigest()[:16]
+    def apply_traffic_batch(self, entries, journal_seq=None):
+        """Записывает накопленные дельты одной транзакцией.
+
+        entries: [(username, connection_id, sent_diff, received_diff, absolute_sent, absolute_received)].
+        Вместе с дельтами сохраняются базовые счетчики сессий и seq журнала,
+        поэтому повторное проигрывание журнала не считает трафик дважды.
+        """
+        try:
+            for username, connection_id, sent_diff, received_diff, absolute_sent, absolute_received in entries:
+                if sent_diff > 0 or received_diff > 0:
+                    self._add_traffic(username, sent_diff, received_diff)
+                self.execute('''UPDATE active_sessions 
+                             SET last_bytes_sent = ?,
+                                 last_bytes_received = ?,
+                                 last_updated = CURRENT_TIMESTAMP
+                             WHERE username = ? AND connection_id = ?''',
+                             (absolute_sent, absolute_received, username, connection_id))
+
+            if journal_seq is not None:
+                self.set_monitor_state('journal_seq', journal_seq, commit=False)
+
+            self.commit()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка пакетной записи трафика: {str(e)}")
+            return False
+
+    # ========== ФЛОТ УЗЛОВ (РЕЖИМ АГРЕГАТОРА) ==========
+
+    def apply_fleet_push(self, node_id, url, ticks, active_usernames, users_count, epoch=None):
+        """Применяет дельты тиков узла одной транзакцией; возвращает последний учтенный seq.
+
+        ticks: [(seq, ts, [(username, connection_id, sent_diff, received_diff)])]. Тики с seq
+        не больше уже учтенного пропускаются, поэтому повторная отправка не удваивает трафик.
+        epoch - идентификатор БД узла: если он сменился, журнал узла начат заново и учтенный
+        seq сбрасывается.
+        """
+        try:
+            row = self.execute("SELECT last_seq, epoch FROM fleet_nodes WHERE node_id = ?", (node_id,)).fetchone()
+            last_seq, stored_epoch = row if row else (0, None)
+            last_seq = self._fleet_epoch_seq(node_id, last_seq, stored_epoch, epoch)
+
+            for seq, ts, deltas in sorted(ticks, key=lambda tick: tick[0]):
+                if seq <= last_seq:
+                    continue
+                log_date = datetime.fromtimestamp(ts).date()
+                for username, connection_id, sent_diff, received_diff in deltas:
+                    self._ensure_fleet_user(username, node_id)
+                    self._add_traffic(username, sent_diff, received_diff, log_date)
+                last_seq = seq
+
+            # Активность пользователей узла - по последнему снимку его сессий
+            for username in active_usernames:
+                self._ensure_fleet_user(username, node_id)
+            placeholders = ','.join('?' * len(active_usernames))
+            cursor = self.execute(f'''UPDATE users SET is_active = 0
+                                      WHERE is_active = 1 AND username NOT IN ({placeholders})
+                                        AND username IN (SELECT username FROM user_nodes WHERE node_id = ?)''',
+                                  (*active_usernames, node_id))
+            changed = cursor.rowcount
+            if active_usernames:
+                cursor = self.execute(f'''UPDATE users
+                                          SET is_active = 1,
+                                              last_connected = CURRENT_TIMESTAMP,
+                                              total_connections = total_connections + 1
+                                          WHERE COALESCE(is_active, 0) = 0 AND username IN ({placeholders})''',
+                                      active_usernames)
+                changed += cursor.rowcount
+
+            self.execute('''INSERT INTO fleet_nodes (node_id, url, last_seq, users_count, last_push, epoch)
+                         VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
+                         ON CONFLICT(node_id) DO UPDATE SET url = excluded.url, last_seq = excluded.last_seq,
+                             users_count = excluded.users_count, last_push = CURRENT_TIMESTAMP,
+                             epoch = COALESCE(excluded.epoch, fleet_nodes.epoch)''',
+                         (node_id, url, last_seq, users_count, epoch))
+            self.commit()
+            if changed:
+                self.users_version += 1
+            return last_seq
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка применения данных узла {node_id}: {str(e)}")
+            return None
+
+    def _ensure_fleet_user(self, username, node_id):
+        """Пользователь, впервые увиденный в данных узла, заводится в БД агрегатора (без commit)"""
+        cursor = self.execute("INSERT OR IGNORE INTO users (username, created_by, created_by_username) VALUES (?, ?, ?)",
+                              (username, Config.SUPER_ADMIN_ID, f"Узел {node_id}"))
+        if cursor.rowcount:
+            self.users_version += 1
+            logger.info(f"Пользователь {username} с узла {node_id} создан в БД")
+        # Пользователь мог переехать на другой узел: размещение - по узлу, который о нем сообщил
+        self.execute('''INSERT INTO user_nodes (username, node_id) VALUES (?, ?)
+                     ON CONFLICT(username) DO UPDATE SET node_id = excluded.node_id''', (username, node_id))
+
+    def get_fleet_nodes(self):
+        """Узлы флота: [(node_id, url, last_seq, users_count, last_push)]"""
+        return self.execute("SELECT node_id, url, last_seq, users_count, last_push FROM fleet_nodes "
+                            "ORDER BY node_id").fetchall()
+
+    def get_user_node(self, username):
+        row = self.execute("SELECT node_id FROM user_nodes WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def set_user_node(self, username, node_id):
+        self.execute("INSERT OR REPLACE INTO user_nodes (username, node_id) VALUES (?, ?)", (username, node_id))
+        self.commit()
+
+    def delete_user_node(self, username):
+        self.execute("DELETE FROM user_nodes WHERE username = ?", (username,))
+        self.commit()
+
+    def get_node_user_counts(self):
+        """Число пользователей на каждом узле по карте размещения: {node_id: count}"""
+        cursor = self.execute("SELECT node_id, COUNT(*) FROM user_nodes GROUP BY node_id")
+        return dict(cursor.fetchall())
+
+    def get_monitor_state(self, key, default=None):
+        cursor = self.execute("SELECT value FROM monitor_state WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        return row[0] if row else default
+
+    def set_monitor_state(self, key, value, commit=True):
+        self.execute('''INSERT INTO monitor_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                     ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP''',
+                     (key, str(value)))
+        if commit:
+            self.commit()
+
+    def get_monitor_stopped_at(self):
+        cursor = self.execute("SELECT CAST(strftime('%s', MAX(updated_at)) AS INTEGER) FROM monitor_state "
+                              "WHERE key IN ('warm_state', 'journal_seq')")
+        return cursor.fetchone()[0]
 
     def ensure_user_exists(self, username):
         """Гарантирует что пользователь существует в БД"""
@@ -350,6 +743,7 @@ class Database:
                     (username, Config.SUPER_ADMIN_ID, "Система (автосоздание)")
                 )
                 self.commit()
+                self.users_version += 1
                 logger.info(f"Пользователь {username} создан в БД")
                 return True
             return True
@@ -429,6 +823,7 @@ class Database:
                                  is_active = 1
                              WHERE username = ?''',
                              (username,))
+                self.users_version += 1
 
             self.commit()
             return bytes_sent_diff, bytes_received_diff, session_hash
@@ -437,69 +832,183 @@ class Database:
             logger.error(f"Ошибка обновления сессии {username}: {str(e)}")
             return 0, 0, None
 
-    def finalize_session(self, username, connection_id, session_hash, reason="normal_disconnect"):
-        """Завершает сессию и создает резервную копию"""
+    def register_session(self, username, connection_id, client_ip, absolute_sent, absolute_received):
+        """Обновляет счетчики сессии (username, connection_id) или открывает новую. Возвращает хэш сессии"""
         try:
-            # Получаем данные сессии
             cursor = self.execute(
-                "SELECT last_bytes_sent, last_bytes_received, client_ip, first_seen FROM active_sessions WHERE username = ? AND connection_id = ? AND session_hash = ?",
-                (username, connection_id, session_hash)
+                "SELECT session_hash FROM active_sessions WHERE username = ? AND connection_id = ?",
+                (username, connection_id)
             )
-            session_data = cursor.fetchone()
+            existing = cursor.fetchone()
 
-            if not session_data:
-                logger.warning(f"Сессия не найдена для завершения: {username}_{connection_id}_{session_hash}")
-                return False
+            if existing:
+                # Обновляем существующую
+                session_hash = existing[0]
+                self.execute('''UPDATE active_sessions 
+                             SET last_bytes_sent = ?,
+                                 last_bytes_received = ?,
+                                 client_ip = ?,
+                                 last_updated = CURRENT_TIMESTAMP
+                             WHERE username = ? AND connection_id = ? AND session_hash = ?''',
+                             (absolute_sent, absolute_received, client_ip, username, connection_id, session_hash))
+            else:
+                # Создаем новую сессию
+                session_hash = self.create_session_hash(username, connection_id, client_ip)
+                self.execute('''INSERT INTO active_sessions 
+                             (username, connection_id, session_hash, last_bytes_sent, last_bytes_received, client_ip)
+                             VALUES (?, ?, ?, ?, ?, ?)''',
+                             (username, connection_id, session_hash, absolute_sent, absolute_received, client_ip))
 
-            sent, received, client_ip, first_seen = session_data
-
-            # Создаем резервную копию сессии
-            self.execute('''INSERT INTO session_backup 
-                         (username, connection_id, session_hash, total_bytes_sent, total_bytes_received, start_time, backup_reason)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                         (username, connection_id, session_hash, sent, received, first_seen, reason))
-
-            # Завершаем сессию в статистике
-            cursor = self.execute('''SELECT id FROM user_stats 
-                                  WHERE username = ? AND session_id = ? AND status = 'active' 
-                                  ORDER BY connection_start DESC LIMIT 1''',
-                                  (username, session_hash))
-            stats_session = cursor.fetchone()
-
-            if stats_session:
-                session_id = stats_session[0]
-                self.execute('''UPDATE user_stats 
-                             SET connection_end = CURRENT_TIMESTAMP,
-                                 duration_seconds = strftime('%s', 'now') - strftime('%s', connection_start),
-                                 bytes_sent = ?,
-                                 bytes_received = ?,
-                                 status = 'completed'
-                             WHERE id = ?''',
-                             (sent, received, session_id))
-
-            # Удаляем из активных сессий
-            self.execute("DELETE FROM active_sessions WHERE username = ? AND connection_id = ? AND session_hash = ?",
-                         (username, connection_id, session_hash))
-
-            # Обновляем общий трафик
-            self.update_traffic(username, sent, received, connection_id)
-
-            # Помечаем как неактивного если больше нет активных сессий
-            cursor = self.execute("SELECT COUNT(*) FROM active_sessions WHERE username = ?", (username,))
-            active_count = cursor.fetchone()[0]
-            if active_count == 0:
-                self.execute("UPDATE users SET is_active = 0 WHERE username = ?", (username,))
+                # Регистрируем начало подключения
+                self.execute('''INSERT INTO user_stats 
+                             (username, connection_start, client_ip, status, session_id)
+                             VALUES (?, CURRENT_TIMESTAMP, ?, 'active', ?)''',
+                             (username, client_ip, session_hash))
+
+                # Увеличиваем счетчик подключений
+                self.execute('''UPDATE users 
+                             SET total_connections = total_connections + 1,
+                                 last_connected = CURRENT_TIMESTAMP,
+                                 is_active = 1
+                             WHERE username = ?''',
+                             (username,))
+                self.users_version += 1
 
             self.commit()
-            logger.info(f"Сессия завершена {username}: sent={sent}, received={received}, reason={reason}")
-            return True
+            return session_hash
+
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка обновления сессии в БД {username}: {str(e)}")
+            return None
+
+    def get_session_base(self, username):
+        """Счетчики последней обновленной сессии пользователя: (sent, received, connection_id) или None"""
+        cursor = self.execute(
+            "SELECT last_bytes_sent, last_bytes_received, connection_id FROM active_sessions WHERE username = ? ORDER BY last_updated DESC LIMIT 1",
+            (username,)
+        )
+        return cursor.fetchone()
+
+    @contextmanager
+    def _savepoint(self, name):
+        """SAVEPOINT вокруг группы запросов: при ошибке откатывается только она, внешняя транзакция остается"""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute(f"SAVEPOINT {name}")
+        try:
+            yield
+        except Exception:
+            self.conn.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            self.conn.execute(f"RELEASE SAVEPOINT {name}")
+            raise
+        self.conn.execute(f"RELEASE SAVEPOINT {name}")
+
+    def finalize_session(self, username, connection_id, session_hash, reason="normal_disconnect", commit=True):
+        """Завершает сессию и создает резервную копию"""
+        try:
+            with self._savepoint('finalize_session'):
+                finalized = self._finalize_session(username, connection_id, session_hash, reason)
+            if commit:
+                self.commit()
+            return finalized
 
         except Exception as e:
             logger.error(f"Ошибка завершения сессии {username}: {str(e)}")
             return False
 
+    def _finalize_session(self, username, connection_id, session_hash, reason):
+        # Получаем данные сессии
+        cursor = self.execute(
+            "SELECT last_bytes_sent, last_bytes_received, client_ip, first_seen FROM active_sessions WHERE username = ? AND connection_id = ? AND session_hash = ?",
+            (username, connection_id, session_hash)
+        )
+        session_data = cursor.fetchone()
+
+        if not session_data:
+            logger.warning(f"Сессия не найдена для завершения: {username}_{connection_id}_{session_hash}")
+            return False
+
+        sent, received, client_ip, first_seen = session_data
+
+        # Создаем резервную копию сессии
+        self.execute('''INSERT INTO session_backup 
+                     (username, connection_id, session_hash, total_bytes_sent, total_bytes_received, start_time, backup_reason)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                     (username, connection_id, session_hash, sent, received, first_seen, reason))
+
+        # Завершаем сессию в статистике
+        cursor = self.execute('''SELECT id FROM user_stats 
+                              WHERE username = ? AND session_id = ? AND status = 'active' 
+                              ORDER BY connection_start DESC LIMIT 1''',
+                              (username, session_hash))
+        stats_session = cursor.fetchone()
+
+        if stats_session:
+            session_id = stats_session[0]
+            self.execute('''UPDATE user_stats 
+                         SET connection_end = CURRENT_TIMESTAMP,
+                             duration_seconds = strftime('%s', 'now') - strftime('%s', connection_start),
+                             bytes_sent = ?,
+                             bytes_received = ?,
+                             status = 'completed'
+                         WHERE id = ?''',
+                         (sent, received, session_id))
+
+        # Удаляем из активных сессий
+        self.execute("DELETE FROM active_sessions WHERE username = ? AND connection_id = ? AND session_hash = ?",
+                     (username, connection_id, session_hash))
+
+        # Трафик сессии уже учтен потиковыми дельтами монитора, повторно не добавляем
+
+        # Помечаем как неактивного если больше нет активных сессий
+        cursor = self.execute("SELECT COUNT(*) FROM active_sessions WHERE username = ?", (username,))
+        active_count = cursor.fetchone()[0]
+        if active_count == 0:
+            self.execute("UPDATE users SET is_active = 0 WHERE username = ?", (username,))
+            self.users_version += 1
+
+        logger.info(f"Сессия завершена {username}: sent={sent}, received={received}, reason={reason}")
+        return True
+
+    def get_active_sessions(self):
+        """Возвращает активные сессии: (username, connection_id, session_hash, last_bytes_sent, last_bytes_received)"""
+        cursor = self.execute('''SELECT username, connection_id, session_hash, last_bytes_sent, last_bytes_received
+                              FROM active_sessions''')
+        return cursor.fetchall()
+
+    def finalize_sessions(self, sessions, reason, deadline=None):
+        """Завершает переданные сессии [(username, connection_id, session_hash)] одной транзакцией.
+
+        deadline - time.time(), после которого обработка прекращается; незавершенные
+        сессии остаются в active_sessions. Возвращает (завершено, всего).
+        """
+        completed = 0
+        try:
+            for username, connection_id, session_hash in sessions:
+                if deadline and time.time() > deadline:
+                    logger.warning(f"Лимит времени: завершено {completed} из {len(sessions)} сессий")
+                    break
+                if self.finalize_session(username, connection_id, session_hash, reason, commit=False):
+                    completed += 1
+            self.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка пакетного завершения сессий: {str(e)}")
+            return 0, len(sessions)
+
+        return completed, len(sessions)
+
     def cleanup_old_sessions(self, active_usernames):
-        """Очищает старые сессии"""
+        """Очищает старые сессии.
+
+        active_usernames - подтвержденный список активных пользователей. None (источник
+        недоступен) ничего не трогает; пустой список означает "туннелей нет".
+        """
+        if active_usernames is None:
+            logger.warning("Очистка сессий пропущена: нет подтвержденного списка активных")
+            return False
+
         try:
             if not active_usernames:
                 # Завершаем все сессии
@@ -507,9 +1016,12 @@ class Database:
                 all_sessions = cursor.fetchall()
 
                 for username, connection_id, session_hash in all_sessions:
-                    self.finalize_session(username, connection_id, session_hash, "cleanup_no_active")
+                    self.finalize_session(username, connection_id, session_hash, "cleanup_no_active", commit=False)
 
-                self.execute("UPDATE users SET is_active = 0")
+                cursor = self.execute("UPDATE users SET is_active = 0 WHERE is_active = 1")
+                self.commit()
+                if cursor.rowcount:
+                    self.users_version += 1
                 logger.info("Завершены все сессии")
                 return True
 
@@ -524,15 +1036,17 @@ class Database:
 
             # Завершаем старые сессии
             for username, connection_id, session_hash in old_sessions:
-                self.finalize_session(username, connection_id, session_hash, "cleanup_inactive")
+                self.finalize_session(username, connection_id, session_hash, "cleanup_inactive", commit=False)
 
-            # Помещаем неактивных пользователей
-            self.execute(f'''UPDATE users 
+            # Помечаем неактивных пользователей (только тех, кто еще помечен активным)
+            cursor = self.execute(f'''UPDATE users 
                          SET is_active = 0 
-                         WHERE username NOT IN ({placeholders})''',
-                         active_usernames)
+                         WHERE is_active = 1 AND username NOT IN ({placeholders})''',
+                                  active_usernames)
 
             self.commit()
+            if cursor.rowcount:
+                self.users_version += 1
 
             if old_sessions:
                 logger.info(f"Очищено {len(old_sessions)} старых сессий")
@@ -540,6 +1054,7 @@ class Database:
             return True
 
         except Exception as e:
+            self.conn.rollback()
             logger.error(f"Ошибка очистки сессий: {str(e)}")
             return False
 
@@ -589,171 +1104,293 @@ class Database:
             logger.error(f"Ошибка получения статистики пользователя {username}: {str(e)}")
             return None
 
-    # ========== МЕТОДЫ ДЛЯ РЕЗЕРВНОГО КОПИРОВАНИЯ ==========
-
-    def backup_user_data(self, username, reason):
-        """Создает резервную копию данных пользователя"""
+    def get_daily_traffic(self, date_from, date_to, username=None):
+        """Трафик по дням за период: [(log_date, sent, received)], по пользователю или по серверу"""
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_file = self.backup_dir / f"user_{username}_{timestamp}.json"
-
-            user_data = {
-                "username": username,
-                "backup_time": datetime.now().isoformat(),
-                "backup_reason": reason,
-                "user_info": None,
-                "stats": [],
-                "traffic_logs": []
-            }
-
-            # Данные пользователя
-            cursor = self.execute("SELECT * FROM users WHERE username = ?", (username,))
-            user_row = cursor.fetchone()
-            if user_row:
-                columns = [description[0] for description in cursor.description]
-                user_data["user_info"] = dict(zip(columns, user_row))
-
-            # Статистика
-            cursor = self.execute("SELECT * FROM user_stats WHERE username = ? ORDER BY connection_start", (username,))
-            for row in cursor.fetchall():
-                columns = [description[0] for description in cursor.description]
-                user_data["stats"].append(dict(zip(columns, row)))
-
-            # Логи трафика
-            cursor = self.execute("SELECT * FROM traffic_log WHERE username = ? ORDER BY log_date", (username,))
-            for row in cursor.fetchall():
-                columns = [description[0] for description in cursor.description]
-                user_data["traffic_logs"].append(dict(zip(columns, row)))
+            if username:
+                cursor = self.execute('''SELECT log_date, bytes_sent, bytes_received FROM traffic_log
+                                         WHERE username = ? AND log_date BETWEEN ? AND ?
+                                         ORDER BY log_date''',
+                                      (username, str(date_from), str(date_to)))
+            else:
+                cursor = self.execute('''SELECT log_date, SUM(bytes_sent), SUM(bytes_received) FROM traffic_log
+                                         WHERE log_date BETWEEN ? AND ?
+                                         GROUP BY log_date ORDER BY log_date''',
+                                      (str(date_from), str(date_to)))
+            return [(row[0], row[1] or 0, row[2] or 0) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения трафика по дням: {str(e)}")
+            return []
+
+    def get_traffic_version(self, username=None):
+        """Метка последнего изменения трафика (пользователя или всего сервера) для кэшей"""
+        if username:
+            cursor = self.execute("SELECT last_updated FROM users WHERE username = ?", (username,))
+        else:
+            cursor = self.execute("SELECT MAX(last_updated) FROM users")
+        row = cursor.fetchone()
+        # quota_version растет при удалении пользователей и обнулении трафика
+        return (row[0] if row else None), self.quota_version
+
+    def get_history_rows(self, date_from, date_to):
+        """Строки аналитики за период: дневной трафик и завершенные сессии"""
+        log_rows = self.execute('''SELECT username, log_date, COALESCE(bytes_sent, 0) + COALESCE(bytes_received, 0)
+                                   FROM traffic_log WHERE log_date BETWEEN ? AND ?''',
+                                (str(date_from), str(date_to))).fetchall()
+        session_rows = self.execute('''SELECT username, connection_start, duration_seconds,
+                                              COALESCE(bytes_sent, 0) + COALESCE(bytes_received, 0)
+                                       FROM user_stats
+                                       WHERE connection_start >= ? AND connection_start < date(?, '+1 day')
+                                         AND duration_seconds IS NOT NULL''',
+                                    (str(date_from), str(date_to))).fetchall()
+        return log_rows, session_rows
+
+    def get_last_session_id(self):
+        return self.execute("SELECT MAX(id) FROM user_stats").fetchone()[0]
+
+    @contextmanager
+    def export_query(self, table, date_from=None, date_to=None, usernames=None):
+        """Выгрузка отдельным соединением только для чтения: монитор не ждет ее завершения"""
+        date_column = EXPORT_TABLES[table]
+        conditions = []
+        params = []
+
+        if date_from:
+            conditions.append(f"{date_column} >= ?")
+            params.append(date_from.isoformat())
+        if date_to:
+            # date_to включительно: строки до начала следующего дня
+            conditions.append(f"{date_column} < date(?, '+1 day')")
+            params.append(date_to.isoformat())
+        if usernames:
+            conditions.append(f"username IN ({', '.join('?' * len(usernames))})")
+            params.extend(usernames)
+
+        query = f"SELECT * FROM {table}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=30.0)
+        try:
+            cursor = conn.execute(query + " ORDER BY id", params)
+            columns = [description[0] for description in cursor.description]
+            integer_types = ('INTEGER', 'BIGINT', 'BOOLEAN')
+            integer_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")
+                               if row[2].upper() in integer_types}
+
+            def batches():
+                while True:
+                    rows = cursor.fetchmany(Config.EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    yield rows
+
+            yield columns, integer_columns, batches()
+        finally:
+            conn.close()
 
-            # Сохраняем в файл
-            with open(backup_file, 'w', encoding='utf-8') as f:
-                json.dump(user_data, f, ensure_ascii=False, indent=2, default=str)
+    # ========== МЕТОДЫ ДЛЯ РЕЗЕРВНОГО КОПИРОВАНИЯ ==========
 
-            logger.info(f"Создана резервная копия данных пользователя {username}")
-            return str(backup_file)
+    def _select_user_rows(self, table, username, order_column=None):
+        query = f"SELECT * FROM {table} WHERE username = ?"
+        if order_column:
+            query += f" ORDER BY {order_column}"
+        cursor = self.execute(query, (username,))
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _write_full_backup(self, backup_file):
+        # Копия через backup API: в нее попадают и страницы, еще не перенесенные из WAL
+        target = sqlite3.connect(str(backup_file))
+        try:
+            self.conn.backup(target)
+        finally:
+            target.close()
+
+    def get_database_files_size(self):
+        """Возвращает размеры файлов БД: основной файл, WAL и SHM"""
+        sizes = {}
+        for key, suffix in (("db", ""), ("wal", "-wal"), ("shm", "-shm")):
+            try:
+                sizes[key] = Path(str(self.db_path) + suffix).stat().st_size
+            except FileNotFoundError:
+                sizes[key] = 0
+            except Exception as e:
+                logger.error(f"Ошибка получения размера {self.db_path}{suffix}: {str(e)}")
+                sizes[key] = 0
+        sizes["total"] = sizes["db"] + sizes["wal"] + sizes["shm"]
+        return sizes
+
+    # ========== МЕТОДЫ ОБСЛУЖИВАНИЯ БД ==========
+
+    def get_freelist_info(self):
+        """Возвращает (свободных страниц, размер страницы, режим auto_vacuum)"""
+        try:
+            freelist = self.execute("PRAGMA freelist_count").fetchone()[0] or 0
+            page_size = self.execute("PRAGMA page_size").fetchone()[0] or 0
+            auto_vacuum = self.execute("PRAGMA auto_vacuum").fetchone()[0] or 0
+            return freelist, page_size, auto_vacuum
+        except Exception as e:
+            logger.error(f"Ошибка получения freelist: {str(e)}")
+            return 0, 0, 0
 
+    def checkpoint_wal(self, mode="TRUNCATE"):
+        """Переносит WAL в основной файл. Возвращает (busy, страниц в WAL, перенесено) или None"""
+        if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            raise ValueError(f"Неизвестный режим checkpoint: {mode}")
+        try:
+            self.commit()
+            busy, log_pages, checkpointed = self.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            if busy:
+                logger.warning(f"Checkpoint WAL ({mode}) не завершен: БД занята, "
+                               f"перенесено {checkpointed}/{log_pages} страниц")
+            return busy, log_pages, checkpointed
         except Exception as e:
-            logger.error(f"Ошибка создания резервной копии для {username}: {str(e)}")
+            logger.error(f"Ошибка checkpoint WAL: {str(e)}")
             return None
 
-    def create_full_backup(self, reason="manual"):
-        """Создает полную резервную копию базы данных"""
+    def incremental_vacuum(self, pages=0):
+        """Возвращает свободные страницы файлу. Возвращает число освобожденных страниц"""
         try:
-            self.backup_dir.mkdir(parents=True, exist_ok=True)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_file = self.backup_dir / f"full_backup_{timestamp}.db"
-
-            # Копируем файл базы данных
-            shutil.copy2(self.db_path, backup_file)
-
-            # Создаем JSON backup
-            json_file = self.backup_dir / f"full_backup_{timestamp}.json"
-
-            backup_data = {
-                "backup_time": datetime.now().isoformat(),
-                "backup_reason": reason,
-                "database_file": str(backup_file),
-                "summary": {
-                    "total_users": self.get_user_count(),
-                    "total_admins": len(self.get_all_admins())
-                }
-            }
-
-            with open(json_file, 'w', encoding='utf-8') as f:
-                json.dump(backup_data, f, ensure_ascii=False, indent=2, default=str)
-
-            # Очищаем старые бэкапы
-            self.cleanup_old_backups()
+            freelist_before, _, auto_vacuum = self.get_freelist_info()
+            if auto_vacuum != 2 or freelist_before == 0:
+                return 0
 
-            logger.info(f"Создана полная резервная копия: {backup_file}")
-            return str(backup_file)
+            # executescript прогоняет PRAGMA до конца: обычный execute освобождает одну страницу за шаг
+            if pages and pages > 0:
+                self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            else:
+                self.conn.executescript("PRAGMA incremental_vacuum;")
 
+            freelist_after, _, _ = self.get_freelist_info()
+            return max(0, freelist_before - freelist_after)
         except Exception as e:
-            logger.error(f"Ошибка создания полной резервной копии: {str(e)}")
-            return None
+            logger.error(f"Ошибка incremental vacuum: {str(e)}")
+            return 0
 
-    def cleanup_old_backups(self):
-        """Удаляет старые резервные копии"""
+    def enable_incremental_vacuum(self):
+        """Переводит существующую БД в режим auto_vacuum=INCREMENTAL (полный VACUUM, один раз).
+        Вызывается при запуске до старта монитора: VACUUM переписывает весь файл"""
         try:
-            cutoff_date = datetime.now() - timedelta(days=Config.BACKUP_RETENTION_DAYS)
+            _, _, auto_vacuum = self.get_freelist_info()
+            if auto_vacuum == 2:
+                return True
 
-            for backup_file in self.backup_dir.glob("*"):
-                if backup_file.is_file():
-                    file_time = datetime.fromtimestamp(backup_file.stat().st_mtime)
-                    if file_time < cutoff_date:
-                        backup_file.unlink()
-                        logger.info(f"Удален старый бэкап: {backup_file.name}")
+            # VACUUM пишет полную копию БД рядом с ней
+            db_size = self.get_database_files_size()["total"]
+            free_space = shutil.disk_usage(Path(self.db_path).parent).free
+            if free_space < db_size * 2:
+                logger.warning(f"Недостаточно места для перевода БД в режим incremental vacuum: "
+                               f"свободно {free_space} байт, нужно {db_size * 2}")
+                return False
 
+            logger.info(f"Перевод БД в режим auto_vacuum=INCREMENTAL ({db_size} байт)...")
+            self.commit()
+            self.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.execute("VACUUM")
+            logger.info("БД переведена в режим auto_vacuum=INCREMENTAL")
             return True
         except Exception as e:
-            logger.error(f"Ошибка очистки старых бэкапов: {str(e)}")
+            logger.error(f"Ошибка перевода БД в режим incremental vacuum: {str(e)}")
             return False
 
-    def get_database_size(self):
-        """Возвращает размер базы данных в байтах"""
+    def run_maintenance(self, vacuum_pages=None):
+        """Checkpoint WAL + incremental vacuum. Возвращает словарь с результатами"""
+        if vacuum_pages is None:
+            vacuum_pages = Config.INCREMENTAL_VACUUM_PAGES
+
+        start_time = time.time()
+        size_before = self.get_database_files_size()
+
+        freed_pages = self.incremental_vacuum(vacuum_pages)
+        checkpoint = self.checkpoint_wal("TRUNCATE")
+        size_after = self.get_database_files_size()
+        freelist, page_size, _ = self.get_freelist_info()
+
+        self.maintenance_requested = False
+
+        result = {
+            "time": datetime.now().isoformat(),
+            "duration": time.time() - start_time,
+            "checkpoint_ok": checkpoint is not None and not checkpoint[0],
+            "freed_pages": freed_pages,
+            "freed_bytes": freed_pages * page_size,
+            "free_pages_left": freelist,
+            "size_before": size_before,
+            "size_after": size_after
+        }
+
+        logger.info(f"Обслуживание БД за {result['duration']:.2f} сек: "
+                    f"размер {size_before['total']} -> {size_after['total']} байт, "
+                    f"WAL {size_before['wal']} -> {size_after['wal']} байт, "
+                    f"освобождено страниц: {freed_pages}")
+        return result
+
+    # ========== ПОЛИТИКА ХРАНЕНИЯ ИСТОРИИ ==========
+
+    def compact_user_stats(self, cutoff_date, batch_size):
+        """Сжимает одну пачку старых строк user_stats в дневные агрегаты. Возвращает число строк"""
+        cursor = self.execute('''SELECT * FROM user_stats
+                              WHERE connection_start < ?
+                                AND (status != 'active'
+                                     OR COALESCE(session_id, '') NOT IN (SELECT session_hash FROM active_sessions))
+                              ORDER BY id LIMIT ?''',
+                              (cutoff_date, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        columns = [description[0] for description in cursor.description]
+        col = {name: i for i, name in enumerate(columns)}
+
+        daily = self._daily_aggregates(rows, col)
+
+        # Архив пишется и синхронизируется до удаления: при сбое строки останутся в БД
+        archive_batch = self._archive_rows('user_stats', columns, rows, col['connection_start'])
+
         try:
-            return self.db_path.stat().st_size
-        except Exception as e:
-            logger.error(f"Ошибка получения размера БД: {str(e)}")
+            for (username, stat_date), (count, duration, sent, received) in daily.items():
+                self.execute('''INSERT INTO user_stats_daily
+                             (username, stat_date, sessions_count, duration_seconds, bytes_sent, bytes_received)
+                             VALUES (?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(username, stat_date) DO UPDATE SET
+                                 sessions_count = sessions_count + excluded.sessions_count,
+                                 duration_seconds = duration_seconds + excluded.duration_seconds,
+                                 bytes_sent = bytes_sent + excluded.bytes_sent,
+                                 bytes_received = bytes_received + excluded.bytes_received''',
+                             (username, stat_date, count, duration, sent, received))
+
+            ids = [row[col['id']] for row in rows]
+            self.execute(f"DELETE FROM user_stats WHERE id IN ({','.join(['?'] * len(ids))})", ids)
+            self.set_monitor_state('archive_user_stats', archive_batch, commit=False)
+            self.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        return len(rows)
+
+    def prune_session_backup(self, cutoff_date, batch_size):
+        """Архивирует и удаляет одну пачку старых строк session_backup. Возвращает число строк"""
+        cursor = self.execute("SELECT * FROM session_backup WHERE end_time < ? ORDER BY id LIMIT ?",
+                              (cutoff_date, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
             return 0
+        columns = [description[0] for description in cursor.description]
+        id_index = columns.index('id')
+
+        archive_batch = self._archive_rows('session_backup', columns, rows, columns.index('end_time'))
 
-    def get_backup_info(self):
-        """Возвращает информацию о резервных копиях"""
         try:
-            backups = []
-            db_backups = []
-            total_size = 0
-            db_total_size = 0
-
-            def _display_time(file_path):
-                # Для full_backup_YYYYMMDD_HHMMSS.* берем время из имени файла,
-                # потому что mtime может быть одинаковым при copy2/WAL.
-                match = re.match(r"^full_backup_(\d{8})_(\d{6})\.(db|json)$", file_path.name)
-                if match:
-                    try:
-                        return datetime.strptime(
-                            f"{match.group(1)}_{match.group(2)}",
-                            "%Y%m%d_%H%M%S"
-                        )
-                    except Exception:
-                        pass
-                return datetime.fromtimestamp(file_path.stat().st_mtime)
-
-            for backup_file in sorted(self.backup_dir.glob("*"), key=_display_time, reverse=True):
-                if backup_file.is_file():
-                    display_dt = _display_time(backup_file)
-                    file_info = {
-                        "name": backup_file.name,
-                        "size": backup_file.stat().st_size,
-                        "modified": display_dt.isoformat(),
-                        "path": str(backup_file)
-                    }
-                    backups.append(file_info)
-                    total_size += file_info["size"]
-                    if backup_file.suffix == ".db":
-                        db_backups.append(file_info)
-                        db_total_size += file_info["size"]
+            ids = [row[id_index] for row in rows]
+            self.execute(f"DELETE FROM session_backup WHERE id IN ({','.join(['?'] * len(ids))})", ids)
+            self.set_monitor_state('archive_session_backup', archive_batch, commit=False)
+            self.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
 
-            return {
-                "total_backups": len(backups),
-                "total_size": total_size,
-                "total_db_backups": len(db_backups),
-                "db_total_size": db_total_size,
-                # Оставляем общие файлы для совместимости
-                "backups": backups[:10],
-                # Отдельно список реальных бэкапов БД
-                "db_backups": db_backups[:10]
-            }
-        except Exception as e:
-            logger.error(f"Ошибка получения информации о бэкапах: {str(e)}")
-            return {
-                "total_backups": 0,
-                "total_size": 0,
-                "total_db_backups": 0,
-                "db_total_size": 0,
-                "backups": [],
-                "db_backups": []
-            }
+        return len(rows)
 
     def reset_all_traffic(self):
         """Обнуляет всю статистику трафика"""
@@ -774,6 +1411,7 @@ class Database:
             # Очищаем таблицы
             self.execute("DELETE FROM traffic_log")
             self.execute("DELETE FROM user_stats")
+            self.execute("DELETE FROM user_stats_daily")
 
             # Завершаем активные сессии
             cursor = self.execute("SELECT username, connection_id, session_hash FROM active_sessions")
@@ -781,6 +1419,9 @@ class Database:
                 self.finalize_session(username, connection_id, session_hash, "reset_traffic")
 
             self.commit()
+            self.maintenance_requested = True
+            self.quota_version += 1
+            self.users_version += 1
             logger.warning("Вся статистика трафика обнулена")
             return True
 
@@ -807,6 +1448,7 @@ class Database:
             # Удаляем статистику пользователя
             self.execute("DELETE FROM traffic_log WHERE username = ?", (username,))
             self.execute("DELETE FROM user_stats WHERE username = ?", (username,))
+            self.execute("DELETE FROM user_stats_daily WHERE username = ?", (username,))
 
             # Завершаем активные сессии пользователя
             cursor = self.execute("SELECT connection_id, session_hash FROM active_sessions WHERE username = ?",
@@ -815,6 +1457,9 @@ class Database:
                 self.finalize_session(username, connection_id, session_hash, "reset_user_traffic")
 
             self.commit()
+            self.maintenance_requested = True
+            self.quota_version += 1
+            self.users_version += 1
             logger.warning(f"Статистика трафика пользователя {username} обнулена")
             return True
 
@@ -823,5 +1468,9 @@ class Database:
             return False
 
 
-# Глобальный экземпляр БД
-db = Database()
+# Глобальный экземпляр БД: SQLite или PostgreSQL (STORAGE_BACKEND)
+if Config.STORAGE_BACKEND == 'postgres':
+    from postgres_storage import PostgresStorage
+    db = PostgresStorage()
+else:
+    db = Database()
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from database import db
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseMaintenance:
+    """Планировщик обслуживания БД в окнах простоя: политика хранения, checkpoint WAL, incremental vacuum"""
+
+    def __init__(self):
+        self.interval = Config.DB_MAINTENANCE_INTERVAL
+        self.min_idle = Config.DB_MAINTENANCE_MIN_IDLE
+        self.wal_threshold = Config.WAL_CHECKPOINT_THRESHOLD
+        self.retention_interval = Config.RETENTION_INTERVAL
+        self.last_retention = 0
+        self.retention_pending = False
+        self.last_retention_result = None
+        self.last_run = 0
+        self.last_result = None
+        self.runs_count = 0
+        self.wal_peak_size = 0
+        self.wal_last_size = 0
+        self.lock = threading.Lock()
+
+    def track_wal_size(self):
+        """Запоминает текущий и пиковый размер WAL"""
+        wal_size = db.get_database_files_size()["wal"]
+        self.wal_last_size = wal_size
+        self.wal_peak_size = max(self.wal_peak_size, wal_size)
+        return wal_size
+
+    def is_retention_due(self):
+        """Проверяет, нужно ли применять политику хранения"""
+        return self.retention_pending or time.time() - self.last_retention >= self.retention_interval
+
+    def is_due(self):
+        """Проверяет, нужно ли обслуживание прямо сейчас"""
+        if db.maintenance_requested:
+            return True
+        if time.time() - self.last_run >= self.interval:
+            return True
+        return self.wal_last_size >= self.wal_threshold
+
+    def maybe_run(self, idle_seconds):
+        """Запускает обслуживание, если оно назрело и до следующего тика есть время"""
+        try:
+            self.track_wal_size()
+
+            if idle_seconds < self.min_idle:
+                return None
+
+            if self.is_retention_due():
+                self.run_retention()
+
+            if not self.is_due():
+                return None
+
+            return self.run()
+        except Exception as e:
+            logger.error(f"Ошибка планировщика обслуживания БД: {str(e)}")
+            return None
+
+    def run(self):
+        """Принудительно выполняет обслуживание БД"""
+        if not self.lock.acquire(blocking=False):
+            logger.info("Обслуживание БД уже выполняется")
+            return None
+
+        try:
+            result = db.run_maintenance()
+            self.last_run = time.time()
+            self.last_result = result
+            self.runs_count += 1
+            self.wal_last_size = result["size_after"]["wal"]
+            return result
+        finally:
+            self.lock.release()
+
+    def run_retention(self):
+        """Применяет политику хранения; незавершенная обработка продолжится в следующем окне"""
+        if not self.lock.acquire(blocking=False):
+            return None
+
+        try:
+            result = db.apply_retention()
+            self.last_retention = time.time()
+            self.retention_pending = result["pending"]
+            self.last_retention_result = result
+            return result
+        finally:
+            self.lock.release()
+
+    def get_status(self):
+        """Возвращает статус обслуживания для /dbstatus"""
+        return {
+            "last_run": datetime.fromtimestamp(self.last_run).isoformat() if self.last_run else None,
+            "next_run_in": max(0, self.interval - (time.time() - self.last_run)) if self.last_run else 0,
+            "runs_count": self.runs_count,
+            "wal_last_size": self.wal_last_size,
+            "wal_peak_size": self.wal_peak_size,
+            "last_result": self.last_result,
+            "last_retention": (datetime.fromtimestamp(self.last_retention).isoformat()
+                               if self.last_retention else None),
+            "retention_pending": self.retention_pending,
+            "last_retention_result": self.last_retention_result
+        }
+
+
+# Глобальный экземпляр планировщика обслуживания
+db_maintenance = DatabaseMaintenance()
@@ -0,0 +1,200 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from metrics import metrics
+from alerts import alerts
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchTask:
+    __slots__ = ('function', 'args', 'kwargs', 'label', 'timeout', 'queued_at')
+
+    def __init__(self, function, args, kwargs, label, timeout):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.label = label
+        self.timeout = timeout
+        self.queued_at = time.time()
+
+
+class UpdateDispatcher:
+    """Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+    Обновления одного чата выполняются строго по очереди (на этом держатся
+    многошаговые диалоги user_states и next_step), разные чаты - параллельно,
+    но не более BOT_WORKERS одновременно. Обработчик дольше своего таймаута
+    не прерывается (в Python это невозможно), но перестает держать очередь
+    чата и слот пула: вместо него запускается новый поток.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()  # ключи чатов, чья очередная задача готова к запуску
+        self.chats = {}  # {chat_key: deque(DispatchTask)}
+        self.running = {}  # {chat_key: (start, DispatchTask, worker_token)}
+        self.target_workers = 0
+        self.alive_workers = 0
+        self.worker_seq = 0
+        self.depth = 0
+        self.timeouts_count = 0
+
+    def install(self, bot):
+        """Подменяет bot._exec_task: обработчики идут через пул диспетчера"""
+        if self.bot is not None:
+            return
+
+        self.bot = bot
+        self.target_workers = max(1, Config.BOT_WORKERS)
+        bot._exec_task = self.submit
+
+        for _ in range(self.target_workers):
+            self._start_worker()
+
+        threading.Thread(target=self._watchdog, daemon=True, name="DispatchWatchdog").start()
+        logger.info(f"Диспетчер обновлений запущен: {self.target_workers} потоков, "
+                    f"таймаут обработчика {Config.DISPATCH_HANDLER_TIMEOUT} сек")
+
+    @staticmethod
+    def _get_chat_key(args):
+        """Ключ упорядочивания: чат сообщения или callback-запроса"""
+        update = args[0] if args else None
+        chat = getattr(update, 'chat', None)
+        if chat is not None:
+            return chat.id
+        message = getattr(update, 'message', None)
+        if message is not None and getattr(message, 'chat', None) is not None:
+            return message.chat.id
+        from_user = getattr(update, 'from_user', None)
+        if from_user is not None:
+            return from_user.id
+        return None
+
+    @staticmethod
+    def _get_label(args):
+        """Команда или тип обновления - для таймаутов и логов"""
+        update = args[0] if args else None
+        text = getattr(update, 'text', None)
+        if text and text.startswith('/'):
+            return text.split()[0].split('@')[0]
+        if getattr(update, 'data', None) is not None:
+            return 'callback'
+        return 'message'
+
+    def submit(self, function, *args, **kwargs):
+        label = self._get_label(args)
+        timeout = Config.DISPATCH_HANDLER_TIMEOUTS.get(label, Config.DISPATCH_HANDLER_TIMEOUT)
+        task = DispatchTask(function, args, kwargs, label, timeout)
+
+        key = self._get_chat_key(args)
+        if key is None:
+            key = object()  # без чата - без упорядочивания
+
+        with self.lock:
+            jobs = self.chats.get(key)
+            if jobs is None:
+                jobs = self.chats[key] = deque()
+            jobs.append(task)
+            self.depth += 1
+            metrics.set('vpnbot_dispatch_queue_depth', self.depth)
+            # Чат без выполняющейся задачи сразу становится готовым
+            schedule = len(jobs) == 1 and key not in self.running
+
+        if schedule:
+            self.ready.put(key)
+
+    def _start_worker(self):
+        with self.lock:
+            self.worker_seq += 1
+            self.alive_workers += 1
+            name = f"Dispatch-{self.worker_seq}"
+        threading.Thread(target=self._worker, daemon=True, name=name).start()
+
+    def _worker(self):
+        while True:
+            key = self.ready.get()
+            token = object()
+
+            with self.lock:
+                jobs = self.chats.get(key)
+                if not jobs:
+                    continue
+                task = jobs.popleft()
+                self.depth -= 1
+                metrics.set('vpnbot_dispatch_queue_depth', self.depth)
+                self.running[key] = (time.time(), task, token)
+
+            metrics.observe('vpnbot_dispatch_wait_seconds', time.time() - task.queued_at)
+            try:
+                task.function(*task.args, **task.kwargs)
+            except Exception as e:
+                self._handle_exception(task, e)
+
+            with self.lock:
+                current = self.running.get(key)
+                timed_out = current is None or current[2] is not token
+                if not timed_out:
+                    del self.running[key]
+                    self._release(key)
+
+                if timed_out and self.alive_workers > self.target_workers:
+                    # Вместо этого потока уже работает замена - выходим
+                    self.alive_workers -= 1
+                    return
+
+    def _release(self, key):
+        """Передает чат следующей задаче (вызывается под self.lock)"""
+        jobs = self.chats.get(key)
+        if jobs:
+            self.ready.put(key)
+        elif jobs is not None:
+            del self.chats[key]
+
+    def _handle_exception(self, task, error):
+        handled = False
+        try:
+            handled = self.bot._handle_exception(error)
+        except Exception:
+            pass
+        if not handled:
+            logger.error(f"Ошибка обработчика {task.label}: {str(error)}")
+
+    def _watchdog(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            expired = []
+
+            with self.lock:
+                for key, (start, task, token) in list(self.running.items()):
+                    if now - start > task.timeout:
+                        del self.running[key]
+                        self._release(key)
+                        self.timeouts_count += 1
+                        expired.append((task, now - start))
+
+            for task, duration in expired:
+                metrics.inc('vpnbot_handler_timeouts_total', handler=task.label)
+                logger.warning(f"Обработчик {task.label} выполняется {duration:.0f} сек (таймаут {task.timeout}), "
+                               f"чат освобожден для следующих обновлений")
+                alerts.raise_alert(f"handler_timeout:{task.label}",
+                                   f"Обработчик {task.label} завис дольше {task.timeout} сек", event=True)
+                self._start_worker()
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "workers": self.alive_workers,
+                "running": len(self.running),
+                "queued": self.depth,
+                "timeouts": self.timeouts_count
+            }
+
+
+# Глобальный диспетчер обновлений
+dispatcher = UpdateDispatcher()
@@ -0,0 +1,522 @@
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+from urllib.parse import quote, unquote
+import fleet_protocol
+from metrics import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+NODE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+def fleet_request(url, method='GET', payload=None, timeout=None, raw=False, data=None, content_type='application/json'):
+    """Запрос к агенту или агрегатору с токеном флота: dict из JSON или (bytes, заголовки) при raw.
+
+    data - готовое тело (например, кадр fleet_protocol) вместо JSON из payload.
+    """
+    if data is None and payload is not None:
+        data = json.dumps(payload).encode('utf-8')
+    http_request = urllib_request.Request(url, data=data, method=method, headers={
+        'Authorization': f"Bearer {Config.FLEET_TOKEN}",
+        'Content-Type': content_type
+    })
+    with urllib_request.urlopen(http_request, timeout=timeout or Config.FLEET_REQUEST_TIMEOUT) as response:
+        body = response.read()
+        if raw:
+            return body, response.headers
+        return json.loads(body or b'{}')
+
+
+class FleetServer(ThreadingHTTPServer):
+    """HTTP-сервер флота; запросы передаются в handle() агента или агрегатора"""
+
+    daemon_threads = True
+
+    def __init__(self, host, port, fleet):
+        self.fleet = fleet
+        super().__init__((host, port), FleetRequestHandler)
+
+
+class FleetRequestHandler(BaseHTTPRequestHandler):
+    def _dispatch(self, method):
+        expected = f"Bearer {Config.FLEET_TOKEN}".encode('utf-8')
+        received = self.headers.get('Authorization', '').encode('utf-8')
+        if not Config.FLEET_TOKEN or not hmac.compare_digest(received, expected):
+            self.send_error(401)
+            return
+
+        parts = [unquote(part) for part in self.path.split('?')[0].strip('/').split('/')]
+        if len(parts) < 2 or parts[0] != 'fleet':
+            self.send_error(404)
+            return
+
+        binary = self.headers.get('Content-Type') == fleet_protocol.CONTENT_TYPE
+        if binary and parts != ['fleet', 'push']:
+            self.send_error(415)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > Config.FLEET_MAX_BODY:
+                self.send_error(413)
+                return
+            body = self.rfile.read(length)
+            if binary:
+                payload = fleet_protocol.decode_push(body)
+            else:
+                payload = json.loads(body) if length else {}
+        except ValueError as e:
+            logger.warning(f"Неверный запрос флота {method} {self.path}: {str(e)}")
+            self.send_error(400)
+            return
+
+        try:
+            result = self.server.fleet.handle(method, parts[1:], payload)
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса флота {method} {self.path}: {str(e)}")
+            self.send_error(500)
+            return
+
+        if result is None:
+            self.send_error(404)
+        elif binary:
+            body = fleet_protocol.encode_ack(result['acked_seq'])
+            self.send_response(200)
+            self.send_header('Content-Type', fleet_protocol.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif isinstance(result, tuple):
+            # (содержимое файла, имя файла)
+            body, filename = result
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Filename', filename)
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            body = json.dumps(result).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        logger.debug(f"fleet: {format % args}")
+
+
+def start_fleet_server(fleet, name):
+    try:
+        server = FleetServer(Config.FLEET_LISTEN_HOST, Config.FLEET_LISTEN_PORT, fleet)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер флота: {str(e)}")
+        return None
+
+    threading.Thread(target=server.serve_forever, daemon=True, name=name).start()
+    logger.info(f"Сервер флота ({Config.FLEET_ROLE}) слушает {Config.FLEET_LISTEN_HOST}:{Config.FLEET_LISTEN_PORT}")
+    return server
+
+
+class FleetAgent:
+    """Агент узла VPN: копит дельты тиков монитора и пачками отправляет их агрегатору.
+
+    Каждый тик несет seq журнала трафика; агрегатор отвечает последним учтенным seq,
+    и только после этого тики уходят из очереди. Повторная отправка безопасна -
+    агрегатор пропускает уже учтенные seq. Команды агрегатора (создание, удаление,
+    отключение пользователей, выдача профилей) выполняются локальным vpn_manager.
+    """
+
+    def __init__(self):
+        self.outbox = deque()  # [seq, ts, [(username, connection_id, sent_diff, received_diff)]]
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.server = None
+        self.protocol = Config.FLEET_PROTOCOL
+        self.protocol_checked = self.protocol != 'binary'
+        self.acked_seq = 0
+        self.last_push = None
+        self.push_errors = 0
+        self.epoch = None
+
+    def on_tick(self, seq, ts, traffic_data, deltas):
+        """Получатель тиков монитора (traffic_monitor.set_tick_listener)"""
+        with self.lock:
+            self.sessions = traffic_data
+            self.outbox.append([seq, ts, list(deltas)])
+            while len(self.outbox) > Config.FLEET_OUTBOX_LIMIT:
+                self._merge_oldest()
+
+    def _merge_oldest(self):
+        """Склеивает два самых старых тика в один с seq второго (агрегатор недоступен долго)"""
+        first = self.outbox.popleft()
+        second = self.outbox.popleft()
+        merged = {}
+        for username, connection_id, sent_diff, received_diff in first[2] + second[2]:
+            totals = merged.setdefault((username, connection_id), [0, 0])
+            totals[0] += sent_diff
+            totals[1] += received_diff
+        self.outbox.appendleft([second[0], second[1],
+                                [(key[0], key[1], sent, received) for key, (sent, received) in merged.items()]])
+
+    @staticmethod
+    def load_epoch():
+        """Идентификатор БД узла: seq журнала живет в той же БД и начинается заново вместе с ней"""
+        from database import db
+
+        epoch = db.get_monitor_state('fleet_epoch')
+        if not epoch:
+            epoch = uuid.uuid4().hex
+            db.set_monitor_state('fleet_epoch', epoch)
+        return epoch
+
+    def negotiate_protocol(self):
+        """Двоичный протокол - только если агрегатор его объявляет в /fleet/status (protocols).
+        Агрегатор старой версии поля не знает, с ним отправка идет в JSON"""
+        status = fleet_request(f"{Config.FLEET_AGGREGATOR_URL}/fleet/status")
+        if 'binary' not in status.get('protocols', []):
+            logger.warning("Агрегатор не принимает двоичный протокол, отправка в JSON")
+            self.protocol = 'json'
+        self.protocol_checked = True
+
+    def push(self):
+        """Отправляет очередь тиков и текущие сессии агрегатору; True при подтверждении"""
+        from database import db
+
+        if self.epoch is None:
+            self.epoch = self.load_epoch()
+
+        with self.lock:
+            ticks = list(self.outbox)
+            sessions = [(username, data['connection_id'], data['client_ip'], data['absolute_sent'],
+                         data['absolute_received']) for username, data in self.sessions.items()]
+
+        payload = {
+            'node': Config.FLEET_NODE_ID,
+            'url': Config.FLEET_ADVERTISE_URL or f"http://{Config.FLEET_LISTEN_HOST}:{Config.FLEET_LISTEN_PORT}",
+            'epoch': self.epoch,
+            'ticks': ticks,
+            'sessions': sessions,
+            'users': db.get_user_count()
+        }
+
+        url = f"{Config.FLEET_AGGREGATOR_URL}/fleet/push"
+        try:
+            if not self.protocol_checked:
+                self.negotiate_protocol()
+            with metrics.timer('vpnbot_fleet_push_seconds'):
+                if self.protocol == 'binary':
+                    data = fleet_protocol.encode_push(payload)
+                    body, headers = fleet_request(url, 'POST', raw=True, data=data,
+                                                  content_type=fleet_protocol.CONTENT_TYPE)
+                    acked_seq = fleet_protocol.decode_ack(body)
+                else:
+                    data = json.dumps(payload).encode('utf-8')
+                    acked_seq = int(fleet_request(url, 'POST', data=data)['acked_seq'])
+            metrics.inc('vpnbot_fleet_push_bytes_total', len(data), protocol=self.protocol)
+        except Exception as e:
+            if isinstance(e, HTTPError) and e.code in (400, 415, 500) and self.protocol == 'binary':
+                # Агрегатор мог смениться на старую версию: перед следующей отправкой спросим заново
+                self.protocol_checked = False
+            self.push_errors += 1
+            metrics.inc('vpnbot_fleet_push_errors_total')
+            logger.warning(f"Не удалось отправить данные агрегатору ({len(ticks)} тиков в очереди): {str(e)}")
+            return False
+
+        with self.lock:
+            while self.outbox and self.outbox[0][0] <= acked_seq:
+                self.outbox.popleft()
+        self.acked_seq = acked_seq
+        self.last_push = time.time()
+        self.push_errors = 0
+        return True
+
+    def _push_loop(self):
+        while True:
+            self.wakeup.wait(Config.FLEET_PUSH_INTERVAL)
+            self.wakeup.clear()
+            self.push()
+
+    def handle(self, method, parts, payload):
+        """Команды агрегатора: users, users/<имя>/revoke|disconnect, profiles/<имя>/<тип>, status"""
+        from database import db
+        from vpn_manager import vpn_manager
+
+        if method == 'POST' and parts == ['users']:
+            username = payload.get('username', '')
+            success, message = vpn_manager.create_user(username)
+            if success:
+                db.add_user(username, Config.SUPER_ADMIN_ID, payload.get('created_by_username') or "Агрегатор")
+            return {'ok': success, 'message': message}
+
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'users':
+            if parts[2] == 'revoke':
+                success, message = vpn_manager.revoke_user(parts[1])
+            elif parts[2] == 'disconnect':
+                success, message = vpn_manager.disconnect_user(parts[1], payload.get('connection_id'))
+            else:
+                return None
+            return {'ok': success, 'message': message}
+
+        if method == 'DELETE' and len(parts) == 2 and parts[0] == 'users':
+            success, message = vpn_manager.delete_user(parts[1])
+            if success:
+                db.delete_user(parts[1])
+            return {'ok': success, 'message': message}
+
+        if method == 'GET' and len(parts) == 3 and parts[0] == 'profiles':
+            file_path = vpn_manager.get_profile_path(parts[1], parts[2])
+            if not file_path:
+                return None
+            with open(file_path, 'rb') as f:
+                return f.read(), os.path.basename(file_path)
+
+        if method == 'GET' and parts == ['status']:
+            with self.lock:
+                return {'node': Config.FLEET_NODE_ID, 'outbox': len(self.outbox), 'sessions': len(self.sessions),
+                        'acked_seq': self.acked_seq, 'users': db.get_user_count(), 'protocol': self.protocol}
+
+        return None
+
+    def start(self):
+        """Подключает агента к монитору и запускает сервер команд и отправку"""
+        from traffic_monitor import traffic_monitor
+
+        if not Config.FLEET_TOKEN or not Config.FLEET_AGGREGATOR_URL:
+            raise ValueError("Для агента нужны FLEET_TOKEN и FLEET_AGGREGATOR_URL")
+
+        traffic_monitor.set_tick_listener(self.on_tick)
+        self.server = start_fleet_server(self, "FleetAgentServer")
+        threading.Thread(target=self._push_loop, daemon=True, name="FleetAgentPush").start()
+        logger.info(f"Агент флота {Config.FLEET_NODE_ID} отправляет данные на {Config.FLEET_AGGREGATOR_URL}")
+
+
+class FleetAggregator:
+    """Агрегатор: принимает дельты и снимки сессий от агентов и ведет общую БД.
+
+    Трафик узлов попадает в те же таблицы, что и в одиночном режиме, поэтому
+    списки, отчеты и графики бота работают по всему флоту. Последние снимки
+    сессий узлов подменяют ipsec для /stats, /activestats, /toptalkers и /dashboard.
+    """
+
+    def __init__(self):
+        self.nodes = {}  # {node_id: {'url', 'sessions', 'pushed_at', 'users'}}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def handle(self, method, parts, payload):
+        if method == 'POST' and parts == ['push']:
+            acked_seq = self.receive(payload)
+            if acked_seq is None:
+                raise RuntimeError("данные узла не записаны в БД")
+            return {'acked_seq': acked_seq}
+        if method == 'GET' and parts == ['status']:
+            return {'protocols': ['json', 'binary'],
+                    'nodes': [{key: value for key, value in node.items() if key != 'sessions'}
+                              for node in self.get_nodes()]}
+        return None
+
+    def receive(self, payload):
+        """Применяет отправку агента; возвращает последний учтенный seq узла"""
+        from database import db
+        from traffic_monitor import traffic_monitor
+
+        node_id = payload.get('node', '')
+        if not NODE_ID_PATTERN.match(node_id):
+            raise ValueError(f"недопустимый идентификатор узла: {node_id!r}")
+
+        ticks = [(int(seq), float(ts), [(username, str(connection_id), int(sent), int(received))
+                                        for username, connection_id, sent, received in deltas])
+                 for seq, ts, deltas in payload.get('ticks', [])]
+        sessions = {
+            username: {'connection_id': str(connection_id), 'client_ip': client_ip,
+                       'absolute_sent': int(absolute_sent), 'absolute_received': int(absolute_received),
+                       'node': node_id}
+            for username, connection_id, client_ip, absolute_sent, absolute_received in payload.get('sessions', [])
+        }
+
+        now = time.time()
+        with self.lock:
+            acked_seq = db.apply_fleet_push(node_id, payload.get('url', ''), ticks, list(sessions),
+                                            int(payload.get('users', 0)), payload.get('epoch') or None)
+            if acked_seq is None:
+                return None
+
+            previous = self.nodes.get(node_id, {}).get('sessions', {})
+            self.nodes[node_id] = {'url': payload.get('url', ''), 'sessions': sessions, 'pushed_at': now,
+                                   'users': int(payload.get('users', 0))}
+
+            # Скорости считаются по снимкам каждого узла отдельно
+            traffic_monitor.rates.record(sessions, now, scope=set(previous) | set(sessions))
+            traffic_monitor.last_sessions = self.get_sessions()
+            traffic_monitor.last_sessions_time = now
+
+        metrics.inc('vpnbot_fleet_pushes_total', node=node_id)
+        metrics.inc('vpnbot_fleet_ticks_total', sum(1 for tick in ticks if tick[0] <= acked_seq), node=node_id)
+        return acked_seq
+
+    def get_sessions(self):
+        """Сессии всех узлов, выходивших на связь в пределах FLEET_NODE_TIMEOUT"""
+        now = time.time()
+        sessions = {}
+        for node in list(self.nodes.values()):
+            if now - node['pushed_at'] <= Config.FLEET_NODE_TIMEOUT:
+                sessions.update(node['sessions'])
+        return sessions
+
+    def get_nodes(self):
+        """Узлы из БД с состоянием из памяти: [{node_id, url, online, users, sessions, last_seq, pushed_at}]"""
+        from database import db
+
+        now = time.time()
+        result = []
+        for node_id, url, last_seq, users_count, last_push in db.get_fleet_nodes():
+            node = self.nodes.get(node_id, {})
+            pushed_at = node.get('pushed_at')
+            result.append({
+                'node_id': node_id,
+                'url': node.get('url') or url,
+                'online': pushed_at is not None and now - pushed_at <= Config.FLEET_NODE_TIMEOUT,
+                'users': node.get('users', users_count),
+                'sessions': node.get('sessions', {}),
+                'last_seq': last_seq,
+                'pushed_at': pushed_at,
+                'last_push': last_push
+            })
+        return result
+
+    def start(self):
+        if not Config.FLEET_TOKEN:
+            raise ValueError("Для агрегатора нужен FLEET_TOKEN")
+        self.server = start_fleet_server(self, "FleetAggregatorServer")
+
+
+class FleetVPNManager:
+    """vpn_manager агрегатора: те же методы, что у VPNManager, но выполняются на узлах.
+
+    Новый пользователь создается на доступном узле с наименьшим числом пользователей,
+    остальные команды уходят на узел, где пользователь размещен.
+    """
+
+    def _node_url(self, username):
+        from database import db
+
+        node_id = db.get_user_node(username)
+        if node_id is None:
+            return None, None
+        for node in aggregator.get_nodes():
+            if node['node_id'] == node_id:
+                return node_id, node['url']
+        return node_id, None
+
+    def _node_command(self, username, method, path, payload=None, timeout=None):
+        node_id, url = self._node_url(username)
+        if url is None:
+            return False, f"Узел пользователя {username} неизвестен" if node_id is None else f"Узел {node_id} недоступен"
+        try:
+            result = fleet_request(f"{url}/fleet/{path}", method, payload, timeout)
+            return bool(result.get('ok')), result.get('message', '')
+        except Exception as e:
+            logger.error(f"Ошибка команды узлу {node_id}: {str(e)}")
+            return False, f"Узел {node_id} не ответил: {str(e)}"
+
+    def pick_node(self):
+        """Доступный узел с наименьшим числом пользователей или None"""
+        from database import db
+
+        placed = db.get_node_user_counts()
+        online = [node for node in aggregator.get_nodes() if node['online']]
+        if not online:
+            return None
+        node = min(online, key=lambda item: (max(item['users'], placed.get(item['node_id'], 0)), item['node_id']))
+        return node
+
+    def create_user(self, username):
+        from database import db
+
+        node = self.pick_node()
+        if node is None:
+            return False, "Нет доступных узлов VPN"
+
+        try:
+            result = fleet_request(f"{node['url']}/fleet/users", 'POST', {'username': username},
+                                   Config.FLEET_CREATE_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Ошибка создания {username} на узле {node['node_id']}: {str(e)}")
+            return False, f"Узел {node['node_id']} не ответил: {str(e)}"
+
+        if not result.get('ok'):
+            return False, result.get('message', '')
+
+        db.set_user_node(username, node['node_id'])
+        with aggregator.lock:
+            # Следующее создание до отправки узла должно видеть этого пользователя
+            if node['node_id'] in aggregator.nodes:
+                aggregator.nodes[node['node_id']]['users'] += 1
+        logger.info(f"Пользователь {username} создан на узле {node['node_id']}")
+        return True, f"{result.get('message', '')} (узел {node['node_id']})"
+
+    def revoke_user(self, username):
+        return self._node_command(username, 'POST', f"users/{quote(username)}/revoke")
+
+    def disconnect_user(self, username, connection_id=None):
+        return self._node_command(username, 'POST', f"users/{quote(username)}/disconnect",
+                                  {'connection_id': connection_id})
+
+    def delete_user(self, username):
+        from database import db
+
+        success, message = self._node_command(username, 'DELETE', f"users/{quote(username)}",
+                                              timeout=Config.FLEET_CREATE_TIMEOUT)
+        if success:
+            db.delete_user_node(username)
+            for file_path in Config.FLEET_PROFILES_DIR.glob(f"{username}.*"):
+                file_path.unlink()
+        return success, message
+
+    def get_profile_path(self, username, profile_type):
+        """Скачивает профиль с узла пользователя и возвращает локальный путь (или None)"""
+        node_id, url = self._node_url(username)
+        if url is None:
+            return None
+        try:
+            body, headers = fleet_request(f"{url}/fleet/profiles/{quote(username)}/{quote(profile_type)}", raw=True)
+        except HTTPError as e:
+            if e.code != 404:
+                logger.error(f"Ошибка получения профиля {username} с узла {node_id}: {str(e)}")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка получения профиля {username} с узла {node_id}: {str(e)}")
+            return None
+
+        Config.FLEET_PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+        file_path = Config.FLEET_PROFILES_DIR / os.path.basename(headers.get('X-Filename') or f"{username}.{profile_type}")
+        file_path.write_bytes(body)
+        return str(file_path)
+
+
+# Глобальные экземпляры флота (используется тот, что соответствует FLEET_ROLE)
+agent = FleetAgent()
+aggregator = FleetAggregator()
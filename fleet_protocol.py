@@ -0,0 +1,303 @@
+import sys
+import socket
+import struct
+import zlib
+from array import array
+
+# Двоичный протокол агент -> агрегатор. Кадр: заголовок HEADER (магия, версия, тип,
+# длина тела, crc32 тела) и тело. Имена пользователей передаются один раз в словаре
+# кадра, дальше - номером в словаре. Счетчики и заголовки тиков - varint (LEB128);
+# дельты и сессии - столбцами array с шириной по наибольшему значению столбца, чтобы
+# разбор шел в C (array.frombytes), а не побайтово в Python. Повторная отправка того
+# же кадра безопасна: агрегатор пропускает тики с seq не больше уже подтвержденного.
+
+CONTENT_TYPE = 'application/x-vpnbot-fleet'
+MAGIC = b'VF'
+VERSION = 1
+# Версия 2 кадра отправки добавляет epoch узла; кадры версии 1 (без epoch) тоже принимаются
+PUSH_VERSION = 2
+PUSH_VERSIONS = (1, 2)
+HEADER = struct.Struct('!2sBBII')
+TS_BASE = struct.Struct('!d')
+
+FRAME_PUSH = 1
+FRAME_ACK = 2
+
+COLUMN_TYPECODES = ('B', 'H', 'I', 'Q')
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _put_varints(out, values):
+    append = out.append
+    for value in values:
+        while value > 0x7F:
+            append((value & 0x7F) | 0x80)
+            value >>= 7
+        append(value)
+
+
+def _get_varints(data, pos, count):
+    """count значений varint с позиции pos: (список, новая позиция)"""
+    result = []
+    append = result.append
+    for _ in range(count):
+        byte = data[pos]
+        pos += 1
+        if byte < 0x80:
+            append(byte)
+            continue
+        value = byte & 0x7F
+        shift = 7
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+            if shift > 63:
+                raise ValueError("слишком длинный varint")
+        append(value)
+    return result, pos
+
+
+def _put_column(out, values):
+    """Столбец чисел одной ширины: код ширины и array.tobytes (little-endian)"""
+    top = max(values, default=0)
+    typecode = 'B' if top < 1 << 8 else 'H' if top < 1 << 16 else 'I' if top < 1 << 32 else 'Q'
+    column = array(typecode, values)
+    if BIG_ENDIAN:
+        column.byteswap()
+    out.append(ord(typecode))
+    out += column.tobytes()
+
+
+def _get_column(data, pos, count):
+    typecode = chr(data[pos])
+    if typecode not in COLUMN_TYPECODES:
+        raise ValueError(f"неизвестная ширина столбца: {typecode!r}")
+    column = array(typecode)
+    end = pos + 1 + count * column.itemsize
+    if end > len(data):
+        raise ValueError("столбец длиннее остатка кадра")
+    column.frombytes(data[pos + 1:end])
+    if BIG_ENDIAN:
+        column.byteswap()
+    return column.tolist(), end
+
+
+def _put_strings(out, values):
+    # Длины (в символах) столбцом, затем все строки одним блоком UTF-8
+    _put_varints(out, [len(values)])
+    _put_varints(out, [len(value) for value in values])
+    blob = ''.join(values).encode('utf-8')
+    _put_varints(out, [len(blob)])
+    out += blob
+
+
+def _get_strings(data, pos):
+    (count,), pos = _get_varints(data, pos, 1)
+    if count > len(data) - pos:
+        raise ValueError(f"счетчик {count} больше остатка кадра")
+    lengths, pos = _get_varints(data, pos, count)
+    (size,), pos = _get_varints(data, pos, 1)
+    blob = bytes(data[pos:pos + size]).decode('utf-8')
+    if pos + size > len(data) or sum(lengths) != len(blob):
+        raise ValueError("длины строк не сходятся с блоком")
+    pos += size
+    values = []
+    offset = 0
+    for length in lengths:
+        values.append(blob[offset:offset + length])
+        offset += length
+    return values, pos
+
+
+def _put_ids(out, values):
+    # Номера туннелей ipsec - числа: столбец чисел; если хоть один не число - строки
+    values = [str(value) for value in values]
+    try:
+        numbers = [int(value) for value in values]
+        numeric = [str(number) for number in numbers] == values and min(numbers, default=0) >= 0
+    except ValueError:
+        numeric = False
+    if numeric:
+        out.append(1)
+        _put_column(out, numbers)
+    else:
+        out.append(0)
+        _put_strings(out, values)
+
+
+def _get_ids(data, pos, count):
+    if data[pos] == 1:
+        numbers, pos = _get_column(data, pos + 1, count)
+        return [str(number) for number in numbers], pos
+    values, pos = _get_strings(data, pos + 1)
+    if len(values) != count:
+        raise ValueError("число строк не совпадает со счетчиком")
+    return values, pos
+
+
+def _put_ips(out, values):
+    # IPv4 - по 4 байта подряд; если есть IPv6 или "unknown" - строки
+    try:
+        packed = b''.join([socket.inet_aton(value) for value in values])
+        numeric = len(packed) == 4 * len(values)
+    except OSError:
+        numeric = False
+    if numeric:
+        out.append(4)
+        out += packed
+    else:
+        out.append(0)
+        _put_strings(out, values)
+
+
+def _get_ips(data, pos, count):
+    if data[pos] == 4:
+        pos += 1
+        end = pos + 4 * count
+        if end > len(data):
+            raise ValueError("адреса длиннее остатка кадра")
+        packed = bytes(data[pos:end])
+        return [socket.inet_ntoa(packed[offset:offset + 4]) for offset in range(0, len(packed), 4)], end
+    values, pos = _get_strings(data, pos + 1)
+    if len(values) != count:
+        raise ValueError("число строк не совпадает со счетчиком")
+    return values, pos
+
+
+def _frame(frame_type, body, version=VERSION):
+    return HEADER.pack(MAGIC, version, frame_type, len(body), zlib.crc32(body)) + body
+
+
+def _unframe(data, frame_type, versions=(VERSION,)):
+    """Проверяет заголовок кадра и возвращает (тело (memoryview), версия)"""
+    if len(data) < HEADER.size:
+        raise ValueError("кадр короче заголовка")
+    magic, version, received_type, length, checksum = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("не кадр протокола флота")
+    if version not in versions:
+        raise ValueError(f"неподдерживаемая версия протокола: {version}")
+    if received_type != frame_type:
+        raise ValueError(f"ожидался кадр типа {frame_type}, получен {received_type}")
+    body = memoryview(data)[HEADER.size:]
+    if len(body) != length:
+        raise ValueError(f"длина тела {len(body)}, в заголовке {length}")
+    if zlib.crc32(body) != checksum:
+        raise ValueError("неверная контрольная сумма кадра")
+    return body, version
+
+
+def encode_push(payload):
+    """Кадр отправки агента из того же словаря, что уходит в JSON:
+    {node, url, epoch, users, ticks: [[seq, ts, [(username, connection_id, sent, received)]]],
+     sessions: [(username, connection_id, client_ip, absolute_sent, absolute_received)]}
+    """
+    ticks = payload['ticks']
+    sessions = payload['sessions']
+    base_ts = ticks[0][1] if ticks else 0.0
+
+    # Тики: прирост seq, смещение времени от первого тика в мс (zigzag), число дельт
+    tick_columns = []
+    previous_seq = 0
+    for seq, ts, deltas in ticks:
+        offset = round((ts - base_ts) * 1000)
+        tick_columns += (seq - previous_seq if seq > previous_seq else 0,
+                         offset << 1 if offset >= 0 else (-offset << 1) - 1, len(deltas))
+        previous_seq = max(seq, previous_seq)
+
+    # Дельты и сессии - столбцами; имена - номерами в словаре кадра
+    delta_columns = list(zip(*[delta for seq, ts, deltas in ticks for delta in deltas])) or [()] * 4
+    session_columns = list(zip(*sessions)) or [()] * 5
+    names = {}
+    delta_names = [names.setdefault(username, len(names)) for username in delta_columns[0]]
+    session_names = [names.setdefault(username, len(names)) for username in session_columns[0]]
+
+    out = bytearray()
+    _put_strings(out, [payload['node'], payload.get('url', ''), payload.get('epoch') or ''])
+    _put_varints(out, (payload.get('users', 0), len(ticks), len(sessions)))
+    out += TS_BASE.pack(base_ts)
+    _put_strings(out, list(names))
+    _put_varints(out, tick_columns)
+
+    _put_column(out, delta_names)
+    _put_ids(out, delta_columns[1])
+    _put_column(out, delta_columns[2])
+    _put_column(out, delta_columns[3])
+
+    _put_column(out, session_names)
+    _put_ids(out, session_columns[1])
+    _put_ips(out, session_columns[2])
+    _put_column(out, session_columns[3])
+    _put_column(out, session_columns[4])
+    return _frame(FRAME_PUSH, bytes(out), PUSH_VERSION)
+
+
+def decode_push(data):
+    """Разбирает кадр отправки в словарь того же вида, что и JSON; ValueError при битом кадре"""
+    body, version = _unframe(data, FRAME_PUSH, PUSH_VERSIONS)
+    try:
+        header, pos = _get_strings(body, 0)
+        if len(header) != (3 if version >= 2 else 2):
+            raise ValueError("неверный заголовок кадра отправки")
+        node, url = header[:2]
+        epoch = header[2] if version >= 2 else ''
+        (users, tick_count, session_count), pos = _get_varints(body, pos, 3)
+        if tick_count + session_count > len(body) - pos:
+            raise ValueError("счетчики больше остатка кадра")
+        base_ts, = TS_BASE.unpack_from(body, pos)
+        pos += TS_BASE.size
+        names, pos = _get_strings(body, pos)
+        tick_columns, pos = _get_varints(body, pos, 3 * tick_count)
+        delta_count = sum(tick_columns[2::3])
+        if delta_count > len(body) - pos:
+            raise ValueError("число дельт больше остатка кадра")
+
+        delta_names, pos = _get_column(body, pos, delta_count)
+        connection_ids, pos = _get_ids(body, pos, delta_count)
+        sent, pos = _get_column(body, pos, delta_count)
+        received, pos = _get_column(body, pos, delta_count)
+        deltas = list(zip([names[index] for index in delta_names], connection_ids, sent, received))
+
+        ticks = []
+        seq = 0
+        position = 0
+        for index in range(0, len(tick_columns), 3):
+            seq += tick_columns[index]
+            offset = tick_columns[index + 1]
+            ts = base_ts + ((offset >> 1) if not offset & 1 else -((offset + 1) >> 1)) / 1000
+            count = tick_columns[index + 2]
+            ticks.append([seq, ts, deltas[position:position + count]])
+            position += count
+
+        session_names, pos = _get_column(body, pos, session_count)
+        connection_ids, pos = _get_ids(body, pos, session_count)
+        client_ips, pos = _get_ips(body, pos, session_count)
+        absolute_sent, pos = _get_column(body, pos, session_count)
+        absolute_received, pos = _get_column(body, pos, session_count)
+        sessions = list(zip([names[index] for index in session_names], connection_ids, client_ips,
+                            absolute_sent, absolute_received))
+    except (IndexError, OverflowError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"битый кадр отправки: {str(e)}")
+
+    if pos != len(body):
+        raise ValueError("лишние байты после кадра отправки")
+    return {'node': node, 'url': url, 'epoch': epoch or None, 'users': users, 'ticks': ticks, 'sessions': sessions}
+
+
+def encode_ack(acked_seq):
+    out = bytearray()
+    _put_varints(out, (acked_seq,))
+    return _frame(FRAME_ACK, bytes(out))
+
+
+def decode_ack(data):
+    """Последний seq, учтенный агрегатором"""
+    try:
+        (acked_seq,), pos = _get_varints(_unframe(data, FRAME_ACK)[0], 0, 1)
+    except IndexError:
+        raise ValueError("битый кадр подтверждения")
+    return acked_seq
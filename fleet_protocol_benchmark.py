@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Сравнение двоичного протокола флота (fleet_protocol) с JSON на синтетических отправках агента.
+
+Для каждого сценария (сессий на узле x тиков в очереди) печатает размер отправки
+и скорость кодирования/разбора; заодно проверяет, что кадр разбирается обратно
+в те же данные.
+
+    python3 fleet_protocol_benchmark.py [сессий ...]
+"""
+import sys
+import json
+import time
+import random
+
+import fleet_protocol
+
+
+def make_payload(sessions, ticks):
+    random.seed(sessions * 1000 + ticks)
+    names = [f"user{random.randint(0, 10 ** 6):06d}_{index}" for index in range(sessions)]
+    connections = {name: str(random.randint(1, 60000)) for name in names}
+    start = 1700000000.0
+    tick_list = []
+    for tick in range(ticks):
+        # Трафик в тике есть не у всех подключенных
+        active = random.sample(names, sessions * 2 // 3)
+        tick_list.append([1000 + tick, start + tick * 30.0,
+                          [(name, connections[name], random.randint(1, 5 * 10 ** 6), random.randint(1, 50 * 10 ** 6))
+                           for name in active]])
+    snapshot = [(name, connections[name], f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+                 random.randint(10 ** 6, 10 ** 10), random.randint(10 ** 6, 10 ** 11))
+                for index, name in enumerate(names)]
+    return {'node': 'node-1', 'url': 'http://10.0.0.1:9470', 'users': sessions,
+            'ticks': tick_list, 'sessions': snapshot}
+
+
+def measure(function, argument, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    session_counts = [int(value) for value in sys.argv[1:]] or [100, 1000, 5000]
+
+    print(f"{'сессий':>7} {'тиков':>6} {'формат':>7} {'байт':>10} {'сжатие':>7} "
+          f"{'кодир., мс':>11} {'разбор, мс':>11} {'разборов/с':>11}")
+    for sessions in session_counts:
+        for ticks in (1, 10):
+            payload = make_payload(sessions, ticks)
+            repeat = 5 if sessions * ticks > 10000 else 20
+
+            json_data = json.dumps(payload).encode('utf-8')
+            binary_data = fleet_protocol.encode_push(payload)
+
+            # Кадр разбирается в те же данные (время - с точностью до мс)
+            decoded = fleet_protocol.decode_push(binary_data)
+            expected = json.loads(json_data)
+            assert [[seq, [list(delta) for delta in deltas]] for seq, ts, deltas in decoded['ticks']] == \
+                   [[seq, deltas] for seq, ts, deltas in expected['ticks']]
+            assert [list(session) for session in decoded['sessions']] == expected['sessions']
+            assert fleet_protocol.decode_ack(fleet_protocol.encode_ack(payload['ticks'][-1][0])) == \
+                   payload['ticks'][-1][0]
+
+            rows = (
+                ('json', json_data, lambda value: json.dumps(value).encode('utf-8'), json.loads),
+                ('binary', binary_data, fleet_protocol.encode_push, fleet_protocol.decode_push),
+            )
+            for title, data, encode, decode in rows:
+                encode_time = measure(encode, payload, repeat)
+                decode_time = measure(decode, data, repeat)
+                print(f"{sessions:>7} {ticks:>6} {title:>7} {len(data):>10} "
+                      f"{len(json_data) / len(data):>6.1f}x {encode_time * 1000:>11.2f} "
+                      f"{decode_time * 1000:>11.2f} {1 / decode_time:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Локальная проверка флота: агрегатор и несколько агентов на одной машине.
+
+Агрегатор работает в этом процессе, агенты - в отдельных процессах со своими
+каталогами данных и портами. Вместо ipsec и ikev2.sh у агентов синтетические
+сессии и профили. Сценарий: создание пользователей через агрегатор (проверка
+распределения по узлам), трафик, недоступность агрегатора (очередь агентов и
+повторная отправка), скачивание профиля, удаление, сверка трафика агрегатора
+с БД узлов.
+
+    python3 fleet_simulator.py [узлов] [пользователей] [секунд трафика]
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import tempfile
+import subprocess
+from pathlib import Path
+
+TOKEN = "fleet-simulator"
+AGGREGATOR_PORT = 19470
+
+
+def run_agent():
+    """Процесс агента: синтетический ipsec и vpn_manager, настоящие монитор, БД и FleetAgent"""
+    from config import Config
+
+    Config.STATS_UPDATE_INTERVAL = Config.FLEET_PUSH_INTERVAL = 1
+    Config.TRAFFIC_FLUSH_INTERVAL = 5
+    Config.ensure_directories()
+    profiles_dir = Config.BASE_DIR / 'profiles'
+    profiles_dir.mkdir(exist_ok=True)
+    traffic_until = time.time() + float(os.environ['SIM_TRAFFIC_SECONDS'])
+
+    class SimulatedVPNManager:
+        def create_user(self, username):
+            for extension in ('mobileconfig', 'sswan', 'p12'):
+                (profiles_dir / f"{username}.{extension}").write_text(f"{Config.FLEET_NODE_ID}:{username}")
+            return True, f"Пользователь {username} создан"
+
+        def revoke_user(self, username):
+            return True, f"Сертификат {username} отозван"
+
+        def disconnect_user(self, username, connection_id=None):
+            return True, f"{username} отключен"
+
+        def delete_user(self, username):
+            for file_path in profiles_dir.glob(f"{username}.*"):
+                file_path.unlink()
+            return True, f"Пользователь {username} удален"
+
+        def get_profile_path(self, username, profile_type):
+            file_path = profiles_dir / f"{username}.{profile_type}"
+            return str(file_path) if file_path.exists() else None
+
+    module = type(sys)('vpn_manager')
+    module.vpn_manager = SimulatedVPNManager()
+    sys.modules['vpn_manager'] = module
+
+    from database import db
+    from fleet import agent
+    from traffic_monitor import traffic_monitor, IpsecStatus
+
+    counters = {}
+
+    def synthetic_ipsec(tick=False):
+        # Каждый пользователь узла подключен и качает до конца фазы трафика
+        growing = time.time() < traffic_until
+        sessions = {}
+        for index, username in enumerate(db.get_usernames()):
+            sent, received = counters.get(username, (0, 0))
+            if growing:
+                sent += random.randint(1, 50000)
+                received += random.randint(1, 500000)
+                counters[username] = (sent, received)
+            sessions[username] = {'connection_id': str(index + 1), 'absolute_sent': sent,
+                                  'absolute_received': received, 'client_ip': f"10.0.0.{index % 250 + 1}"}
+        return IpsecStatus(sessions)
+
+    traffic_monitor.update_interval = 1
+    traffic_monitor.flush_interval = 5
+    traffic_monitor.read_ipsec_status = synthetic_ipsec
+    agent.start()
+    traffic_monitor.start_monitoring()
+    while True:
+        time.sleep(3600)
+
+
+def wait_for(condition, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return
+        time.sleep(0.5)
+    raise RuntimeError(f"не дождались: {what}")
+
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    traffic_seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    base = Path(tempfile.mkdtemp(prefix='fleet_sim_'))
+    os.environ.update({
+        'FLEET_TOKEN': TOKEN,
+        'FLEET_LISTEN_HOST': '127.0.0.1',
+        'FLEET_AGGREGATOR_URL': f"http://127.0.0.1:{AGGREGATOR_PORT}",
+        'SIM_TRAFFIC_SECONDS': str(traffic_seconds)
+    })
+
+    agents = []
+    for number in range(nodes):
+        data_dir = base / f"node{number + 1}"
+        data_dir.mkdir()
+        # Узлы всегда на своем SQLite; агрегатор - на хранилище из STORAGE_BACKEND
+        env = dict(os.environ, VPNBOT_DATA_DIR=str(data_dir), FLEET_ROLE='agent', STORAGE_BACKEND='sqlite',
+                   FLEET_NODE_ID=f"node{number + 1}", FLEET_LISTEN_PORT=str(AGGREGATOR_PORT + number + 1),
+                   FLEET_ADVERTISE_URL=f"http://127.0.0.1:{AGGREGATOR_PORT + number + 1}")
+        log = open(data_dir / 'agent.out', 'w')
+        agents.append((data_dir, subprocess.Popen([sys.executable, __file__, '--agent'], env=env,
+                                                  stdout=log, stderr=subprocess.STDOUT)))
+
+    os.environ.update({'VPNBOT_DATA_DIR': str(base / 'aggregator'), 'FLEET_ROLE': 'aggregator',
+                       'FLEET_LISTEN_PORT': str(AGGREGATOR_PORT)})
+    (base / 'aggregator').mkdir()
+
+    from config import Config
+    Config.STATS_UPDATE_INTERVAL = 1
+    Config.FLEET_NODE_TIMEOUT = 5
+    Config.ensure_directories()
+
+    from database import db
+    from fleet import aggregator, fleet_request
+    from vpn_manager import vpn_manager
+    from traffic_monitor import traffic_monitor  # обработчики сигналов ставятся только из главного потока
+
+    try:
+        aggregator.start()
+        print(f"🛰️  Агрегатор :{AGGREGATOR_PORT}, узлов: {nodes}, каталог: {base}")
+        wait_for(lambda: sum(node['online'] for node in aggregator.get_nodes()) == nodes, 30, "все узлы онлайн")
+
+        # 1. Создание через агрегатор: равномерно по узлам
+        start = time.time()
+        for number in range(users):
+            success, message = vpn_manager.create_user(f"user{number:04d}")
+            assert success, message
+        placed = db.get_node_user_counts()
+        print(f"👥 Создано {users} за {time.time() - start:.2f} сек, по узлам: {placed}")
+        assert max(placed.values()) - min(placed.values()) <= 1, "неравномерное распределение"
+
+        # 2. Профиль скачивается с узла пользователя
+        file_path = vpn_manager.get_profile_path('user0000', 'mobileconfig')
+        assert file_path and Path(file_path).read_text() == f"{db.get_user_node('user0000')}:user0000"
+        print(f"📄 Профиль user0000 получен с узла {db.get_user_node('user0000')}")
+
+        # 3. Агрегатор недоступен часть фазы трафика: тики копятся у агентов
+        time.sleep(traffic_seconds / 3)
+        aggregator.server.shutdown()
+        aggregator.server.server_close()
+        print("⛔ Агрегатор остановлен")
+        time.sleep(traffic_seconds / 3)
+        aggregator.start()
+        print("✅ Агрегатор снова принимает данные")
+
+        # 4. Трафик закончился, очереди агентов опустели
+        def drained():
+            for number in range(nodes):
+                status = fleet_request(f"http://127.0.0.1:{AGGREGATOR_PORT + number + 1}/fleet/status")
+                if status['outbox']:
+                    return False
+            return True
+
+        time.sleep(traffic_seconds / 3 + 3)
+        wait_for(drained, 30, "пустые очереди агентов")
+        protocols = {fleet_request(f"http://127.0.0.1:{AGGREGATOR_PORT + number + 1}/fleet/status")['protocol']
+                     for number in range(nodes)}
+        print(f"📦 Очереди агентов пусты, протокол отправки: {', '.join(sorted(protocols))}")
+
+        success, message = vpn_manager.delete_user('user0001')
+        assert success, message
+        assert db.get_user_node('user0001') is None
+
+        # 5. Сверка: агенты фиксируют трафик в своих БД и останавливаются
+        for data_dir, process in agents:
+            process.send_signal(signal.SIGTERM)
+        for data_dir, process in agents:
+            process.wait(30)
+
+        import sqlite3
+        node_totals = {}
+        for data_dir, process in agents:
+            conn = sqlite3.connect(data_dir / 'users.db')
+            for username, sent, received in conn.execute(
+                    "SELECT username, total_bytes_sent, total_bytes_received FROM users"):
+                node_totals[username] = (sent, received)
+            conn.close()
+        aggregator_totals = {user.username: (user.total_bytes_sent, user.total_bytes_received)
+                             for user in db.get_all_users()}
+
+        mismatched = [username for username, totals in node_totals.items()
+                      if aggregator_totals.get(username) != totals]
+        total = sum(sent + received for sent, received in node_totals.values())
+        print(f"📊 Трафик узлов: {total} байт, расхождений с агрегатором: {len(mismatched)}")
+        print(json.dumps({'nodes': [{key: node[key] for key in ('node_id', 'users', 'last_seq')}
+                                    for node in aggregator.get_nodes()]}, ensure_ascii=False))
+        assert not mismatched, mismatched[:5]
+        print("✅ Проверка флота пройдена")
+    finally:
+        for data_dir, process in agents:
+            if process.poll() is None:
+                process.kill()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['--agent']:
+        run_agent()
+    else:
+        main()
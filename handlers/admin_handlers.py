@@ -6,7 +6,7 @@ from telebot import types
 from datetime import datetime
 from database import db
 from vpn_manager import vpn_manager
-from utils import get_backup_info_text, format_database_info, format_bytes
+from utils import get_backup_info_text, format_database_info, format_bytes, parse_size
 from config import Config
 
 logger = logging.getLogger(__name__)
@@ -31,10 +31,9 @@ def show_delete_user_menu(message, bot=None):
     logger.info(f"Открытие меню удаления пользователем {user_id}")
 
     if db.is_super_admin(user_id):
-        users = db.get_all_users()
+        users = db.get_user_statuses()
     else:
-        cursor = db.execute("SELECT * FROM users WHERE created_by = ? ORDER BY created_at DESC", (user_id,))
-        users = cursor.fetchall()
+        users = db.get_user_statuses(created_by=user_id)
 
     if not users:
         if db.is_super_admin(user_id):
@@ -45,17 +44,14 @@ def show_delete_user_menu(message, bot=None):
 
     buttons = []
     for user in users:
-        if len(user) >= 2:
-            username = user[1]
-            if db.is_super_admin(user_id) and len(user) >= 4:
-                created_by_username = user[3]
-                button_text = f"🗑️ {username} (создал: {created_by_username})"
-            else:
-                button_text = f"🗑️ {username}"
-            buttons.append([types.InlineKeyboardButton(
-                button_text,
-                callback_data=f'delete_{username}'
-            )])
+        if db.is_super_admin(user_id):
+            button_text = f"🗑️ {user.username} (создал: {user.created_by_username})"
+        else:
+            button_text = f"🗑️ {user.username}"
+        buttons.append([types.InlineKeyboardButton(
+            button_text,
+            callback_data=f'delete_{user.username}'
+        )])
 
     markup = types.InlineKeyboardMarkup(buttons)
     if db.is_super_admin(user_id):
@@ -157,6 +153,408 @@ def setup_admin_handlers(bot):
         markup = types.InlineKeyboardMarkup(buttons)
         bot.send_message(message.chat.id, "👑 Управление администраторами", reply_markup=markup)
 
+    @bot.message_handler(commands=['profile'])
+    def profile_ticks(message):
+        """Профилирование следующих N тиков мониторинга: /profile [N] [cprofile|pyinstrument]"""
+        from traffic_monitor import traffic_monitor
+
+        user_id = message.from_user.id
+
+        if not db.is_super_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Только для супер-администратора")
+            return
+
+        logger.info(f"Команда /profile от супер-администратора {user_id}")
+
+        args = (message.text or "").split()[1:]
+        ticks = 3
+        engine = 'cprofile'
+        for arg in args:
+            if arg.isdigit():
+                ticks = int(arg)
+            else:
+                engine = arg.lower()
+
+        chat_id = message.chat.id
+
+        def send_profile(path, summary):
+            if not path:
+                bot.send_message(chat_id, f"❌ {summary}")
+                return
+            try:
+                with open(path, 'rb') as f:
+                    bot.send_document(chat_id, f, caption=f"🔬 {summary}")
+            finally:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        ok, msg = traffic_monitor.profiler.request(ticks, send_profile, engine)
+        if ok:
+            bot.send_message(
+                chat_id,
+                f"🔬 {msg}\nФайл придет примерно через "
+                f"{traffic_monitor.profiler.total_ticks * Config.STATS_UPDATE_INTERVAL} сек"
+            )
+        else:
+            engines = ", ".join(traffic_monitor.profiler.available_engines())
+            bot.send_message(chat_id, f"❌ {msg}\nДоступно: {engines}")
+
+    @bot.message_handler(commands=['alerts'])
+    def show_alerts(message):
+        """Активные оповещения монитора"""
+        from alerts import alerts, SEVERITY_ICONS
+
+        user_id = message.from_user.id
+
+        if not db.is_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+            return
+
+        logger.info(f"Команда /alerts от администратора {user_id}")
+
+        active = alerts.get_active()
+        if not active:
+            bot.send_message(message.chat.id, "✅ Активных оповещений нет")
+            return
+
+        text = f"🚨 Активные оповещения ({len(active)}):\n\n"
+        for key, alert in active:
+            icon = SEVERITY_ICONS.get(alert['severity'], '⚪')
+            text += f"{icon} {alert['text']}\n"
+            text += f"   с {alerts.format_time(alert['first'])}, последнее {alerts.format_time(alert['last'])}"
+            text += f", повторов: {alert['count']}\n\n" if alert['count'] > 1 else "\n\n"
+        bot.send_message(message.chat.id, text)
+
+    @bot.message_handler(commands=['fleet'])
+    def show_fleet(message):
+        """Состояние узлов флота (режим агрегатора)"""
+        from traffic_monitor import traffic_monitor
+        from utils import format_rate
+
+        user_id = message.from_user.id
+
+        if not db.is_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+            return
+
+        logger.info(f"Команда /fleet от администратора {user_id}")
+
+        if Config.FLEET_ROLE != 'aggregator':
+            bot.send_message(message.chat.id, f"ℹ️ Бот работает в режиме {Config.FLEET_ROLE}, узлов флота нет")
+            return
+
+        from fleet import aggregator
+        nodes = aggregator.get_nodes()
+        if not nodes:
+            bot.send_message(message.chat.id, "🛰️ Узлы еще не присылали данных")
+            return
+
+        placed = db.get_node_user_counts()
+        total_sessions = 0
+        total_sent_rate = 0
+        total_received_rate = 0
+        text = f"🛰️ Узлы флота ({len(nodes)}):\n\n"
+        for node in nodes:
+            sent_rate = 0
+            received_rate = 0
+            for username in node['sessions']:
+                rates = traffic_monitor.rates.get_rates(username)
+                if rates:
+                    sent_rate += rates['current'][0]
+                    received_rate += rates['current'][1]
+            total_sessions += len(node['sessions'])
+            total_sent_rate += sent_rate
+            total_received_rate += received_rate
+
+            if node['pushed_at']:
+                last_push = datetime.fromtimestamp(node['pushed_at']).strftime('%H:%M:%S')
+            else:
+                last_push = node['last_push'] or "—"
+            text += f"{'🟢' if node['online'] else '🔴'} {node['node_id']}\n"
+            text += f"   👥 Пользователей: {node['users']} (размещено ботом: {placed.get(node['node_id'], 0)})\n"
+            text += f"   🔌 Сессий: {len(node['sessions'])}, ↑{format_rate(sent_rate)} ↓{format_rate(received_rate)}\n"
+            text += f"   🕒 Последняя отправка: {last_push}, seq {node['last_seq']}\n\n"
+
+        text += f"📊 Всего: {total_sessions} сессий, ↑{format_rate(total_sent_rate)} ↓{format_rate(total_received_rate)}"
+        bot.send_message(message.chat.id, text)
+
+    @bot.message_handler(commands=['quota'])
+    def quota_command(message):
+        """Квоты трафика: /quota [username] [daily|monthly|total <размер|0>] [action <warn|disconnect|revoke>]"""
+        from traffic_monitor import traffic_monitor
+        from traffic_quotas import QUOTA_KINDS, QUOTA_NAMES
+        from reports import ReportBuilder
+
+        user_id = message.from_user.id
+
+        if not db.is_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+            return
+
+        logger.info(f"Команда /quota от администратора {user_id}")
+
+        args = (message.text or "").split()[1:]
+        quotas = db.get_user_quotas()
+
+        if not args:
+            # Обычный админ видит квоты только своих пользователей
+            if not db.is_super_admin(user_id):
+                quotas = {username: quota for username, quota in quotas.items()
+                          if quota['created_by'] == user_id}
+
+            if not quotas:
+                bot.send_message(message.chat.id, "ℹ️ Квоты не заданы\n\n"
+                                                  "Использование: /quota username daily|monthly|total 10GB\n"
+                                                  "Действие: /quota username action warn|disconnect|revoke")
+                return
+
+            report = ReportBuilder("📏 Квоты трафика:\n\n", "quotas",
+                                   columns=('username',) + QUOTA_KINDS + ('action',))
+            for username, quota in quotas.items():
+                limits = ", ".join(f"{QUOTA_NAMES[kind]} {format_bytes(quota[kind])}"
+                                   for kind in QUOTA_KINDS if quota[kind])
+                report.add(f"👤 {username}: {limits} ({quota['action']})\n",
+                           (username,) + tuple(quota[kind] for kind in QUOTA_KINDS) + (quota['action'],))
+            if not report.send(bot, message.chat.id):
+                bot.send_message(message.chat.id, "❌ Не удалось отправить отчет")
+            return
+
+        username = args[0]
+        user = db.get_user(username)
+        if not user:
+            bot.send_message(message.chat.id, f"❌ Пользователь '{username}' не найден")
+            return
+
+        # Обычный админ управляет квотами только своих пользователей
+        if not db.is_super_admin(user_id) and user.created_by != user_id:
+            bot.send_message(message.chat.id, "⛔ Можно менять квоты только своих пользователей")
+            return
+
+        if len(args) >= 3:
+            kind = args[1].lower()
+            value = args[2].lower()
+
+            if kind == 'action':
+                if value not in Config.QUOTA_ACTIONS:
+                    bot.send_message(message.chat.id, f"❌ Действие: {', '.join(Config.QUOTA_ACTIONS)}")
+                    return
+                if value == 'revoke' and not db.is_super_admin(user_id):
+                    bot.send_message(message.chat.id, "⛔ Отзыв сертификата - только для супер-администратора")
+                    return
+                success = db.set_user_quota(username, action=value)
+            elif kind in QUOTA_KINDS:
+                limit = parse_size(value)
+                if limit is None:
+                    bot.send_message(message.chat.id, "❌ Неверный размер. Примеры: 500MB, 10GB, 0 - снять квоту")
+                    return
+                success = db.set_user_quota(username, kind=kind, limit=limit)
+            else:
+                bot.send_message(message.chat.id, f"❌ Тип квоты: {', '.join(QUOTA_KINDS)} или action")
+                return
+
+            if not success:
+                bot.send_message(message.chat.id, "❌ Ошибка сохранения квоты")
+                return
+            quotas = db.get_user_quotas()
+
+        quota = quotas.get(username)
+        if not quota:
+            bot.send_message(message.chat.id, f"ℹ️ У пользователя '{username}' квоты не заданы")
+            return
+
+        usage = traffic_monitor.quotas.get_usage(username)
+        text = f"📏 Квоты {username} (действие: {quota['action']}):\n\n"
+        for kind in QUOTA_KINDS:
+            if not quota[kind]:
+                continue
+            used = f"{format_bytes(usage[kind])} из " if usage else ""
+            text += f"• {QUOTA_NAMES[kind].capitalize()}: {used}{format_bytes(quota[kind])}\n"
+        bot.send_message(message.chat.id, text)
+
+    @bot.message_handler(commands=['export'])
+    def export_history(message):
+        """Выгрузка истории: /export traffic_log|user_stats|session_backup [csv|jsonl|parquet]
+        [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [user1,user2]"""
+        from traffic_export import exporter, EXPORT_TABLES, EXPORT_FORMATS
+
+        user_id = message.from_user.id
+
+        if not db.is_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+            return
+
+        logger.info(f"Команда /export от администратора {user_id}")
+
+        args = (message.text or "").split()[1:]
+        if not args or args[0] not in EXPORT_TABLES:
+            bot.send_message(message.chat.id,
+                             "📤 Выгрузка истории трафика\n\n"
+                             "Использование: /export таблица [формат] [с] [по] [пользователи]\n"
+                             f"Таблицы: {', '.join(EXPORT_TABLES)}\n"
+                             f"Форматы: {', '.join(EXPORT_FORMATS)} (по умолчанию csv)\n\n"
+                             "Пример: /export traffic_log csv 2024-01-01 2024-01-31 user1,user2")
+            return
+
+        table = args[0]
+        fmt = 'csv'
+        dates = []
+        usernames = []
+        for arg in args[1:]:
+            if arg.lower() in EXPORT_FORMATS:
+                fmt = arg.lower()
+                continue
+            try:
+                dates.append(datetime.strptime(arg, "%Y-%m-%d").date())
+                continue
+            except ValueError:
+                pass
+            usernames.extend(name for name in arg.split(',') if name)
+
+        if len(dates) > 2:
+            bot.send_message(message.chat.id, "❌ Укажите не больше двух дат: начало и конец периода")
+            return
+        date_from = dates[0] if dates else None
+        date_to = dates[1] if len(dates) > 1 else None
+
+        # Обычный админ выгружает историю только своих пользователей
+        if not db.is_super_admin(user_id):
+            own_users = db.get_usernames(created_by=user_id)
+            foreign = [name for name in usernames if name not in own_users]
+            if foreign:
+                bot.send_message(message.chat.id, f"⛔ Не ваши пользователи: {', '.join(foreign)}")
+                return
+            if not usernames:
+                usernames = own_users
+            if not usernames:
+                bot.send_message(message.chat.id, "📭 У вас нет пользователей для выгрузки")
+                return
+
+        bot.send_message(message.chat.id, f"⏳ Выгрузка {table} ({fmt})...")
+
+        success, result = exporter.export(table, fmt, date_from, date_to, usernames)
+        if not success:
+            bot.send_message(message.chat.id, f"❌ {result}")
+            return
+
+        path = result['path']
+        try:
+            if result['size'] > Config.EXPORT_MAX_FILE_SIZE:
+                bot.send_message(message.chat.id,
+                                 f"❌ Файл {format_bytes(result['size'])} больше лимита Telegram, "
+                                 f"сузьте период или список пользователей")
+                return
+
+            period = f"{date_from or '...'} - {date_to or '...'}"
+            with open(path, 'rb') as f:
+                bot.send_document(message.chat.id, f,
+                                  caption=f"📤 {table}: {result['rows']} строк, {period}\n"
+                                          f"{format_bytes(result['size'])}, {result['seconds']:.1f} сек")
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @bot.message_handler(commands=['report'])
+    def traffic_report(message):
+        """Аналитический отчет по истории трафика: /report [дней] [username]"""
+        from traffic_analytics import analytics, numpy_available
+        from reports import ReportBuilder
+
+        user_id = message.from_user.id
+
+        if not db.is_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+            return
+
+        logger.info(f"Команда /report от администратора {user_id}")
+
+        if not numpy_available():
+            bot.send_message(message.chat.id, "❌ Для отчетов нужен numpy (pip install numpy)")
+            return
+
+        days = Config.ANALYTICS_DEFAULT_DAYS
+        username = None
+        for arg in (message.text or "").split()[1:]:
+            if arg.isdigit():
+                days = max(1, min(int(arg), Config.ANALYTICS_MAX_DAYS))
+            else:
+                username = arg
+
+        users = None
+        if username:
+            user = db.get_user(username)
+            if not user:
+                bot.send_message(message.chat.id, f"❌ Пользователь '{username}' не найден")
+                return
+            if not db.is_super_admin(user_id) and user.created_by != user_id:
+                bot.send_message(message.chat.id, "⛔ Отчет доступен только по своим пользователям")
+                return
+            users = [username]
+        elif not db.is_super_admin(user_id):
+            # Обычный админ видит отчет только по своим пользователям
+            users = db.get_usernames(created_by=user_id)
+
+        window = analytics.get_window(days)
+        if window is None:
+            bot.send_message(message.chat.id, "❌ Ошибка загрузки истории трафика")
+            return
+        if users is not None:
+            window = window.for_users(users)
+        if not window.usernames:
+            bot.send_message(message.chat.id, "📭 Нет данных за этот период")
+            return
+
+        title = (f"📊 Отчет {'по ' + username if username else 'по серверу'} за {days} дн. "
+                 f"({window.date_from} - {window.date_to})\n\n")
+        report = ReportBuilder(title, "report", code=True)
+        report.extend(analytics.iter_report(window))
+        if not report.send(bot, message.chat.id):
+            bot.send_message(message.chat.id, "❌ Не удалось отправить отчет")
+
+    @bot.message_handler(commands=['chart'])
+    def traffic_chart(message):
+        """График трафика по дням: /chart [дней] [username]"""
+        from traffic_charts import charts, charts_available
+
+        user_id = message.from_user.id
+
+        if not db.is_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+            return
+
+        logger.info(f"Команда /chart от администратора {user_id}")
+
+        if not charts_available():
+            bot.send_message(message.chat.id, "❌ Для графиков нужен matplotlib (pip install matplotlib)")
+            return
+
+        days = Config.CHART_DEFAULT_DAYS
+        username = None
+        for arg in (message.text or "").split()[1:]:
+            if arg.isdigit():
+                days = max(2, min(int(arg), Config.ANALYTICS_MAX_DAYS))
+            else:
+                username = arg
+
+        if username:
+            user = db.get_user(username)
+            if not user:
+                bot.send_message(message.chat.id, f"❌ Пользователь '{username}' не найден")
+                return
+            if not db.is_super_admin(user_id) and user.created_by != user_id:
+                bot.send_message(message.chat.id, "⛔ График доступен только по своим пользователям")
+                return
+        elif not db.is_super_admin(user_id):
+            bot.send_message(message.chat.id, "⛔ График сервера - только для супер-администратора. "
+                                              "Укажите пользователя: /chart 30 username")
+            return
+
+        if not charts.send_chart(bot, message.chat.id, username, days):
+            bot.send_message(message.chat.id, "❌ Не удалось построить график")
+
     @bot.message_handler(commands=['deleteuser'])
     def delete_user(message):
         show_delete_user_menu(message, bot)
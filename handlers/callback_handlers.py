@@ -6,6 +6,7 @@ import os
 import sys
 from pathlib import Path
 from types import SimpleNamespace
+from datetime import datetime
 from telebot import types
 from database import db
 from vpn_manager import vpn_manager
@@ -122,6 +123,11 @@ def setup_callback_handlers(bot):
             show_active_stats(_message_as_caller(call))
             bot.answer_callback_query(call.id, "⚡ Активные подключения")
 
+        elif action == 'toptalkers':
+            from handlers.user_handlers import show_top_talkers
+            show_top_talkers(_message_as_caller(call))
+            bot.answer_callback_query(call.id, "⚡ Топ по скорости")
+
         elif action == 'admin':
             if db.is_super_admin(user_id):
                 buttons = [
@@ -217,7 +223,6 @@ def setup_callback_handlers(bot):
             return
 
         if call.data == 'listusers_refresh':
-            list_users_pages[chat_id]['users'] = db.get_all_users()
             list_users_pages[chat_id]['page'] = 0
         elif call.data.startswith('listusers_prev_'):
             new_page = int(call.data.replace('listusers_prev_', ''))
@@ -233,6 +238,27 @@ def setup_callback_handlers(bot):
             callback_query_id=call.id
         )
 
+    @bot.callback_query_handler(func=lambda call: call.data in ('dashboard_extend', 'dashboard_stop'))
+    def handle_dashboard(call):
+        from live_dashboard import dashboards
+
+        if not db.is_admin(call.from_user.id):
+            bot.answer_callback_query(call.id, "⛔ Доступ запрещен")
+            return
+
+        chat_id = call.message.chat.id
+        message_id = call.message.message_id
+
+        if call.data == 'dashboard_extend':
+            expires_at = dashboards.extend(chat_id, message_id)
+            if expires_at is None:
+                bot.answer_callback_query(call.id, "⚠️ Панель уже остановлена, запустите /dashboard снова")
+                return
+            bot.answer_callback_query(call.id, f"⏳ Продлено до {datetime.fromtimestamp(expires_at):%H:%M}")
+        else:
+            dashboards.stop(chat_id, message_id=message_id)
+            bot.answer_callback_query(call.id, "⏹ Панель остановлена")
+
     @bot.callback_query_handler(
         func=lambda call: call.data.startswith('userstats_page_') or call.data == 'userstats_refresh'
     )
@@ -245,7 +271,6 @@ def setup_callback_handlers(bot):
             return
 
         if call.data == 'userstats_refresh':
-            user_stats_pages[chat_id]['users'] = db.get_all_users()
             user_stats_pages[chat_id]['page'] = 0
         elif call.data.startswith('userstats_page_'):
             new_page = int(call.data.replace('userstats_page_', ''))
@@ -296,7 +321,7 @@ def setup_callback_handlers(bot):
         if not db.is_super_admin(user_id):
             # Обычный админ может удалять только своих пользователей
             user = db.get_user(username)
-            if not user or user[2] != user_id:  # created_by
+            if not user or user.created_by != user_id:
                 bot.send_message(call.message.chat.id, f"❌ Вы можете удалять только своих пользователей")
                 bot.answer_callback_query(call.id, "❌ Нет прав на удаление")
                 return
@@ -428,9 +453,9 @@ def setup_callback_handlers(bot):
             backup_info = db.get_backup_info()
             db_backups = backup_info.get("db_backups", [])
             if not db_backups:
-                db_backups = [b for b in backup_info.get("backups", []) if b.get("path", "").endswith(".db")]
+                db_backups = [b for b in backup_info.get("backups", []) if b.get("path", "").endswith(db.BACKUP_SUFFIX)]
             if not db_backups:
-                bot.send_message(call.message.chat.id, "❌ Не найдено .db бэкапов для восстановления")
+                bot.send_message(call.message.chat.id, "❌ Не найдено бэкапов БД для восстановления")
                 bot.answer_callback_query(call.id, "❌ Нет бэкапов")
                 return
 
@@ -459,9 +484,9 @@ def setup_callback_handlers(bot):
             backup_info = db.get_backup_info()
             db_backups = backup_info.get("db_backups", [])
             if not db_backups:
-                db_backups = [b for b in backup_info.get("backups", []) if b.get("path", "").endswith(".db")]
+                db_backups = [b for b in backup_info.get("backups", []) if b.get("path", "").endswith(db.BACKUP_SUFFIX)]
             if not db_backups:
-                bot.send_message(call.message.chat.id, "❌ Не найдено .db бэкапов для восстановления")
+                bot.send_message(call.message.chat.id, "❌ Не найдено бэкапов БД для восстановления")
                 bot.answer_callback_query(call.id, "❌ Нет бэкапов")
                 return
 
@@ -620,17 +645,17 @@ def setup_callback_handlers(bot):
         method = call.data
 
         if method == 'add_manual':
-            msg = bot.send_message(call.message.chat.id, "Введите ID пользователя для добавления в администраторы:")
-            bot.register_next_step_handler(msg, process_add_admin_manual, bot)
+            bot.send_message(call.message.chat.id, "Введите ID пользователя для добавления в администраторы:")
+            bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_add_admin_manual, bot)
             bot.answer_callback_query(call.id, "📝 Ввод ID")
 
         elif method == 'add_forward':
-            msg = bot.send_message(
+            bot.send_message(
                 call.message.chat.id,
                 "Перешлите любое сообщение от пользователя, которого хотите добавить в администраторы.\n\n"
                 "Если Telegram скрывает ID при пересылке, используйте добавление по ID или через контакт."
             )
-            bot.register_next_step_handler(msg, process_add_admin_forward, bot)
+            bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_add_admin_forward, bot)
             bot.answer_callback_query(call.id, "🔗 Перешлите сообщение")
 
         elif method == 'add_contact':
@@ -645,13 +670,13 @@ def setup_callback_handlers(bot):
             else:
                 keyboard.add(types.KeyboardButton("📱 Отправить контакт", request_contact=True))
             keyboard.add(types.KeyboardButton("❌ Отмена"))
-            msg = bot.send_message(
+            bot.send_message(
                 call.message.chat.id,
                 "Выберите пользователя из списка Telegram контактов.\n\n"
                 "Если список не откроется (старая версия Telegram API), отправьте контакт вручную.",
                 reply_markup=keyboard
             )
-            bot.register_next_step_handler(msg, process_add_admin_contact, bot)
+            bot.register_next_step_handler_by_chat_id(call.message.chat.id, process_add_admin_contact, bot)
             bot.answer_callback_query(call.id, "📇 Отправьте контакт")
 
         elif method == 'add_cancel':
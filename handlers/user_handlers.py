@@ -3,10 +3,15 @@ import logging
 from telebot import types
 from datetime import datetime
 from database import db
-from utils import validate_username, format_traffic_stats, format_database_info, get_backup_info_text, format_bytes
+from utils import validate_username, format_traffic_stats, format_database_info, get_backup_info_text, format_bytes, \
+    format_rate
 from vpn_manager import vpn_manager
 from config import Config
 from traffic_monitor import traffic_monitor
+from reports import ReportBuilder
+from render_cache import render_cache
+from live_dashboard import dashboards
+from user_search import SEARCH_HELP, parse_query, format_user_card
 
 logger = logging.getLogger(__name__)
 
@@ -21,9 +26,55 @@ user_states = {}
 bot_instance = None
 
 
-def split_message(text, max_length=4000):
-    """Разбивает текст на части не длиннее max_length символов"""
-    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
+def iter_active_stats(traffic_data):
+    """Записи отчета /activestats: (текст, строка CSV) на каждое подключение"""
+    for username, data in traffic_data.items():
+        total_traffic = (data['absolute_sent'] + data['absolute_received']) / (1024 ** 2)  # MB
+
+        sent_rate, received_rate = 0, 0
+        rates = traffic_monitor.rates.get_rates(username)
+        if rates:
+            sent_rate, received_rate = rates['current']
+
+        text = (f"👤 {username}\n"
+                f"   IP: {data['client_ip']}\n"
+                f"   ID: {data['connection_id']}\n"
+                f"   Абсолютные значения:\n"
+                f"     • Отправлено: {data['absolute_sent'] / 1024 / 1024:.1f} MB\n"
+                f"     • Получено: {data['absolute_received'] / 1024 / 1024:.1f} MB\n"
+                f"   Всего: {total_traffic:.2f} MB\n")
+        if rates:
+            text += f"   Скорость: ↑{format_rate(sent_rate)} ↓{format_rate(received_rate)}\n"
+        text += "\n"
+
+        row = (username, data['client_ip'], data['connection_id'], data['absolute_sent'],
+               data['absolute_received'], round(sent_rate), round(received_rate))
+        yield text, row
+
+
+def iter_debug_traffic(traffic_data):
+    """Записи отчета /debugtraffic: сырые значения ipsec, базы и разница"""
+    for username, data in traffic_data.items():
+        base = traffic_monitor.get_base_traffic(username)
+        sent_diff = max(0, data['absolute_sent'] - base['sent'])
+        received_diff = max(0, data['absolute_received'] - base['received'])
+
+        text = (f"👤 {username}:\n"
+                f"  IP: {data['client_ip']}\n"
+                f"  Connection ID: {data['connection_id']}\n"
+                f"  Абсолютные значения из ipsec:\n"
+                f"    • Отправлено: {data['absolute_sent']:,} bytes ({data['absolute_sent'] / 1024 / 1024:.1f} MB)\n"
+                f"    • Получено: {data['absolute_received']:,} bytes ({data['absolute_received'] / 1024 / 1024:.1f} MB)\n"
+                f"  Базовые значения:\n"
+                f"    • Отправлено: {base['sent']:,} bytes\n"
+                f"    • Получено: {base['received']:,} bytes\n"
+                f"  Разница (будет добавлено):\n"
+                f"    • Отправлено: +{sent_diff:,} bytes (+{sent_diff / 1024 / 1024:.1f} MB)\n"
+                f"    • Получено: +{received_diff:,} bytes (+{received_diff / 1024 / 1024:.1f} MB)\n\n")
+
+        row = (username, data['client_ip'], data['connection_id'], data['absolute_sent'],
+               data['absolute_received'], base['sent'], base['received'], sent_diff, received_diff)
+        yield text, row
 
 
 def show_platform_selector(bot, chat_id, username):
@@ -102,49 +153,54 @@ def process_username_step(bot, message):
         show_platform_selector(bot, message.chat.id, username)
 
 
-def show_list_users_page(bot, chat_id, edit_message_id=None, callback_query_id=None):
-    """Показывает страницу списка пользователей"""
-    if chat_id not in list_users_pages:
-        if callback_query_id:
-            try:
-                bot.answer_callback_query(callback_query_id, "Данные устарели. Используйте /listusers снова")
-            except:
-                pass
-        return
+def _get_users(kind, query, filters):
+    """Пользователи для списков (все или найденные по query) из кэша текущей версии данных"""
+    if query:
+        load = lambda: db.search_users(**filters)
+    elif kind == 'summaries':
+        load = db.get_user_summaries
+    else:
+        load = db.get_user_statuses
+    return render_cache.get((f'user_{kind}', query, db.users_version), load)
 
-    data = list_users_pages[chat_id]
-    users = data['users']
-    page = data['page']
-    page_size = data['page_size']
 
-    total_pages = (len(users) + page_size - 1) // page_size
+def _parse_list_query(bot, message, command):
+    """Строка поиска из аргументов /listusers и /userstats: (query, filters) или None при ошибке"""
+    args = (getattr(message, 'text', None) or "").split(maxsplit=1)
+    query = " ".join(args[1].split()) if len(args) > 1 else ""
+    if query == '?':
+        bot.send_message(message.chat.id, f"{SEARCH_HELP}\n\nПример: /{command} *test active seen:7d")
+        return None
+
+    filters, error = parse_query(query)
+    if error:
+        bot.send_message(message.chat.id, f"❌ {error}\n\nСправка: /{command} ?")
+        return None
+    return query, filters
+
+
+def _render_list_users_page(page, page_size, users, query):
+    """Текст и клавиатура страницы /listusers"""
+    total_pages = max(1, (len(users) + page_size - 1) // page_size)
     start_idx = page * page_size
     end_idx = min(start_idx + page_size, len(users))
 
-    user_list = f"📋 Список пользователей (стр. {page + 1}/{total_pages}):\n\n"
-
-    for i in range(start_idx, end_idx):
-        user = users[i]
-
-        # Безопасное извлечение данных
-        username = user[1] if len(user) > 1 else "Unknown"
-        created_by_username = user[3] if len(user) > 3 else "Неизвестно"
-        created_at = user[4] if len(user) > 4 else ""
-        total_conn = user[5] if len(user) > 5 else 0
-        last_conn = user[6] if len(user) > 6 else ""
-        sent = user[7] if len(user) > 7 else 0
-        received = user[8] if len(user) > 8 else 0
-        is_active = user[9] if len(user) > 9 else 0
-
-        status = "🟢" if is_active else "⚪"
-        user_list += f"{status} {username}\n"
-        user_list += f"   Создан: {created_at[:10] if created_at else 'Неизвестно'} администратором {created_by_username}\n"
-        if total_conn > 0:
-            total_traffic = sent + received
-            user_list += f"   Подключений: {total_conn}, трафик: {format_bytes(total_traffic)}\n"
+    user_list = f"📋 Список пользователей (стр. {page + 1}/{total_pages}):\n"
+    if query:
+        user_list += f"🔍 Фильтр: {query}\n"
+    user_list += "\n"
+
+    for user in users[start_idx:end_idx]:
+        status = "🟢" if user.is_active else "⚪"
+        created_at = user.created_at[:10] if user.created_at else 'Неизвестно'
+        user_list += f"{status} {user.username}\n"
+        user_list += f"   Создан: {created_at} администратором {user.created_by_username}\n"
+        if user.total_connections > 0:
+            total_traffic = user.total_bytes_sent + user.total_bytes_received
+            user_list += f"   Подключений: {user.total_connections}, трафик: {format_bytes(total_traffic)}\n"
         user_list += "\n"
 
-    user_list += f"Всего пользователей: {len(users)}"
+    user_list += f"{'Найдено' if query else 'Всего пользователей'}: {len(users)}"
 
     # Создаем кнопки навигации
     markup = types.InlineKeyboardMarkup()
@@ -161,6 +217,40 @@ def show_list_users_page(bot, chat_id, edit_message_id=None, callback_query_id=N
 
     # Кнопка обновления
     markup.row(types.InlineKeyboardButton("🔄 Обновить", callback_data='listusers_refresh'))
+    return user_list, markup
+
+
+def show_list_users_page(bot, chat_id, edit_message_id=None, callback_query_id=None):
+    """Показывает страницу списка пользователей"""
+    if chat_id not in list_users_pages:
+        if callback_query_id:
+            try:
+                bot.answer_callback_query(callback_query_id, "Данные устарели. Используйте /listusers снова")
+            except:
+                pass
+        return
+
+    data = list_users_pages[chat_id]
+    page_size = data['page_size']
+
+    # Страницы отрисовываются один раз на версию данных, листание - попадания в кэш
+    query = data['query']
+    version = db.users_version
+    users = _get_users('summaries', query, data['filters'])
+    total_pages = max(1, (len(users) + page_size - 1) // page_size)
+    page = data['page'] = min(data['page'], total_pages - 1)
+
+    key = ('listusers', query, page, page_size, version)
+    if edit_message_id and render_cache.is_shown(chat_id, edit_message_id, key):
+        # Сообщение уже показывает эту страницу - правка вернула бы "message is not modified"
+        if callback_query_id:
+            try:
+                bot.answer_callback_query(callback_query_id)
+            except:
+                pass
+        return
+
+    user_list, markup = render_cache.get(key, lambda: _render_list_users_page(page, page_size, users, query))
 
     try:
         if edit_message_id:
@@ -170,6 +260,7 @@ def show_list_users_page(bot, chat_id, edit_message_id=None, callback_query_id=N
                 text=user_list,
                 reply_markup=markup
             )
+            render_cache.mark_shown(chat_id, edit_message_id, key)
         else:
             bot.send_message(chat_id, user_list, reply_markup=markup)
 
@@ -181,6 +272,7 @@ def show_list_users_page(bot, chat_id, edit_message_id=None, callback_query_id=N
         error_msg = str(e)
         if "message is not modified" in error_msg:
             # Это нормально - пользователь нажал на ту же самую кнопку
+            render_cache.mark_shown(chat_id, edit_message_id, key)
             if callback_query_id:
                 try:
                     bot.answer_callback_query(callback_query_id)
@@ -218,18 +310,27 @@ def list_users(message):
 
     logger.info(f"Команда /listusers от администратора {user_id}")
 
-    users = db.get_all_users()
+    parsed = _parse_list_query(bot, message, 'listusers')
+    if parsed is None:
+        return
+    query, filters = parsed
+
+    users = _get_users('summaries', query, filters)
 
     if not users:
-        bot.send_message(message.chat.id, "📭 В базе данных нет пользователей")
+        if query:
+            bot.send_message(message.chat.id, f"🔍 Никого не найдено: {query}")
+        else:
+            bot.send_message(message.chat.id, "📭 В базе данных нет пользователей")
         return
 
     # Сохраняем данные для пагинации
     chat_id = message.chat.id
     list_users_pages[chat_id] = {
-        'users': users,
         'page': 0,
-        'page_size': 15  # Пользователей на страницу
+        'page_size': 15,  # Пользователей на страницу
+        'query': query,
+        'filters': filters
     }
 
     # Показываем первую страницу
@@ -256,13 +357,15 @@ def show_stats(message):
     active_users = db.get_active_users_count()
 
     # Получаем свежие данные
-    traffic_data = traffic_monitor.parse_ipsec_status()
+    status = traffic_monitor.read_ipsec_status()
+    traffic_data = status.sessions
+    ipsec_active = len(traffic_data) if status.available else f"⚠️ ipsec недоступен ({status.error})"
 
     stats_text = f"""📊 Статистика VPN сервера
 
 👥 Всего пользователей: {total_users}
 🟢 Активных в БД: {active_users}
-🔌 Активных в ipsec: {len(traffic_data)}
+🔌 Активных в ipsec: {ipsec_active}
 
 ⏱️  Мониторинг: каждые {Config.STATS_UPDATE_INTERVAL} сек
 📁 Директория конфигов: {Config.VPN_PROFILES_PATH}
@@ -293,50 +396,42 @@ def user_stats(message):
 
     logger.info(f"Команда /userstats от администратора {user_id}")
 
-    users = db.get_all_users()
+    parsed = _parse_list_query(bot, message, 'userstats')
+    if parsed is None:
+        return
+    query, filters = parsed
+
+    users = _get_users('statuses', query, filters)
     if not users:
-        bot.send_message(message.chat.id, "📭 В базе данных нет пользователей")
+        if query:
+            bot.send_message(message.chat.id, f"🔍 Никого не найдено: {query}")
+        else:
+            bot.send_message(message.chat.id, "📭 В базе данных нет пользователей")
         return
 
     chat_id = message.chat.id
     user_stats_pages[chat_id] = {
-        'users': users,
         'page': 0,
-        'page_size': 10
+        'page_size': 10,
+        'query': query,
+        'filters': filters
     }
     show_user_stats_page(bot, chat_id)
 
 
-def show_user_stats_page(bot, chat_id, edit_message_id=None, callback_query_id=None):
-    """Показывает страницу списка пользователей для статистики."""
-    if chat_id not in user_stats_pages:
-        if callback_query_id:
-            try:
-                bot.answer_callback_query(callback_query_id, "Данные устарели. Используйте /userstats снова")
-            except Exception:
-                pass
-        return
-
-    data = user_stats_pages[chat_id]
-    users = data['users']
-    page = data['page']
-    page_size = data['page_size']
+def _render_user_stats_page(page, page_size, users, query):
+    """Текст и клавиатура страницы /userstats"""
     total_pages = max(1, (len(users) + page_size - 1) // page_size)
-
     start_idx = page * page_size
     end_idx = min(start_idx + page_size, len(users))
 
     buttons = []
-    for i in range(start_idx, end_idx):
-        user = users[i]
-        if len(user) >= 2:
-            username = user[1]
-            is_active = user[9] if len(user) > 9 else 0
-            status = "🟢" if is_active else "⚪"
-            buttons.append([types.InlineKeyboardButton(
-                f"{status} {username}",
-                callback_data=f'userstats_{username}'
-            )])
+    for user in users[start_idx:end_idx]:
+        status = "🟢" if user.is_active else "⚪"
+        buttons.append([types.InlineKeyboardButton(
+            f"{status} {user.username}",
+            callback_data=f'userstats_{user.username}'
+        )])
 
     if total_pages > 1:
         nav_buttons = []
@@ -351,6 +446,40 @@ def show_user_stats_page(bot, chat_id, edit_message_id=None, callback_query_id=N
     buttons.append([types.InlineKeyboardButton("🔄 Обновить список", callback_data='userstats_refresh')])
     markup = types.InlineKeyboardMarkup(buttons)
     text = f"Выберите пользователя для просмотра статистики (стр. {page + 1}/{total_pages}):"
+    if query:
+        text += f"\n🔍 Фильтр: {query} (найдено: {len(users)})"
+    return text, markup
+
+
+def show_user_stats_page(bot, chat_id, edit_message_id=None, callback_query_id=None):
+    """Показывает страницу списка пользователей для статистики."""
+    if chat_id not in user_stats_pages:
+        if callback_query_id:
+            try:
+                bot.answer_callback_query(callback_query_id, "Данные устарели. Используйте /userstats снова")
+            except Exception:
+                pass
+        return
+
+    data = user_stats_pages[chat_id]
+    page_size = data['page_size']
+
+    query = data['query']
+    version = db.users_version
+    users = _get_users('statuses', query, data['filters'])
+    total_pages = max(1, (len(users) + page_size - 1) // page_size)
+    page = data['page'] = min(data['page'], total_pages - 1)
+
+    key = ('userstats', query, page, page_size, version)
+    if edit_message_id and render_cache.is_shown(chat_id, edit_message_id, key):
+        if callback_query_id:
+            try:
+                bot.answer_callback_query(callback_query_id)
+            except Exception:
+                pass
+        return
+
+    text, markup = render_cache.get(key, lambda: _render_user_stats_page(page, page_size, users, query))
 
     try:
         if edit_message_id:
@@ -360,6 +489,7 @@ def show_user_stats_page(bot, chat_id, edit_message_id=None, callback_query_id=N
                 text=text,
                 reply_markup=markup
             )
+            render_cache.mark_shown(chat_id, edit_message_id, key)
         else:
             bot.send_message(chat_id, text, reply_markup=markup)
 
@@ -368,6 +498,7 @@ def show_user_stats_page(bot, chat_id, edit_message_id=None, callback_query_id=N
     except telebot.apihelper.ApiTelegramException as e:
         error_msg = str(e)
         if "message is not modified" in error_msg:
+            render_cache.mark_shown(chat_id, edit_message_id, key)
             if callback_query_id:
                 try:
                     bot.answer_callback_query(callback_query_id)
@@ -395,37 +526,93 @@ def show_active_stats(message):
 
     logger.info(f"Команда /activestats от администратора {user_id}")
 
-    traffic_data = traffic_monitor.parse_ipsec_status()
+    status = traffic_monitor.read_ipsec_status()
+    traffic_data = status.sessions
+
+    if not status.available:
+        bot.send_message(message.chat.id, f"⚠️ Не удалось получить данные ipsec: {status.error}")
+        return
 
     if not traffic_data:
         bot.send_message(message.chat.id, "📭 Нет активных подключений")
         return
 
-    stats_text = "🟢 Активные подключения (из ipsec):\n\n"
+    report = ReportBuilder(
+        "🟢 Активные подключения (из ipsec):\n\n", "activestats",
+        columns=('username', 'client_ip', 'connection_id', 'sent_bytes', 'received_bytes',
+                 'sent_bps', 'received_bps')
+    )
+    report.extend(iter_active_stats(traffic_data))
+    if not report.send(bot, message.chat.id, footer=f"Всего активных: {len(traffic_data)}"):
+        bot.send_message(message.chat.id, "❌ Не удалось отправить отчет")
 
-    for username, data in traffic_data.items():
-        total_traffic = (data['absolute_sent'] + data['absolute_received']) / (1024 ** 2)  # MB
 
-        stats_text += f"👤 {username}\n"
-        stats_text += f"   IP: {data['client_ip']}\n"
-        stats_text += f"   ID: {data['connection_id']}\n"
-        stats_text += f"   Абсолютные значения:\n"
-        stats_text += f"     • Отправлено: {data['absolute_sent'] / 1024 / 1024:.1f} MB\n"
-        stats_text += f"     • Получено: {data['absolute_received'] / 1024 / 1024:.1f} MB\n"
-        stats_text += f"   Всего: {total_traffic:.2f} MB\n\n"
-
-    stats_text += f"Всего активных: {len(traffic_data)}"
-
-    # Защита от слишком длинных сообщений
-    if len(stats_text) > 4000:
-        parts = split_message(stats_text)
-        for i, part in enumerate(parts):
-            if i == 0:
-                bot.send_message(message.chat.id, part)
-            else:
-                bot.send_message(message.chat.id, f"`{part}`", parse_mode='Markdown')
-    else:
-        bot.send_message(message.chat.id, stats_text)
+def show_top_talkers(message):
+    """Обработчик команды /toptalkers: самые активные пользователи прямо сейчас.
+
+    Данные берутся только из памяти монитора, без обращения к БД и ipsec.
+    """
+    bot = bot_instance
+
+    if bot is None:
+        logger.error("bot_instance не инициализирован в user_handlers")
+        return
+
+    user_id = message.from_user.id
+
+    if not db.is_admin(user_id):
+        bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+        return
+
+    logger.info(f"Команда /toptalkers от администратора {user_id}")
+
+    rates = traffic_monitor.rates
+    talkers = rates.top_talkers(Config.TOP_TALKERS_LIMIT)
+
+    if not talkers:
+        bot.send_message(message.chat.id, "📭 Нет активных подключений")
+        return
+
+    stats_text = "🔥 Топ по скорости сейчас:\n\n"
+
+    for position, (username, sent_rate, received_rate) in enumerate(talkers, 1):
+        user_rates = rates.get_rates(username)
+        if user_rates is None:
+            continue
+        sent_1m, received_1m = user_rates['1m']
+        sent_5m, received_5m = user_rates['5m']
+
+        stats_text += f"{position}. 👤 {username}\n"
+        stats_text += f"   Сейчас: ↑{format_rate(sent_rate)} ↓{format_rate(received_rate)}\n"
+        stats_text += f"   1 мин: ↑{format_rate(sent_1m)} ↓{format_rate(received_1m)}\n"
+        stats_text += f"   5 мин: ↑{format_rate(sent_5m)} ↓{format_rate(received_5m)}\n\n"
+
+    total_sent, total_received = rates.total_rate()
+    stats_text += f"📈 Всего сейчас: ↑{format_rate(total_sent)} ↓{format_rate(total_received)}\n"
+    stats_text += f"🔌 Активных: {len(rates.rings)}"
+
+    bot.send_message(message.chat.id, stats_text)
+
+
+def show_dashboard(message):
+    """Обработчик команды /dashboard: живая панель, которая обновляется сама"""
+    bot = bot_instance
+
+    if bot is None:
+        logger.error("bot_instance не инициализирован в user_handlers")
+        return
+
+    user_id = message.from_user.id
+
+    if not db.is_admin(user_id):
+        bot.send_message(message.chat.id, "⛔ Доступ запрещен")
+        return
+
+    logger.info(f"Команда /dashboard от администратора {user_id}")
+
+    success, error = dashboards.start(bot, message.chat.id, user_id)
+    if not success:
+        bot.send_message(message.chat.id, f"⚠️ {error}")
 
 
 def setup_user_handlers(bot):
@@ -453,6 +640,7 @@ def setup_user_handlers(bot):
                     [types.InlineKeyboardButton("📊 Статистика сервера", callback_data='start_stats')],
                     [types.InlineKeyboardButton("👤 Статистика по пользователям", callback_data='start_userstats')],
                     [types.InlineKeyboardButton("🔌 Активные подключения", callback_data='start_activestats')],
+                    [types.InlineKeyboardButton("🔥 Топ по скорости", callback_data='start_toptalkers')],
                     [types.InlineKeyboardButton("👨‍💻 Панель администратора", callback_data='start_admin')],
                     [types.InlineKeyboardButton("👑 Управление админами", callback_data='start_manage_admins')],
                     [types.InlineKeyboardButton("🗑️ Удалить пользователя", callback_data='start_deleteuser')]
@@ -469,6 +657,7 @@ def setup_user_handlers(bot):
                     [types.InlineKeyboardButton("📊 Статистика сервера", callback_data='start_stats')],
                     [types.InlineKeyboardButton("👤 Статистика по пользователям", callback_data='start_userstats')],
                     [types.InlineKeyboardButton("🔌 Активные подключения", callback_data='start_activestats')],
+                    [types.InlineKeyboardButton("🔥 Топ по скорости", callback_data='start_toptalkers')],
                     [types.InlineKeyboardButton("👨‍💻 Панель администратора", callback_data='start_admin')],
                     [types.InlineKeyboardButton("🗑️ Удалить пользователя", callback_data='start_deleteuser')]
                 ]
@@ -520,7 +709,7 @@ def setup_user_handlers(bot):
 
         bot.send_message(message.chat.id, "🔄 Принудительная синхронизация статистики...")
 
-        active_count, updated_count, disconnected_count = traffic_monitor.update_traffic_stats()
+        active_count, updated_count, disconnected_count = traffic_monitor.update_traffic_stats(force_flush=True)
 
         if active_count > 0 or disconnected_count > 0:
             bot.send_message(message.chat.id, f"✅ Синхронизация завершена.\n"
@@ -534,6 +723,54 @@ def setup_user_handlers(bot):
     def show_active_stats_handler(message):
         show_active_stats(message)
 
+    @bot.message_handler(commands=['toptalkers'])
+    def show_top_talkers_handler(message):
+        show_top_talkers(message)
+
+    @bot.message_handler(commands=['dashboard'])
+    def show_dashboard_handler(message):
+        show_dashboard(message)
+
+    @bot.inline_handler(func=lambda inline_query: True)
+    def inline_user_search(inline_query):
+        """Inline-режим: @бот запрос - поиск пользователей с теми же фильтрами, что у /listusers"""
+        try:
+            if not db.is_admin(inline_query.from_user.id):
+                bot.answer_inline_query(inline_query.id, [], cache_time=Config.SEARCH_INLINE_CACHE_TIME,
+                                        is_personal=True)
+                return
+
+            filters, error = parse_query(inline_query.query)
+            if error:
+                result = types.InlineQueryResultArticle(
+                    id='error', title=f"❌ {error}", description="Нажмите, чтобы отправить справку по поиску",
+                    input_message_content=types.InputTextMessageContent(SEARCH_HELP)
+                )
+                bot.answer_inline_query(inline_query.id, [result], cache_time=Config.SEARCH_INLINE_CACHE_TIME,
+                                        is_personal=True)
+                return
+
+            offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+            users = db.search_users(order_by_name=True, limit=Config.SEARCH_INLINE_LIMIT, offset=offset, **filters)
+
+            results = []
+            for user in users:
+                total_traffic = user.total_bytes_sent + user.total_bytes_received
+                last_seen = user.last_connected[:10] if user.last_connected else "никогда"
+                results.append(types.InlineQueryResultArticle(
+                    id=user.username,
+                    title=f"{'🟢' if user.is_active else '⚪'} {user.username}",
+                    description=f"{user.created_by_username}, трафик {format_bytes(total_traffic)}, был: {last_seen}",
+                    input_message_content=types.InputTextMessageContent(format_user_card(user))
+                ))
+
+            # Следующая порция подгружается, когда пользователь долистает до конца
+            next_offset = str(offset + len(users)) if len(users) == Config.SEARCH_INLINE_LIMIT else ""
+            bot.answer_inline_query(inline_query.id, results, cache_time=Config.SEARCH_INLINE_CACHE_TIME,
+                                    is_personal=True, next_offset=next_offset)
+        except Exception as e:
+            logger.error(f"Ошибка inline-поиска: {str(e)}")
+
     @bot.message_handler(commands=['userstats'])
     def user_stats_handler(message):
         user_stats(message)
@@ -548,38 +785,26 @@ def setup_user_handlers(bot):
 
         logger.info(f"Команда /traffic от администратора {user_id}")
 
-        users = db.get_all_users()
+        # Сортировка по трафику и отбор топ-10 - в SQL
+        users = db.get_user_summaries(order_by_traffic=True, limit=10)
         if not users:
             bot.send_message(message.chat.id, "📭 Нет данных о трафике")
             return
 
-        # Сортируем по трафику
-        users_sorted = sorted(users, key=lambda x: ((x[7] or 0) + (x[8] or 0) if len(x) > 8 else 0), reverse=True)
-
         stats_text = "📊 Общая статистика трафика (Топ-10)\n\n"
         total_traffic_all = 0
 
-        for user in users_sorted[:10]:
-            if len(user) >= 9:
-                username = user[1]
-                total_conn = user[5] or 0
-                sent = user[7] or 0
-                received = user[8] or 0
-                is_active = user[9] if len(user) > 9 else 0
-                last_conn = user[6] if len(user) > 6 else None
-            else:
-                continue
-
-            total_traffic = sent + received
+        for user in users:
+            total_traffic = user.total_bytes_sent + user.total_bytes_received
             total_traffic_all += total_traffic
 
             if total_traffic > 0:
-                status = "🟢" if is_active else "⚪"
-                stats_text += f"{status} {username}:\n"
-                stats_text += f"   • Подключений: {total_conn}\n"
+                status = "🟢" if user.is_active else "⚪"
+                stats_text += f"{status} {user.username}:\n"
+                stats_text += f"   • Подключений: {user.total_connections}\n"
                 stats_text += f"   • Трафик: {format_bytes(total_traffic)}\n"
-                if last_conn:
-                    stats_text += f"   • Активность: {last_conn[:10]}\n"
+                if user.last_connected:
+                    stats_text += f"   • Активность: {user.last_connected[:10]}\n"
                 stats_text += "\n"
 
         stats_text += f"📈 Всего трафика: {format_bytes(total_traffic_all)}"
@@ -623,42 +848,23 @@ def setup_user_handlers(bot):
         logger.info(f"Команда /debugtraffic от администратора {user_id}")
 
         # Получаем сырые данные из ipsec
-        traffic_data = traffic_monitor.parse_ipsec_status()
+        status = traffic_monitor.read_ipsec_status()
+        traffic_data = status.sessions
+
+        if not status.available:
+            bot.send_message(message.chat.id, f"⚠️ Не удалось получить данные ipsec: {status.error}")
+            return
 
         if not traffic_data:
             bot.send_message(message.chat.id, "📭 Нет активных подключений")
             return
 
-        debug_text = "🔧 Отладочная информация о трафика:\n\n"
-
-        for username, data in traffic_data.items():
-            debug_text += f"👤 {username}:\n"
-            debug_text += f"  IP: {data['client_ip']}\n"
-            debug_text += f"  Connection ID: {data['connection_id']}\n"
-            debug_text += f"  Абсолютные значения из ipsec:\n"
-            debug_text += f"    • Отправлено: {data['absolute_sent']:,} bytes ({data['absolute_sent'] / 1024 / 1024:.1f} MB)\n"
-            debug_text += f"    • Получено: {data['absolute_received']:,} bytes ({data['absolute_received'] / 1024 / 1024:.1f} MB)\n"
-
-            # Получаем базовые значения
-            base = traffic_monitor.get_base_traffic(username)
-            debug_text += f"  Базовые значения:\n"
-            debug_text += f"    • Отправлено: {base['sent']:,} bytes\n"
-            debug_text += f"    • Получено: {base['received']:,} bytes\n"
-
-            # Вычисляем разницу
-            sent_diff = max(0, data['absolute_sent'] - base['sent'])
-            received_diff = max(0, data['absolute_received'] - base['received'])
-            debug_text += f"  Разница (будет добавлено):\n"
-            debug_text += f"    • Отправлено: +{sent_diff:,} bytes (+{sent_diff / 1024 / 1024:.1f} MB)\n"
-            debug_text += f"    • Получено: +{received_diff:,} bytes (+{received_diff / 1024 / 1024:.1f} MB)\n\n"
-
-        # Разбиваем если слишком длинное
-        if len(debug_text) > 4000:
-            parts = split_message(debug_text)
-            for i, part in enumerate(parts):
-                if i == 0:
-                    bot.send_message(message.chat.id, f"```{part}```", parse_mode='Markdown')
-                else:
-                    bot.send_message(message.chat.id, f"```{part}```", parse_mode='Markdown')
-        else:
-            bot.send_message(message.chat.id, f"```{debug_text}```", parse_mode='Markdown')
+        report = ReportBuilder(
+            "🔧 Отладочная информация о трафика:\n\n", "debugtraffic",
+            columns=('username', 'client_ip', 'connection_id', 'absolute_sent', 'absolute_received',
+                     'base_sent', 'base_received', 'sent_diff', 'received_diff'),
+            code=True
+        )
+        report.extend(iter_debug_traffic(traffic_data))
+        if not report.send(bot, message.chat.id):
+            bot.send_message(message.chat.id, "❌ Не удалось отправить отчет")
@@ -82,6 +82,17 @@ read_env_value() {
   grep -E "^${key}=" "$file" 2>/dev/null | tail -n 1 | cut -d'=' -f2-
 }
 
+set_env_value() {
+  local key="$1"
+  local value="$2"
+  local file="$3"
+  if grep -qE "^${key}=" "$file" 2>/dev/null; then
+    sed -i "s|^${key}=.*|${key}=${value}|" "$file"
+  else
+    echo "${key}=${value}" >> "$file"
+  fi
+}
+
 fetch_file() {
   local url="$1"
   local out="$2"
@@ -145,6 +156,7 @@ if [[ -d "$PROJECT_DIR" ]]; then
   cp -a "$PROJECT_DIR/users.db-shm" "$PRESERVE_DIR/" 2>/dev/null || true
   cp -a "$PROJECT_DIR/users.db-wal" "$PRESERVE_DIR/" 2>/dev/null || true
   cp -a "$PROJECT_DIR/bacup_database" "$PRESERVE_DIR/" 2>/dev/null || true
+  cp -a "$PROJECT_DIR/archive" "$PRESERVE_DIR/" 2>/dev/null || true
 fi
 
 mkdir -p "$PROJECT_DIR"
@@ -159,6 +171,10 @@ if [[ -d "$PRESERVE_DIR/bacup_database" ]]; then
   rm -rf "$PROJECT_DIR/bacup_database"
   cp -a "$PRESERVE_DIR/bacup_database" "$PROJECT_DIR/"
 fi
+if [[ -d "$PRESERVE_DIR/archive" ]]; then
+  rm -rf "$PROJECT_DIR/archive"
+  cp -a "$PRESERVE_DIR/archive" "$PROJECT_DIR/"
+fi
 
 rm -rf "$TMP_DIR"
 echo "Project prepared in: $PROJECT_DIR"
@@ -196,6 +212,65 @@ EOF
   echo ".env saved: $ENV_FILE"
 fi
 
+# Режим приема обновлений: long polling (по умолчанию) или webhook.
+CURRENT_BOT_MODE="$(read_env_value "BOT_MODE" "$ENV_FILE")"
+WEBHOOK_DEFAULT="n"
+if [[ "${CURRENT_BOT_MODE:-polling}" == "webhook" ]]; then
+  WEBHOOK_DEFAULT="y"
+fi
+
+if ask_yes_no "Receive Telegram updates via webhook instead of long polling?" "$WEBHOOK_DEFAULT"; then
+  echo "Telegram accepts webhooks only on ports 443, 80, 88 and 8443."
+  CURRENT_WEBHOOK_URL="$(read_env_value "WEBHOOK_URL" "$ENV_FILE")"
+  if [[ -n "${CURRENT_WEBHOOK_URL:-}" ]]; then
+    WEBHOOK_URL_VALUE="$(ask_with_default "Public HTTPS URL of this server" "$CURRENT_WEBHOOK_URL")"
+  else
+    WEBHOOK_URL_VALUE="$(ask_non_empty "Public HTTPS URL of this server (e.g. https://vpn.example.com)")"
+  fi
+
+  WEBHOOK_SSL_CERT_VALUE=""
+  WEBHOOK_SSL_KEY_VALUE=""
+  WEBHOOK_UPLOAD_CERT_VALUE="0"
+  if ask_yes_no "Is TLS terminated by a local reverse proxy (nginx/caddy) in front of the bot?" "y"; then
+    WEBHOOK_LISTEN_VALUE="127.0.0.1"
+    WEBHOOK_PORT_VALUE="$(ask_with_default "Local port for the bot webhook listener" "8443")"
+  else
+    WEBHOOK_LISTEN_VALUE="0.0.0.0"
+    WEBHOOK_PORT_VALUE="$(ask_with_default "Port for the bot HTTPS listener (443/80/88/8443)" "8443")"
+    WEBHOOK_SSL_CERT_VALUE="$(ask_non_empty "Path to TLS certificate (PEM)")"
+    WEBHOOK_SSL_KEY_VALUE="$(ask_non_empty "Path to TLS private key (PEM)")"
+    if ask_yes_no "Is the certificate self-signed?" "n"; then
+      WEBHOOK_UPLOAD_CERT_VALUE="1"
+    fi
+  fi
+
+  WEBHOOK_SECRET_VALUE="$(read_env_value "WEBHOOK_SECRET" "$ENV_FILE")"
+  if [[ -z "${WEBHOOK_SECRET_VALUE:-}" ]]; then
+    WEBHOOK_SECRET_VALUE="$(python3 -c 'import secrets; print(secrets.token_hex(24))')"
+  fi
+
+  set_env_value "BOT_MODE" "webhook" "$ENV_FILE"
+  set_env_value "WEBHOOK_URL" "$WEBHOOK_URL_VALUE" "$ENV_FILE"
+  set_env_value "WEBHOOK_LISTEN" "$WEBHOOK_LISTEN_VALUE" "$ENV_FILE"
+  set_env_value "WEBHOOK_PORT" "$WEBHOOK_PORT_VALUE" "$ENV_FILE"
+  set_env_value "WEBHOOK_SECRET" "$WEBHOOK_SECRET_VALUE" "$ENV_FILE"
+  set_env_value "WEBHOOK_SSL_CERT" "$WEBHOOK_SSL_CERT_VALUE" "$ENV_FILE"
+  set_env_value "WEBHOOK_SSL_KEY" "$WEBHOOK_SSL_KEY_VALUE" "$ENV_FILE"
+  set_env_value "WEBHOOK_UPLOAD_CERT" "$WEBHOOK_UPLOAD_CERT_VALUE" "$ENV_FILE"
+  chmod 600 "$ENV_FILE"
+
+  if [[ "$WEBHOOK_LISTEN_VALUE" == "127.0.0.1" ]]; then
+    echo "Webhook mode enabled. Proxy this location to the bot, e.g. for nginx:"
+    echo "  location /telegram/webhook { proxy_pass http://127.0.0.1:${WEBHOOK_PORT_VALUE}; }"
+  else
+    echo "Webhook mode enabled on port ${WEBHOOK_PORT_VALUE}. Make sure it is open in the firewall."
+  fi
+else
+  if [[ -f "$ENV_FILE" ]]; then
+    set_env_value "BOT_MODE" "polling" "$ENV_FILE"
+  fi
+fi
+
 SUPER_ADMIN_ID_VALUE="$(read_env_value "SUPER_ADMIN_ID" "$ENV_FILE")"
 if [[ -z "${SUPER_ADMIN_ID_VALUE:-}" || ! "$SUPER_ADMIN_ID_VALUE" =~ ^[0-9]+$ ]]; then
   SUPER_ADMIN_ID_VALUE="149999149"
@@ -0,0 +1,249 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+from metrics import metrics
+from utils import format_bytes, format_rate
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых сообщение панели больше нельзя править
+GONE_ERRORS = ("message to edit not found", "message can't be edited", "chat not found",
+               "bot was blocked", "user is deactivated")
+
+
+class LiveDashboards:
+    """Живые панели: одно сообщение на чат, которое бот правит по данным последнего тика монитора.
+
+    Панель перерисовывается не чаще DASHBOARD_INTERVAL и только после нового тика,
+    а правка уходит в Telegram, только если текст действительно изменился. Панели
+    останавливаются сами через DASHBOARD_IDLE_TIMEOUT без действий администратора.
+    """
+
+    def __init__(self):
+        self.panels = {}  # {chat_id: {'message_id', 'user_id', 'expires_at', 'tick', 'body', 'next_edit_at'}}
+        self.starting = set()  # чаты, для которых панель отправляется прямо сейчас (место уже занято)
+        self.bot = None
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.edits_count = 0
+        self.skipped_count = 0
+
+    def start(self, bot, chat_id, user_id):
+        """Запускает панель в чате; возвращает (успех, сообщение об ошибке)"""
+        # Место под панель занимается до отправки сообщения: параллельные /dashboard
+        # из разных чатов не должны превысить DASHBOARD_MAX_ACTIVE
+        with self.lock:
+            if chat_id in self.starting:
+                return False, "Панель в этом чате уже запускается"
+            old = self.panels.get(chat_id)
+            active = len(self.panels) + len(self.starting)
+            if old is None and active >= Config.DASHBOARD_MAX_ACTIVE:
+                return False, f"Уже работает {active} панелей (максимум {Config.DASHBOARD_MAX_ACTIVE})"
+            self.starting.add(chat_id)
+
+        try:
+            if old is not None:
+                # В чате остается одна панель: старое сообщение замораживается
+                self.stop(chat_id, "⏹ Панель перезапущена ниже")
+
+            body = self._render_body()
+            expires_at = time.time() + Config.DASHBOARD_IDLE_TIMEOUT
+            sent = bot.send_message(chat_id, self._compose(body, expires_at), reply_markup=self._markup()).wait()
+            message_id = sent.message_id
+        except Exception as e:
+            with self.lock:
+                self.starting.discard(chat_id)
+            logger.error(f"Ошибка отправки живой панели: {str(e)}")
+            return False, "Не удалось отправить сообщение панели"
+
+        with self.lock:
+            self.starting.discard(chat_id)
+            self.bot = bot
+            self.panels[chat_id] = {
+                'message_id': message_id,
+                'user_id': user_id,
+                'expires_at': expires_at,
+                'tick': self._current_tick(),
+                'body': body,
+                'next_edit_at': time.time() + Config.DASHBOARD_INTERVAL
+            }
+            metrics.set('vpnbot_dashboards_active', len(self.panels))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, daemon=True, name="LiveDashboards")
+                self.thread.start()
+
+        logger.info(f"Живая панель запущена в чате {chat_id} администратором {user_id}")
+        return True, None
+
+    def extend(self, chat_id, message_id):
+        """Продлевает панель; возвращает новое время остановки или None, если панели нет"""
+        with self.lock:
+            panel = self.panels.get(chat_id)
+            if panel is None or panel['message_id'] != message_id:
+                return None
+            panel['expires_at'] = time.time() + Config.DASHBOARD_IDLE_TIMEOUT
+            # Время остановки в подписи изменилось - перерисовать при ближайшем проходе
+            panel['body'] = None
+            panel['next_edit_at'] = 0
+        self.wakeup.set()
+        return panel['expires_at']
+
+    def stop(self, chat_id, reason="⏹ Панель остановлена", message_id=None):
+        """Останавливает панель и оставляет в сообщении последние данные"""
+        with self.lock:
+            panel = self.panels.get(chat_id)
+            if panel is None or (message_id is not None and panel['message_id'] != message_id):
+                return False
+            del self.panels[chat_id]
+            metrics.set('vpnbot_dashboards_active', len(self.panels))
+            bot = self.bot
+
+        body = panel['body'] or self._render_body()
+        try:
+            bot.edit_message_text(chat_id=chat_id, message_id=panel['message_id'], text=f"{body}\n\n{reason}")
+        except Exception as e:
+            logger.debug(f"Не удалось отметить остановку панели в чате {chat_id}: {str(e)}")
+        logger.info(f"Живая панель в чате {chat_id} остановлена: {reason}")
+        return True
+
+    @staticmethod
+    def _current_tick():
+        from traffic_monitor import traffic_monitor
+        return traffic_monitor.last_sessions_time, traffic_monitor.ipsec_error
+
+    @staticmethod
+    def _render_body():
+        """Текст панели без времени: по нему решается, нужна ли правка"""
+        from traffic_monitor import traffic_monitor
+
+        sessions = traffic_monitor.last_sessions
+        rates = traffic_monitor.rates
+        total_sent, total_received = rates.total_rate()
+
+        text = "📡 Живая панель\n\n"
+        if traffic_monitor.ipsec_error:
+            text += f"⚠️ ipsec недоступен: {traffic_monitor.ipsec_error}\n"
+        text += f"🔌 Активных: {len(sessions)}\n"
+        text += f"📈 Сейчас: ↑{format_rate(total_sent)} ↓{format_rate(total_received)}\n"
+
+        talkers = rates.top_talkers(Config.DASHBOARD_TOP_USERS)
+        if talkers:
+            text += "\n🔥 Топ по скорости:\n"
+            for position, (username, sent_rate, received_rate) in enumerate(talkers, 1):
+                text += f"{position}. {username}: ↑{format_rate(sent_rate)} ↓{format_rate(received_rate)}"
+                session = sessions.get(username)
+                if session:
+                    text += f", за сессию {format_bytes(session['absolute_sent'] + session['absolute_received'])}"
+                text += "\n"
+        return text.rstrip()
+
+    @staticmethod
+    def _compose(body, expires_at):
+        from traffic_monitor import traffic_monitor
+        tick_time = traffic_monitor.last_sessions_time
+        updated = datetime.fromtimestamp(tick_time).strftime('%H:%M:%S') if tick_time else "—"
+        return (f"{body}\n\n🕒 Данные на {updated}, обновление не чаще раза в {Config.DASHBOARD_INTERVAL} сек\n"
+                f"⏳ Автоостановка в {datetime.fromtimestamp(expires_at).strftime('%H:%M')}")
+
+    @staticmethod
+    def _markup():
+        markup = types.InlineKeyboardMarkup()
+        markup.row(
+            types.InlineKeyboardButton("⏳ Продлить", callback_data='dashboard_extend'),
+            types.InlineKeyboardButton("⏹ Остановить", callback_data='dashboard_stop')
+        )
+        return markup
+
+    def _loop(self):
+        while True:
+            self.wakeup.wait(Config.DASHBOARD_INTERVAL)
+            self.wakeup.clear()
+            with self.lock:
+                if not self.panels:
+                    self.thread = None
+                    return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка обновления живых панелей: {str(e)}")
+
+    def refresh(self):
+        """Один проход: останавливает просроченные панели и правит те, у которых изменился текст"""
+        now = time.time()
+        tick = self._current_tick()
+
+        with self.lock:
+            expired = [chat_id for chat_id, panel in self.panels.items() if now >= panel['expires_at']]
+            due = [(chat_id, dict(panel)) for chat_id, panel in self.panels.items()
+                   if chat_id not in expired and now >= panel['next_edit_at']
+                   and (panel['tick'] != tick or panel['body'] is None)]
+            bot = self.bot
+
+        for chat_id in expired:
+            self.stop(chat_id, "⏹ Панель остановлена: нет активности")
+
+        if not due:
+            return
+
+        # Текст один для всех панелей - рисуется один раз за проход
+        body = self._render_body()
+        for chat_id, panel in due:
+            if body == panel['body']:
+                self.skipped_count += 1
+                metrics.inc('vpnbot_dashboard_updates_total', result='unchanged')
+                self._update_panel(chat_id, panel['message_id'], tick=tick)
+                continue
+
+            next_edit_at = time.time() + Config.DASHBOARD_INTERVAL
+            try:
+                bot.edit_message_text(chat_id=chat_id, message_id=panel['message_id'],
+                                      text=self._compose(body, panel['expires_at']), reply_markup=self._markup())
+            except ApiTelegramException as e:
+                error_msg = str(e)
+                if "message is not modified" not in error_msg:
+                    metrics.inc('vpnbot_dashboard_updates_total', result='error')
+                    if any(error in error_msg for error in GONE_ERRORS) or e.error_code == 403:
+                        with self.lock:
+                            self.panels.pop(chat_id, None)
+                            metrics.set('vpnbot_dashboards_active', len(self.panels))
+                        logger.info(f"Живая панель в чате {chat_id} снята: {error_msg}")
+                        continue
+                    if e.error_code == 429:
+                        retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 0)
+                        next_edit_at = time.time() + max(retry_after, Config.DASHBOARD_INTERVAL)
+                    logger.warning(f"Ошибка правки живой панели в чате {chat_id}: {error_msg}")
+                    self._update_panel(chat_id, panel['message_id'], next_edit_at=next_edit_at)
+                    continue
+            except Exception as e:
+                metrics.inc('vpnbot_dashboard_updates_total', result='error')
+                logger.warning(f"Ошибка правки живой панели в чате {chat_id}: {str(e)}")
+                self._update_panel(chat_id, panel['message_id'], next_edit_at=next_edit_at)
+                continue
+
+            self.edits_count += 1
+            metrics.inc('vpnbot_dashboard_updates_total', result='edited')
+            self._update_panel(chat_id, panel['message_id'], tick=tick, body=body, next_edit_at=next_edit_at)
+
+    def _update_panel(self, chat_id, message_id, **fields):
+        with self.lock:
+            panel = self.panels.get(chat_id)
+            # Панель могли остановить или перезапустить, пока шла правка
+            if panel is not None and panel['message_id'] == message_id:
+                panel.update(fields)
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "active": len(self.panels),
+                "edits": self.edits_count,
+                "skipped": self.skipped_count
+            }
+
+
+# Глобальный менеджер живых панелей
+dashboards = LiveDashboards()
@@ -1,6 +1,7 @@
 import os
 import sys
 import atexit
+import time
 import logging
 import telebot
 from pathlib import Path
@@ -12,6 +13,11 @@ from config import Config
 from database import db
 from vpn_manager import vpn_manager
 from traffic_monitor import traffic_monitor
+from metrics import instrument_bot, start_metrics_server
+from alerts import alerts
+from send_queue import send_queue
+from dispatcher import dispatcher
+from webhook import run_webhook
 
 # Импортируем обработчики
 from handlers.user_handlers import setup_user_handlers
@@ -34,6 +40,9 @@ logger = logging.getLogger(__name__)
 def check_single_instance():
     """Проверка единственного экземпляра"""
     lock_file = '/tmp/vpn_bot.lock'
+    if Config.FLEET_ROLE != 'standalone':
+        # Агент и агрегатор могут работать на одной машине (и несколько агентов - для проверки)
+        lock_file = f'/tmp/vpn_bot-{Config.FLEET_ROLE}-{Config.FLEET_NODE_ID}.lock'
 
     if os.path.exists(lock_file):
         try:
@@ -71,6 +80,30 @@ def check_single_instance():
     return cleanup
 
 
+def run_fleet_agent(cleanup):
+    """Узел флота: мониторинг и отправка дельт агрегатору, без Telegram бота"""
+    from fleet import agent
+
+    start_metrics_server()
+    agent.start()
+    traffic_monitor.start_monitoring()
+
+    print("=" * 60)
+    print(f"🛰️  Агент флота {Config.FLEET_NODE_ID} запущен")
+    print(f"📡 Агрегатор: {Config.FLEET_AGGREGATOR_URL}")
+    print(f"🔌 Команды агрегатора: {Config.FLEET_LISTEN_HOST}:{Config.FLEET_LISTEN_PORT}")
+    print(f"🗄️  База данных: {Config.DB_PATH}")
+    print(f"⏱️  Мониторинг: каждые {Config.STATS_UPDATE_INTERVAL} секунд")
+    print("=" * 60)
+
+    try:
+        # Остановка - по SIGINT/SIGTERM через graceful_shutdown монитора
+        while True:
+            time.sleep(3600)
+    finally:
+        cleanup()
+
+
 def main():
     """Основная функция запуска бота"""
 
@@ -80,6 +113,14 @@ def main():
     # Проверка единственного экземпляра
     cleanup = check_single_instance()
 
+    # Перевод старой БД в режим incremental vacuum - один раз и до старта монитора
+    if not db.enable_incremental_vacuum():
+        logger.warning("Incremental vacuum недоступен, обслуживание БД выполняет только checkpoint")
+
+    if Config.FLEET_ROLE == 'agent':
+        run_fleet_agent(cleanup)
+        return
+
     # Проверка токена бота
     if not Config.BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN не установлен в переменных окружения")
@@ -137,6 +178,25 @@ def main():
         else:
             bot.send_message(message.chat.id, "⛔ У вас нет доступа")
 
+    # Все исходящие сообщения идут через очередь с лимитами Telegram
+    send_queue.install(bot)
+
+    # Обработчики выполняются параллельно, но обновления одного чата - строго по порядку
+    dispatcher.install(bot)
+
+    # Метрики (ничего не делает, если METRICS_ENABLED не задан)
+    instrument_bot(bot)
+    start_metrics_server()
+
+    # Предупреждения о превышении квот и оповещения уходят администраторам в Telegram
+    traffic_monitor.quotas.set_notifier(lambda chat_id, text: bot.send_message(chat_id, text))
+    alerts.set_notifier(lambda chat_id, text: bot.send_message(chat_id, text))
+
+    # Агрегатор принимает данные узлов; монитор у него только обслуживает БД
+    if Config.FLEET_ROLE == 'aggregator':
+        from fleet import aggregator
+        aggregator.start()
+
     # Запуск мониторинга трафика
     traffic_monitor.start_monitoring()
 
@@ -145,8 +205,10 @@ def main():
     print("🚀 VPN Manager Bot запущен!")
     print(f"📁 Конфигурации: {Config.VPN_PROFILES_PATH}")
     print(f"👑 Супер-админ ID: {Config.SUPER_ADMIN_ID}")
-    print(f"🗄️  База данных: {Config.DB_PATH}")
+    print(f"🗄️  База данных: {'PostgreSQL' if Config.STORAGE_BACKEND == 'postgres' else Config.DB_PATH}")
     print(f"💾 Директория бэкапов: {Config.BACKUP_DIR}")
+    print(f"📡 Прием обновлений: {Config.BOT_MODE}")
+    print(f"🛰️  Роль во флоте: {Config.FLEET_ROLE}")
     print(f"⏱️  Мониторинг: каждые {Config.STATS_UPDATE_INTERVAL} секунд")
     print(f"🧹 Очистка сессий: каждые {Config.SESSION_CLEANUP_INTERVAL} секунд")
     print(f"📈 Хранение бэкапов: {Config.BACKUP_RETENTION_DAYS} дней")
@@ -162,8 +224,17 @@ def main():
 
     # Запуск бота
     try:
-        logger.info("Запуск polling бота...")
-        bot.polling(none_stop=True, interval=1, timeout=30, skip_pending=True)
+        if Config.BOT_MODE == 'webhook':
+            logger.info("Запуск бота в режиме webhook...")
+            run_webhook(bot)
+        else:
+            logger.info("Запуск polling бота...")
+            # Если раньше был включен webhook, getUpdates без его удаления не работает
+            try:
+                bot.remove_webhook()
+            except Exception as e:
+                logger.warning(f"Не удалось снять webhook (если он не был установлен, polling работает): {str(e)}")
+            bot.polling(none_stop=True, interval=0, timeout=30, long_polling_timeout=25, skip_pending=True)
     except Exception as e:
         logger.critical(f"Критическая ошибка бота: {str(e)}")
         print(f"❌ Критическая ошибка: {str(e)}")
@@ -0,0 +1,239 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_NULL_TIMER = nullcontext()
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    parts = []
+    for name, value in items:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class MetricsRegistry:
+    """Минимальный реестр метрик в формате Prometheus/OpenMetrics без внешних зависимостей.
+
+    При выключенных метриках все методы записи сразу возвращаются.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.help = {}
+        self.types = {}
+        self.counters = {}  # {name: {label_key: value}}
+        self.gauges = {}  # {name: {label_key: value}}
+        self.histograms = {}  # {name: {label_key: [bucket_counts, sum, count]}}
+        self.buckets = {}
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self.types[name] = metric_type
+        self.help[name] = help_text
+        if metric_type == 'histogram':
+            self.buckets[name] = tuple(buckets or DEFAULT_BUCKETS)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+        key = _label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            data = series.get(key)
+            if data is None:
+                data = series[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data[0][i] += 1
+            data[1] += value
+            data[2] += 1
+
+    @contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timer(self, name, **labels):
+        """Контекстный менеджер для замера длительности в гистограмму"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(name, labels)
+
+    def render(self):
+        """Текст экспозиции Prometheus"""
+        lines = []
+        with self.lock:
+            for kind, storage in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(storage):
+                    lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for key, value in storage[name].items():
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+
+            for name in sorted(self.histograms):
+                buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+                lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, (counts, total, count) in self.histograms[name].items():
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(enabled=Config.METRICS_ENABLED)
+
+metrics.describe('vpnbot_tick_duration_seconds', 'histogram', 'Длительность тика мониторинга')
+metrics.describe('vpnbot_tick_phase_seconds', 'histogram', 'Длительность фаз тика мониторинга')
+metrics.describe('vpnbot_active_sessions', 'gauge', 'Активные сессии по данным ipsec')
+metrics.describe('vpnbot_pending_traffic_users', 'gauge', 'Пользователи с дельтами, не записанными в БД')
+metrics.describe('vpnbot_traffic_bytes_per_second', 'gauge', 'Суммарная скорость трафика за последний тик')
+metrics.describe('vpnbot_traffic_bytes_total', 'counter', 'Учтенный трафик')
+metrics.describe('vpnbot_disconnects_total', 'counter', 'Обнаруженные отключения')
+metrics.describe('vpnbot_ipsec_errors_total', 'counter', 'Ошибки вызова ipsec trafficstatus')
+metrics.describe('vpnbot_sqlite_commit_seconds', 'histogram', 'Длительность commit в SQLite')
+metrics.describe('vpnbot_postgres_commit_seconds', 'histogram', 'Длительность commit в PostgreSQL')
+metrics.describe('vpnbot_postgres_copy_rows_total', 'counter', 'Дельты трафика, загруженные через COPY')
+metrics.describe('vpnbot_handler_seconds', 'histogram', 'Длительность обработчиков бота')
+metrics.describe('vpnbot_handler_errors_total', 'counter', 'Исключения в обработчиках бота')
+metrics.describe('vpnbot_telegram_api_seconds', 'histogram', 'Длительность вызовов Telegram Bot API')
+metrics.describe('vpnbot_telegram_api_errors_total', 'counter', 'Ошибки вызовов Telegram Bot API')
+metrics.describe('vpnbot_alerts_total', 'counter', 'Поднятые оповещения')
+metrics.describe('vpnbot_send_queue_depth', 'gauge', 'Сообщения в очереди отправки')
+metrics.describe('vpnbot_send_latency_seconds', 'histogram', 'Время от постановки в очередь до отправки')
+metrics.describe('vpnbot_send_retries_total', 'counter', 'Повторы отправки после 429')
+metrics.describe('vpnbot_send_coalesced_total', 'counter', 'Сообщения, склеенные с соседними')
+metrics.describe('vpnbot_send_errors_total', 'counter', 'Ошибки отправки сообщений')
+metrics.describe('vpnbot_webhook_updates_total', 'counter', 'Обновления, принятые через webhook')
+metrics.describe('vpnbot_dispatch_queue_depth', 'gauge', 'Обновления, ожидающие обработчика')
+metrics.describe('vpnbot_dispatch_wait_seconds', 'histogram', 'Ожидание обновления в очереди чата')
+metrics.describe('vpnbot_handler_timeouts_total', 'counter', 'Обработчики, превысившие таймаут')
+metrics.describe('vpnbot_render_cache_total', 'counter', 'Обращения к кэшу отрисованных страниц')
+metrics.describe('vpnbot_dashboards_active', 'gauge', 'Работающие живые панели')
+metrics.describe('vpnbot_dashboard_updates_total', 'counter', 'Проходы обновления живых панелей')
+metrics.describe('vpnbot_user_search_seconds', 'histogram', 'Время поиска пользователей в БД',
+                 buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25))
+metrics.describe('vpnbot_fleet_push_seconds', 'histogram', 'Длительность отправки данных агентом агрегатору')
+metrics.describe('vpnbot_fleet_push_bytes_total', 'counter', 'Объем отправок агента агрегатору')
+metrics.describe('vpnbot_fleet_push_errors_total', 'counter', 'Неудачные отправки агента агрегатору')
+metrics.describe('vpnbot_fleet_pushes_total', 'counter', 'Отправки узлов, принятые агрегатором')
+metrics.describe('vpnbot_fleet_ticks_total', 'counter', 'Тики узлов, учтенные агрегатором')
+
+
+def _handler_label(handler):
+    commands = handler.get('filters', {}).get('commands')
+    if commands:
+        return "/" + commands[0]
+    return getattr(handler['function'], '__name__', 'handler')
+
+
+def _wrap_handler(function, label):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            metrics.inc('vpnbot_handler_errors_total', handler=label)
+            raise
+        finally:
+            metrics.observe('vpnbot_handler_seconds', time.perf_counter() - start, handler=label)
+
+    wrapper.__name__ = getattr(function, '__name__', 'handler')
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def instrument_bot(bot):
+    """Оборачивает зарегистрированные обработчики и вызовы Bot API замерами времени"""
+    if not metrics.enabled:
+        return
+
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            handler['function'] = _wrap_handler(handler['function'], _handler_label(handler))
+
+    from telebot import apihelper
+    original_make_request = apihelper._make_request
+
+    def timed_make_request(token, method_name, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original_make_request(token, method_name, *args, **kwargs)
+        except Exception:
+            metrics.inc('vpnbot_telegram_api_errors_total', method=method_name)
+            raise
+        finally:
+            metrics.observe('vpnbot_telegram_api_seconds', time.perf_counter() - start, method=method_name)
+
+    apihelper._make_request = timed_make_request
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics: {format % args}")
+
+
+def start_metrics_server():
+    """Запускает HTTP-эндпоинт /metrics в отдельном потоке (только если метрики включены)"""
+    if not metrics.enabled:
+        return None
+
+    try:
+        server = ThreadingHTTPServer((Config.METRICS_HOST, Config.METRICS_PORT), MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик: {str(e)}")
+        return None
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name="MetricsServer")
+    thread.start()
+    logger.info(f"Метрики доступны на http://{Config.METRICS_HOST}:{Config.METRICS_PORT}/metrics")
+    return server
@@ -0,0 +1,1269 @@
+import io
+import re
+import time
+import gzip
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from metrics import metrics
+from storage import Storage, UserRow, UserSummary, UserStatus, USER_SUMMARY_COLUMNS, EXPORT_TABLES
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+if psycopg2 is not None:
+    # Даты и время возвращаются строками, как из SQLite (обработчики режут их срезами [:10])
+    TEXT_DATES = psycopg2.extensions.new_type((1082, 1114, 1184), 'TEXT_DATES', lambda value, cursor: value)
+
+logger = logging.getLogger(__name__)
+
+# Соединения работают в UTC, время пишется с точностью до секунды: строки
+# 'YYYY-MM-DD HH:MM:SS' совпадают с CURRENT_TIMESTAMP в SQLite
+NOW = "LOCALTIMESTAMP(0)"
+CONNECTION_OPTIONS = "-c timezone=UTC -c datestyle=ISO -c client_min_messages=warning"
+
+INTEGER_TYPES = (20, 21, 23)  # bigint, smallint, integer
+
+# Порядок таблиц в полном бэкапе и столбцы id, чьи последовательности сдвигаются после восстановления
+BACKUP_TABLES = ('users', 'admins', 'user_stats', 'traffic_log', 'active_sessions', 'session_backup',
+                 'monitor_state', 'user_stats_daily', 'fleet_nodes', 'user_nodes')
+SERIAL_TABLES = ('users', 'admins', 'user_stats', 'traffic_log', 'active_sessions', 'session_backup',
+                 'user_stats_daily')
+BACKUP_HEADER = "-- vpnbot pgcopy 1\n"
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_line(row):
+    return '\t'.join('\\N' if value is None else str(value).translate(COPY_ESCAPES) for value in row) + '\n'
+
+
+def _like_escape(value):
+    return re.sub(r'([%_\\])', r'\\\1', value)
+
+
+class _CopySection:
+    """Файл для copy_expert: строки одной таблицы из бэкапа до маркера конца данных"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def read(self, size=-1):
+        line = self.source.readline()
+        if not line:
+            raise ValueError("бэкап обрывается внутри таблицы")
+        return '' if line == '\\.\n' else line
+
+    readline = read
+
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL: пул соединений, дельты трафика грузятся через COPY.
+
+    Каждый публичный метод - транзакция на соединении из пула; вложенные вызовы
+    (finalize_session внутри finalize_sessions и т.п.) идут в ту же транзакцию
+    через SAVEPOINT. Флаг commit=False у отдельных методов здесь не нужен: запись
+    фиксируется при выходе из внешней транзакции.
+    """
+
+    BACKUP_SUFFIX = '.pgcopy.gz'
+
+    def __init__(self, dsn=None):
+        super().__init__()
+        if psycopg2 is None:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres нужен psycopg2 (pip install psycopg2-binary)")
+        self.dsn = dsn or Config.POSTGRES_DSN
+        if not self.dsn:
+            raise ValueError("Не задан POSTGRES_DSN")
+        self.local = threading.local()
+        self.pool = psycopg2.pool.ThreadedConnectionPool(Config.POSTGRES_POOL_MIN, Config.POSTGRES_POOL_MAX,
+                                                         self.dsn, options=CONNECTION_OPTIONS)
+        logger.info(f"Пул соединений PostgreSQL создан ({Config.POSTGRES_POOL_MIN}-{Config.POSTGRES_POOL_MAX})")
+        self._create_tables()
+
+    # ========== СОЕДИНЕНИЯ И ТРАНЗАКЦИИ ==========
+
+    def _getconn(self):
+        conn = self.pool.getconn()
+        psycopg2.extensions.register_type(TEXT_DATES, conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Курсор в транзакции потока: внешний вызов делает commit/rollback, вложенные - SAVEPOINT"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            with conn.cursor() as cursor:
+                cursor.execute("SAVEPOINT nested")
+                try:
+                    yield cursor
+                except Exception:
+                    cursor.execute("ROLLBACK TO SAVEPOINT nested")
+                    raise
+                cursor.execute("RELEASE SAVEPOINT nested")
+            return
+
+        conn = self._getconn()
+        self.local.conn = conn
+        broken = False
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            with metrics.timer('vpnbot_postgres_commit_seconds'):
+                conn.commit()
+        except Exception as e:
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.local.conn = None
+            # Оборванное соединение пул закрывает, следующий getconn откроет новое
+            self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def _fetchall(self, query, params=()):
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def _fetchone(self, query, params=()):
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+    def _execute(self, query, params=()):
+        """Выполняет запрос в своей транзакции; возвращает число затронутых строк"""
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.rowcount
+
+    def fetch_rows(self, row_class, query, params=()):
+        """Выполняет запрос; строки результата - экземпляры row_class (namedtuple)"""
+        make = row_class._make
+        return [make(row) for row in self._fetchall(query, params)]
+
+    def close(self):
+        self.pool.closeall()
+
+    def _create_tables(self):
+        """Создание всех необходимых таблиц"""
+        try:
+            with self.transaction() as cursor:
+                # Счетчики трафика обновляются каждый тик: запас места на страницах (fillfactor)
+                # дает HOT-обновления без записи во все индексы users
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS users (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  username TEXT UNIQUE NOT NULL,
+                                  created_by BIGINT NOT NULL,
+                                  created_by_username TEXT NOT NULL,
+                                  created_at TIMESTAMP(0) DEFAULT {NOW},
+                                  total_connections INTEGER DEFAULT 0,
+                                  last_connected TIMESTAMP(0),
+                                  total_bytes_sent BIGINT DEFAULT 0,
+                                  total_bytes_received BIGINT DEFAULT 0,
+                                  is_active SMALLINT DEFAULT 0,
+                                  last_updated TIMESTAMP(0) DEFAULT {NOW},
+                                  quota_daily BIGINT DEFAULT 0,
+                                  quota_monthly BIGINT DEFAULT 0,
+                                  quota_total BIGINT DEFAULT 0,
+                                  quota_action TEXT DEFAULT 'warn'
+                               ) WITH (fillfactor = 70)''')
+
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS admins (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  user_id BIGINT UNIQUE NOT NULL,
+                                  username TEXT NOT NULL,
+                                  added_by BIGINT NOT NULL,
+                                  added_at TIMESTAMP(0) DEFAULT {NOW}
+                               )''')
+
+                # Гарантированно добавляем супер-админа при каждом старте
+                cursor.execute('''INSERT INTO admins (user_id, username, added_by) VALUES (%s, %s, %s)
+                                  ON CONFLICT (user_id) DO NOTHING''',
+                               (Config.SUPER_ADMIN_ID, "Супер-админ", Config.SUPER_ADMIN_ID))
+
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS user_stats (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  username TEXT NOT NULL,
+                                  connection_start TIMESTAMP(0) DEFAULT {NOW},
+                                  connection_end TIMESTAMP(0),
+                                  duration_seconds INTEGER,
+                                  bytes_sent BIGINT DEFAULT 0,
+                                  bytes_received BIGINT DEFAULT 0,
+                                  client_ip TEXT,
+                                  status TEXT DEFAULT 'completed',
+                                  session_id TEXT
+                               )''')
+
+                cursor.execute('''CREATE TABLE IF NOT EXISTS traffic_log (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  username TEXT NOT NULL,
+                                  log_date DATE NOT NULL,
+                                  bytes_sent BIGINT DEFAULT 0,
+                                  bytes_received BIGINT DEFAULT 0,
+                                  connections_count INTEGER DEFAULT 0,
+                                  UNIQUE (username, log_date)
+                               ) WITH (fillfactor = 70)''')
+
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS active_sessions (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  username TEXT NOT NULL,
+                                  connection_id TEXT NOT NULL,
+                                  session_hash TEXT NOT NULL,
+                                  last_bytes_sent BIGINT DEFAULT 0,
+                                  last_bytes_received BIGINT DEFAULT 0,
+                                  client_ip TEXT,
+                                  first_seen TIMESTAMP(0) DEFAULT {NOW},
+                                  last_updated TIMESTAMP(0) DEFAULT {NOW},
+                                  UNIQUE (username, connection_id, session_hash)
+                               ) WITH (fillfactor = 70)''')
+
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS session_backup (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  username TEXT NOT NULL,
+                                  connection_id TEXT NOT NULL,
+                                  session_hash TEXT NOT NULL,
+                                  total_bytes_sent BIGINT DEFAULT 0,
+                                  total_bytes_received BIGINT DEFAULT 0,
+                                  start_time TIMESTAMP(0),
+                                  end_time TIMESTAMP(0) DEFAULT {NOW},
+                                  backup_time TIMESTAMP(0) DEFAULT {NOW},
+                                  backup_reason TEXT
+                               )''')
+
+                cursor.execute(f'''CREATE TABLE IF NOT EXISTS monitor_state (
+                                  key TEXT PRIMARY KEY,
+                                  value TEXT,
+                                  updated_at TIMESTAMP(0) DEFAULT {NOW}
+                               )''')
+
+                cursor.execute('''CREATE TABLE IF NOT EXISTS user_stats_daily (
+                                  id BIGSERIAL PRIMARY KEY,
+                                  username TEXT NOT NULL,
+                                  stat_date DATE NOT NULL,
+                                  sessions_count INTEGER DEFAULT 0,
+                                  duration_seconds BIGINT DEFAULT 0,
+                                  bytes_sent BIGINT DEFAULT 0,
+                                  bytes_received BIGINT DEFAULT 0,
+                                  UNIQUE (username, stat_date)
+                               )''')
+
+                cursor.execute('''CREATE TABLE IF NOT EXISTS fleet_nodes (
+                                  node_id TEXT PRIMARY KEY,
+                                  url TEXT,
+                                  last_seq BIGINT DEFAULT 0,
+                                  users_count INTEGER DEFAULT 0,
+                                  last_push TIMESTAMP(0)
+                               )''')
+                cursor.execute("ALTER TABLE fleet_nodes ADD COLUMN IF NOT EXISTS epoch TEXT")
+                cursor.execute('''CREATE TABLE IF NOT EXISTS user_nodes (
+                                  username TEXT PRIMARY KEY,
+                                  node_id TEXT NOT NULL
+                               )''')
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_nodes_node ON user_nodes (node_id)")
+
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_username ON user_stats (username, session_id, status)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_start ON user_stats (connection_start)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_backup_username ON session_backup (username)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_backup_end ON session_backup (end_time)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_active_sessions_user ON active_sessions (username, connection_id)")
+
+                # Индексы поиска: префикс имени без учета регистра (LIKE 'ab%' по lower()),
+                # создатель, статус и последнее подключение
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username) text_pattern_ops)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created_by ON users (created_by, lower(username))")
+                cursor.execute('''CREATE INDEX IF NOT EXISTS idx_users_admin_lower
+                                  ON users (lower(created_by_username) text_pattern_ops)''')
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users (is_active, lower(username))")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_last_connected ON users (last_connected)")
+
+            self._ensure_users_trgm()
+            logger.info("Все таблицы созданы/проверены")
+
+        except Exception as e:
+            logger.error(f"Ошибка при создании таблиц: {str(e)}")
+            raise
+
+    def _ensure_users_trgm(self):
+        """Триграммный индекс pg_trgm для поиска подстроки; без расширения ILIKE работает без индекса"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (username gin_trgm_ops)")
+            self.users_fts = True
+        except psycopg2.Error as e:
+            logger.warning(f"pg_trgm недоступен, поиск по подстроке будет без индекса: {str(e).splitlines()[0]}")
+            self.users_fts = False
+
+    # ========== МЕТОДЫ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ==========
+
+    def user_exists(self, username):
+        return self._fetchone("SELECT id FROM users WHERE username = %s", (username,)) is not None
+
+    def add_user(self, username, created_by, created_by_username):
+        added = self._execute('''INSERT INTO users (username, created_by, created_by_username) VALUES (%s, %s, %s)
+                                 ON CONFLICT (username) DO NOTHING''',
+                              (username, created_by, created_by_username))
+        if not added:
+            logger.warning(f"Пользователь {username} уже существует")
+            return False
+        self.users_version += 1
+        logger.info(f"Пользователь {username} добавлен")
+        return True
+
+    def ensure_user_exists(self, username):
+        """Гарантирует что пользователь существует в БД"""
+        try:
+            created = self._execute('''INSERT INTO users (username, created_by, created_by_username) VALUES (%s, %s, %s)
+                                       ON CONFLICT (username) DO NOTHING''',
+                                    (username, Config.SUPER_ADMIN_ID, "Система (автосоздание)"))
+            if created:
+                self.users_version += 1
+                logger.info(f"Пользователь {username} создан в БД")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка проверки/создания пользователя {username}: {str(e)}")
+            return False
+
+    def get_all_users(self):
+        return self.fetch_rows(UserRow, f"SELECT {', '.join(UserRow._fields)} FROM users ORDER BY created_at DESC, id DESC")
+
+    def get_user(self, username):
+        rows = self.fetch_rows(UserRow, f"SELECT {', '.join(UserRow._fields)} FROM users WHERE username = %s",
+                               (username,))
+        return rows[0] if rows else None
+
+    def get_user_summaries(self, created_by=None, order_by_traffic=False, limit=None):
+        """Пользователи для списков: только отображаемые колонки"""
+        query = f"SELECT {USER_SUMMARY_COLUMNS} FROM users"
+        params = []
+        if created_by is not None:
+            query += " WHERE created_by = %s"
+            params.append(created_by)
+        if order_by_traffic:
+            query += " ORDER BY COALESCE(total_bytes_sent, 0) + COALESCE(total_bytes_received, 0) DESC"
+        else:
+            query += " ORDER BY created_at DESC, id DESC"
+        if limit:
+            query += " LIMIT %s"
+            params.append(limit)
+        return self.fetch_rows(UserSummary, query, params)
+
+    def get_user_statuses(self, created_by=None):
+        """Пользователи для кнопок выбора: имя, кто создал, активен ли"""
+        query = "SELECT username, created_by_username, COALESCE(is_active, 0) FROM users"
+        params = ()
+        if created_by is not None:
+            query += " WHERE created_by = %s"
+            params = (created_by,)
+        return self.fetch_rows(UserStatus, query + " ORDER BY created_at DESC, id DESC", params)
+
+    def search_users(self, name=None, substring=False, admin=None, is_active=None, seen_within=None,
+                     unseen_for=None, order_by_name=False, limit=None, offset=0):
+        """Поиск пользователей по фильтрам (см. Database.search_users). Возвращает UserSummary"""
+        conditions = []
+        params = []
+
+        if name:
+            if not substring:
+                # Префикс по индексу lower(username) text_pattern_ops
+                conditions.append("lower(username) LIKE %s")
+                params.append(_like_escape(name.lower()) + '%')
+            else:
+                # При pg_trgm ILIKE идет по триграммному индексу (от трех символов)
+                conditions.append("username ILIKE %s")
+                params.append('%' + _like_escape(name) + '%')
+
+        if isinstance(admin, int):
+            conditions.append("created_by = %s")
+            params.append(admin)
+        elif admin:
+            conditions.append("lower(created_by_username) LIKE %s")
+            params.append(_like_escape(admin.lower()) + '%')
+
+        if is_active is not None:
+            conditions.append("is_active = %s")
+            params.append(1 if is_active else 0)
+
+        if seen_within:
+            conditions.append(f"last_connected >= {NOW} - make_interval(secs => %s)")
+            params.append(int(seen_within))
+        if unseen_for:
+            conditions.append(f"(last_connected IS NULL OR last_connected < {NOW} - make_interval(secs => %s))")
+            params.append(int(unseen_for))
+
+        query = f"SELECT {USER_SUMMARY_COLUMNS} FROM users"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY lower(username)" if order_by_name else " ORDER BY created_at DESC, id DESC"
+        if limit:
+            query += " LIMIT %s OFFSET %s"
+            params.extend((limit, offset))
+        with metrics.timer('vpnbot_user_search_seconds'):
+            return self.fetch_rows(UserSummary, query, params)
+
+    def get_usernames(self, created_by=None):
+        if created_by is None:
+            rows = self._fetchall("SELECT username FROM users ORDER BY username")
+        else:
+            rows = self._fetchall("SELECT username FROM users WHERE created_by = %s ORDER BY username", (created_by,))
+        return [row[0] for row in rows]
+
+    def delete_user(self, username):
+        try:
+            # Создаем резервную копию
+            self.backup_user_data(username, "user_deletion")
+
+            deleted = self._execute("DELETE FROM users WHERE username = %s", (username,)) > 0
+            if deleted:
+                self.maintenance_requested = True
+                self.quota_version += 1
+                self.users_version += 1
+                logger.info(f"Пользователь {username} удален из БД")
+            return deleted
+
+        except Exception as e:
+            logger.error(f"Ошибка удаления пользователя {username}: {str(e)}")
+            return False
+
+    def clear_all_users(self):
+        try:
+            # Создаем полную резервную копию
+            backup_file = self.create_full_backup("before_clear_all")
+            logger.info(f"Создана резервная копия перед очисткой: {backup_file}")
+
+            with self.transaction() as cursor:
+                cursor.execute("DELETE FROM session_backup")
+                cursor.execute("DELETE FROM active_sessions")
+                cursor.execute("DELETE FROM user_stats")
+                cursor.execute("DELETE FROM user_stats_daily")
+                cursor.execute("DELETE FROM traffic_log")
+                cursor.execute("DELETE FROM users")
+
+            self.maintenance_requested = True
+            self.quota_version += 1
+            self.users_version += 1
+            logger.info("Все пользователи удалены из БД")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка очистки БД: {str(e)}")
+            return False
+
+    def get_user_count(self):
+        return self._fetchone("SELECT COUNT(*) FROM users")[0] or 0
+
+    def get_active_users_count(self):
+        return self._fetchone("SELECT COUNT(*) FROM users WHERE is_active = 1")[0] or 0
+
+    def get_user_statistics(self, username):
+        """Получает статистику пользователя"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute('''SELECT total_connections, last_connected, total_bytes_sent, total_bytes_received,
+                                         is_active
+                                  FROM users WHERE username = %s''', (username,))
+                user_stats = cursor.fetchone()
+                if not user_stats:
+                    return None
+
+                # Статистика за 30 дней
+                cursor.execute('''SELECT SUM(bytes_sent)::bigint, SUM(bytes_received)::bigint, SUM(connections_count)
+                                  FROM traffic_log WHERE username = %s AND log_date >= CURRENT_DATE - 30''',
+                               (username,))
+                monthly_stats = cursor.fetchone()
+
+                cursor.execute("SELECT COUNT(*) FROM active_sessions WHERE username = %s", (username,))
+                active_sessions = cursor.fetchone()[0] or 0
+
+            return {
+                'total_connections': user_stats[0] or 0,
+                'last_connected': user_stats[1],
+                'total_bytes_sent': user_stats[2] or 0,
+                'total_bytes_received': user_stats[3] or 0,
+                'is_active': bool(user_stats[4]),
+                'active_sessions': active_sessions,
+                'monthly_sent': monthly_stats[0] or 0 if monthly_stats else 0,
+                'monthly_received': monthly_stats[1] or 0 if monthly_stats else 0,
+                'monthly_connections': monthly_stats[2] or 0 if monthly_stats else 0
+            }
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики пользователя {username}: {str(e)}")
+            return None
+
+    # ========== МЕТОДЫ ДЛЯ КВОТ ==========
+
+    def get_user_quotas(self):
+        """Возвращает квоты пользователей, у которых задано хотя бы одно ограничение"""
+        rows = self._fetchall('''SELECT username, created_by, quota_daily, quota_monthly, quota_total, quota_action
+                                 FROM users
+                                 WHERE quota_daily > 0 OR quota_monthly > 0 OR quota_total > 0''')
+        return {
+            row[0]: {
+                'created_by': row[1],
+                'daily': row[2] or 0,
+                'monthly': row[3] or 0,
+                'total': row[4] or 0,
+                'action': row[5] or 'warn'
+            }
+            for row in rows
+        }
+
+    def set_user_quota(self, username, kind=None, limit=None, action=None):
+        """Задает лимит квоты (daily/monthly/total, 0 - снять) и/или действие при превышении"""
+        try:
+            if kind is not None and kind not in ('daily', 'monthly', 'total'):
+                return False
+            with self.transaction() as cursor:
+                if kind is not None:
+                    cursor.execute(f"UPDATE users SET quota_{kind} = %s WHERE username = %s", (int(limit or 0), username))
+                if action is not None:
+                    cursor.execute("UPDATE users SET quota_action = %s WHERE username = %s", (action, username))
+            self.quota_version += 1
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка изменения квоты {username}: {str(e)}")
+            return False
+
+    def get_quota_usage(self, username, day, month_start):
+        """Возвращает (за день, за месяц, всего) байт из итогов БД - начальные значения счетчиков квот"""
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT
+                                  COALESCE(SUM(CASE WHEN log_date = %s THEN bytes_sent + bytes_received END), 0)::bigint,
+                                  COALESCE(SUM(bytes_sent + bytes_received), 0)::bigint
+                              FROM traffic_log
+                              WHERE username = %s AND log_date >= %s''',
+                           (str(day), username, str(month_start)))
+            daily, monthly = cursor.fetchone()
+            cursor.execute("SELECT total_bytes_sent + total_bytes_received FROM users WHERE username = %s", (username,))
+            row = cursor.fetchone()
+        return daily, monthly, (row[0] or 0) if row else 0
+
+    # ========== МЕТОДЫ ДЛЯ АДМИНИСТРАТОРОВ ==========
+
+    def is_admin(self, user_id):
+        return self._fetchone("SELECT id FROM admins WHERE user_id = %s", (user_id,)) is not None
+
+    def get_all_admins(self):
+        return self._fetchall('''SELECT a.user_id, a.username, a.added_at,
+                                 COALESCE(s.username, 'Супер-админ') AS added_by_name
+                                 FROM admins a
+                                 LEFT JOIN admins s ON a.added_by = s.user_id
+                                 ORDER BY a.added_at, a.id''')
+
+    def add_admin(self, user_id, username, added_by):
+        added = self._execute('''INSERT INTO admins (user_id, username, added_by) VALUES (%s, %s, %s)
+                                 ON CONFLICT (user_id) DO NOTHING''',
+                              (user_id, username, added_by))
+        if not added:
+            logger.warning(f"Администратор {user_id} уже существует")
+            return False
+        logger.info(f"Администратор {username} добавлен")
+        return True
+
+    def delete_admin(self, user_id):
+        if user_id == Config.SUPER_ADMIN_ID:
+            return False
+        return self._execute("DELETE FROM admins WHERE user_id = %s", (user_id,)) > 0
+
+    # ========== МЕТОДЫ ДЛЯ СТАТИСТИКИ И ТРАФИКА ==========
+
+    def _load_deltas(self, cursor, rows):
+        """Загружает дельты во временную таблицу traffic_deltas одним COPY (без commit).
+
+        rows: [(username, connection_id, log_date, sent_diff, received_diff, absolute_sent, absolute_received)],
+        абсолютные счетчики - None, если сессию обновлять не нужно. Таблица очищается при commit.
+        """
+        cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS traffic_deltas (
+                              username TEXT NOT NULL,
+                              connection_id TEXT,
+                              log_date DATE,
+                              sent BIGINT NOT NULL,
+                              received BIGINT NOT NULL,
+                              absolute_sent BIGINT,
+                              absolute_received BIGINT
+                          ) ON COMMIT DELETE ROWS''')
+        buffer = io.StringIO(''.join([_copy_line(row) for row in rows]))
+        cursor.copy_expert("COPY traffic_deltas FROM STDIN", buffer)
+        metrics.inc('vpnbot_postgres_copy_rows_total', len(rows))
+
+    def _add_loaded_traffic(self, cursor):
+        """Добавляет дельты из traffic_deltas к итогам пользователей и дневному логу (без commit)"""
+        cursor.execute(f'''UPDATE users u
+                           SET total_bytes_sent = u.total_bytes_sent + d.sent,
+                               total_bytes_received = u.total_bytes_received + d.received,
+                               last_updated = {NOW}
+                           FROM (SELECT username, SUM(sent)::bigint AS sent, SUM(received)::bigint AS received
+                                 FROM traffic_deltas WHERE sent > 0 OR received > 0
+                                 GROUP BY username) d
+                           WHERE u.username = d.username''')
+        cursor.execute('''INSERT INTO traffic_log (username, log_date, bytes_sent, bytes_received)
+                          SELECT username, log_date, SUM(sent), SUM(received)
+                          FROM traffic_deltas WHERE sent > 0 OR received > 0
+                          GROUP BY username, log_date
+                          ON CONFLICT (username, log_date) DO UPDATE SET
+                              bytes_sent = traffic_log.bytes_sent + excluded.bytes_sent,
+                              bytes_received = traffic_log.bytes_received + excluded.bytes_received''')
+        if cursor.rowcount:
+            self.users_version += 1
+
+    def update_traffic(self, username, bytes_sent_diff, bytes_received_diff, connection_id=None):
+        """Обновляет общий трафик пользователя (построчно, без COPY)"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(f'''UPDATE users
+                                   SET total_bytes_sent = total_bytes_sent + %s,
+                                       total_bytes_received = total_bytes_received + %s,
+                                       last_updated = {NOW}
+                                   WHERE username = %s''',
+                               (bytes_sent_diff, bytes_received_diff, username))
+                cursor.execute('''INSERT INTO traffic_log (username, log_date, bytes_sent, bytes_received)
+                                  VALUES (%s, %s, %s, %s)
+                                  ON CONFLICT (username, log_date) DO UPDATE SET
+                                      bytes_sent = traffic_log.bytes_sent + excluded.bytes_sent,
+                                      bytes_received = traffic_log.bytes_received + excluded.bytes_received''',
+                               (username, datetime.now().date(), bytes_sent_diff, bytes_received_diff))
+            self.users_version += 1
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления трафика для {username}: {str(e)}")
+            return False
+
+    def apply_traffic_batch(self, entries, journal_seq=None):
+        """Записывает накопленные дельты одной транзакцией: COPY во временную таблицу и
+        несколько UPDATE/INSERT по ней вместо запросов на каждую сессию.
+
+        entries: [(username, connection_id, sent_diff, received_diff, absolute_sent, absolute_received)].
+        Вместе с дельтами сохраняются базовые счетчики сессий и seq журнала.
+        """
+        try:
+            today = datetime.now().date()
+            with self.transaction() as cursor:
+                if entries:
+                    self._load_deltas(cursor, [
+                        (username, connection_id, today, sent_diff, received_diff, absolute_sent, absolute_received)
+                        for username, connection_id, sent_diff, received_diff, absolute_sent, absolute_received
+                        in entries
+                    ])
+                    self._add_loaded_traffic(cursor)
+                    cursor.execute(f'''UPDATE active_sessions a
+                                       SET last_bytes_sent = d.absolute_sent,
+                                           last_bytes_received = d.absolute_received,
+                                           last_updated = {NOW}
+                                       FROM traffic_deltas d
+                                       WHERE a.username = d.username AND a.connection_id = d.connection_id''')
+
+                if journal_seq is not None:
+                    self.set_monitor_state('journal_seq', journal_seq, commit=False)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи трафика: {str(e)}")
+            return False
+
+    def get_daily_traffic(self, date_from, date_to, username=None):
+        """Трафик по дням за период: [(log_date, sent, received)], по пользователю или по серверу"""
+        try:
+            if username:
+                rows = self._fetchall('''SELECT log_date, bytes_sent, bytes_received FROM traffic_log
+                                         WHERE username = %s AND log_date BETWEEN %s AND %s
+                                         ORDER BY log_date''',
+                                      (username, str(date_from), str(date_to)))
+            else:
+                rows = self._fetchall('''SELECT log_date, SUM(bytes_sent)::bigint, SUM(bytes_received)::bigint
+                                         FROM traffic_log
+                                         WHERE log_date BETWEEN %s AND %s
+                                         GROUP BY log_date ORDER BY log_date''',
+                                      (str(date_from), str(date_to)))
+            return [(row[0], row[1] or 0, row[2] or 0) for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка получения трафика по дням: {str(e)}")
+            return []
+
+    def get_traffic_version(self, username=None):
+        """Метка последнего изменения трафика (пользователя или всего сервера) для кэшей"""
+        if username:
+            row = self._fetchone("SELECT last_updated FROM users WHERE username = %s", (username,))
+        else:
+            row = self._fetchone("SELECT MAX(last_updated) FROM users")
+        # quota_version растет при удалении пользователей и обнулении трафика
+        return (row[0] if row else None), self.quota_version
+
+    def get_history_rows(self, date_from, date_to):
+        """Строки аналитики за период: дневной трафик и завершенные сессии"""
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT username, log_date, COALESCE(bytes_sent, 0) + COALESCE(bytes_received, 0)
+                              FROM traffic_log WHERE log_date BETWEEN %s AND %s''',
+                           (str(date_from), str(date_to)))
+            log_rows = cursor.fetchall()
+            cursor.execute('''SELECT username, connection_start, duration_seconds,
+                                     COALESCE(bytes_sent, 0) + COALESCE(bytes_received, 0)
+                              FROM user_stats
+                              WHERE connection_start >= %s AND connection_start < %s::date + 1
+                                AND duration_seconds IS NOT NULL''',
+                           (str(date_from), str(date_to)))
+            session_rows = cursor.fetchall()
+        return log_rows, session_rows
+
+    def get_last_session_id(self):
+        return self._fetchone("SELECT MAX(id) FROM user_stats")[0]
+
+    @contextmanager
+    def export_query(self, table, date_from=None, date_to=None, usernames=None):
+        """Выгрузка серверным курсором в отдельной транзакции только для чтения"""
+        date_column = EXPORT_TABLES[table]
+        conditions = []
+        params = []
+
+        if date_from:
+            conditions.append(f"{date_column} >= %s")
+            params.append(date_from.isoformat())
+        if date_to:
+            # date_to включительно: строки до начала следующего дня
+            conditions.append(f"{date_column} < %s::date + 1")
+            params.append(date_to.isoformat())
+        if usernames:
+            conditions.append("username = ANY(%s)")
+            params.append(list(usernames))
+
+        query = f"SELECT * FROM {table}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        conn = self._getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION READ ONLY")
+            cursor = conn.cursor(name=f"export_{table}")
+            cursor.itersize = Config.EXPORT_BATCH_SIZE
+            cursor.execute(query + " ORDER BY id", params)
+            # У серверного курсора описание колонок появляется после первой выборки
+            first = cursor.fetchmany(Config.EXPORT_BATCH_SIZE)
+            columns = [description[0] for description in cursor.description]
+            integer_columns = {description[0] for description in cursor.description
+                               if description[1] in INTEGER_TYPES}
+
+            def batches():
+                rows = first
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(Config.EXPORT_BATCH_SIZE)
+
+            yield columns, integer_columns, batches()
+        finally:
+            if not conn.closed:
+                conn.rollback()
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def reset_all_traffic(self):
+        """Обнуляет всю статистику трафика"""
+        try:
+            # Создаем резервную копию
+            backup_file = self.create_full_backup("before_reset_traffic")
+            logger.info(f"Создана резервная копия перед обнулением: {backup_file}")
+
+            with self.transaction() as cursor:
+                cursor.execute(f'''UPDATE users
+                                   SET total_bytes_sent = 0,
+                                       total_bytes_received = 0,
+                                       total_connections = 0,
+                                       last_connected = NULL,
+                                       last_updated = {NOW}''')
+                cursor.execute("DELETE FROM traffic_log")
+                cursor.execute("DELETE FROM user_stats")
+                cursor.execute("DELETE FROM user_stats_daily")
+
+                # Завершаем активные сессии
+                for username, connection_id, session_hash, _, _ in self.get_active_sessions():
+                    self.finalize_session(username, connection_id, session_hash, "reset_traffic")
+
+            self.maintenance_requested = True
+            self.quota_version += 1
+            self.users_version += 1
+            logger.warning("Вся статистика трафика обнулена")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка обнуления трафика: {str(e)}")
+            return False
+
+    def reset_user_traffic(self, username):
+        """Обнуляет статистику трафика для конкретного пользователя"""
+        try:
+            # Создаем резервную копию
+            self.backup_user_data(username, "before_reset_traffic")
+
+            with self.transaction() as cursor:
+                cursor.execute(f'''UPDATE users
+                                   SET total_bytes_sent = 0,
+                                       total_bytes_received = 0,
+                                       total_connections = 0,
+                                       last_connected = NULL,
+                                       last_updated = {NOW}
+                                   WHERE username = %s''',
+                               (username,))
+                cursor.execute("DELETE FROM traffic_log WHERE username = %s", (username,))
+                cursor.execute("DELETE FROM user_stats WHERE username = %s", (username,))
+                cursor.execute("DELETE FROM user_stats_daily WHERE username = %s", (username,))
+
+                # Завершаем активные сессии пользователя
+                cursor.execute("SELECT connection_id, session_hash FROM active_sessions WHERE username = %s",
+                               (username,))
+                for connection_id, session_hash in cursor.fetchall():
+                    self.finalize_session(username, connection_id, session_hash, "reset_user_traffic")
+
+            self.maintenance_requested = True
+            self.quota_version += 1
+            self.users_version += 1
+            logger.warning(f"Статистика трафика пользователя {username} обнулена")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка обнуления трафика пользователя {username}: {str(e)}")
+            return False
+
+    # ========== СЕССИИ ==========
+
+    def register_session(self, username, connection_id, client_ip, absolute_sent, absolute_received):
+        """Обновляет счетчики сессии (username, connection_id) или открывает новую. Возвращает хэш сессии"""
+        try:
+            created = False
+            with self.transaction() as cursor:
+                cursor.execute('''SELECT session_hash FROM active_sessions
+                                  WHERE username = %s AND connection_id = %s FOR UPDATE''',
+                               (username, connection_id))
+                existing = cursor.fetchone()
+
+                if existing:
+                    session_hash = existing[0]
+                    cursor.execute(f'''UPDATE active_sessions
+                                       SET last_bytes_sent = %s,
+                                           last_bytes_received = %s,
+                                           client_ip = %s,
+                                           last_updated = {NOW}
+                                       WHERE username = %s AND connection_id = %s AND session_hash = %s''',
+                                   (absolute_sent, absolute_received, client_ip, username, connection_id, session_hash))
+                else:
+                    session_hash = self.create_session_hash(username, connection_id, client_ip)
+                    cursor.execute('''INSERT INTO active_sessions
+                                      (username, connection_id, session_hash, last_bytes_sent, last_bytes_received, client_ip)
+                                      VALUES (%s, %s, %s, %s, %s, %s)''',
+                                   (username, connection_id, session_hash, absolute_sent, absolute_received, client_ip))
+                    cursor.execute(f'''INSERT INTO user_stats (username, connection_start, client_ip, status, session_id)
+                                       VALUES (%s, {NOW}, %s, 'active', %s)''',
+                                   (username, client_ip, session_hash))
+                    cursor.execute(f'''UPDATE users
+                                       SET total_connections = total_connections + 1,
+                                           last_connected = {NOW},
+                                           is_active = 1
+                                       WHERE username = %s''',
+                                   (username,))
+                    created = True
+
+            if created:
+                self.users_version += 1
+            return session_hash
+
+        except Exception as e:
+            logger.error(f"Ошибка обновления сессии в БД {username}: {str(e)}")
+            return None
+
+    def get_session_base(self, username):
+        """Счетчики последней обновленной сессии пользователя: (sent, received, connection_id) или None"""
+        return self._fetchone('''SELECT last_bytes_sent, last_bytes_received, connection_id FROM active_sessions
+                                 WHERE username = %s ORDER BY last_updated DESC, id DESC LIMIT 1''',
+                              (username,))
+
+    def get_active_sessions(self):
+        """Возвращает активные сессии: (username, connection_id, session_hash, last_bytes_sent, last_bytes_received)"""
+        return self._fetchall('''SELECT username, connection_id, session_hash, last_bytes_sent, last_bytes_received
+                                 FROM active_sessions ORDER BY id''')
+
+    def finalize_session(self, username, connection_id, session_hash, reason="normal_disconnect", commit=True):
+        """Завершает сессию и создает резервную копию"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute('''DELETE FROM active_sessions
+                                  WHERE username = %s AND connection_id = %s AND session_hash = %s
+                                  RETURNING last_bytes_sent, last_bytes_received, client_ip, first_seen''',
+                               (username, connection_id, session_hash))
+                session_data = cursor.fetchone()
+                if not session_data:
+                    logger.warning(f"Сессия не найдена для завершения: {username}_{connection_id}_{session_hash}")
+                    return False
+
+                sent, received, client_ip, first_seen = session_data
+
+                # Создаем резервную копию сессии
+                cursor.execute('''INSERT INTO session_backup
+                                  (username, connection_id, session_hash, total_bytes_sent, total_bytes_received,
+                                   start_time, backup_reason)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                               (username, connection_id, session_hash, sent, received, first_seen, reason))
+
+                # Завершаем сессию в статистике (трафик уже учтен потиковыми дельтами)
+                cursor.execute(f'''UPDATE user_stats
+                                   SET connection_end = {NOW},
+                                       duration_seconds = EXTRACT(EPOCH FROM {NOW} - connection_start)::integer,
+                                       bytes_sent = %s,
+                                       bytes_received = %s,
+                                       status = 'completed'
+                                   WHERE id = (SELECT id FROM user_stats
+                                               WHERE username = %s AND session_id = %s AND status = 'active'
+                                               ORDER BY connection_start DESC LIMIT 1)''',
+                               (sent, received, username, session_hash))
+
+                # Помечаем как неактивного если больше нет активных сессий
+                cursor.execute('''UPDATE users SET is_active = 0
+                                  WHERE username = %s
+                                    AND NOT EXISTS (SELECT 1 FROM active_sessions WHERE username = %s)''',
+                               (username, username))
+                if cursor.rowcount:
+                    self.users_version += 1
+
+            logger.info(f"Сессия завершена {username}: sent={sent}, received={received}, reason={reason}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка завершения сессии {username}: {str(e)}")
+            return False
+
+    def finalize_sessions(self, sessions, reason, deadline=None):
+        """Завершает переданные сессии [(username, connection_id, session_hash)] одной транзакцией"""
+        completed = 0
+        try:
+            with self.transaction():
+                for username, connection_id, session_hash in sessions:
+                    if deadline and time.time() > deadline:
+                        logger.warning(f"Лимит времени: завершено {completed} из {len(sessions)} сессий")
+                        break
+                    if self.finalize_session(username, connection_id, session_hash, reason):
+                        completed += 1
+        except Exception as e:
+            logger.error(f"Ошибка пакетного завершения сессий: {str(e)}")
+            return 0, len(sessions)
+
+        return completed, len(sessions)
+
+    def cleanup_old_sessions(self, active_usernames):
+        """Очищает сессии пользователей, которых нет в подтвержденном списке активных (None - пропуск)"""
+        if active_usernames is None:
+            logger.warning("Очистка сессий пропущена: нет подтвержденного списка активных")
+            return False
+
+        try:
+            active_usernames = list(active_usernames)
+            with self.transaction() as cursor:
+                cursor.execute('''SELECT username, connection_id, session_hash FROM active_sessions
+                                  WHERE NOT (username = ANY(%s::text[]))''',
+                               (active_usernames,))
+                old_sessions = cursor.fetchall()
+
+                for username, connection_id, session_hash in old_sessions:
+                    reason = "cleanup_inactive" if active_usernames else "cleanup_no_active"
+                    self.finalize_session(username, connection_id, session_hash, reason)
+
+                cursor.execute('''UPDATE users SET is_active = 0
+                                  WHERE is_active = 1 AND NOT (username = ANY(%s::text[]))''',
+                               (active_usernames,))
+                if cursor.rowcount:
+                    self.users_version += 1
+
+            if old_sessions:
+                logger.info(f"Очищено {len(old_sessions)} старых сессий")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка очистки сессий: {str(e)}")
+            return False
+
+    # ========== ФЛОТ УЗЛОВ (РЕЖИМ АГРЕГАТОРА) ==========
+
+    def apply_fleet_push(self, node_id, url, ticks, active_usernames, users_count, epoch=None):
+        """Применяет дельты тиков узла одной транзакцией; возвращает последний учтенный seq.
+
+        Строка узла блокируется (FOR UPDATE), поэтому параллельные отправки одного узла
+        применяются по очереди и тики с seq не больше учтенного пропускаются. Смена epoch
+        (БД узла пересоздана) сбрасывает учтенный seq.
+        """
+        try:
+            active_usernames = list(active_usernames)
+            with self.transaction() as cursor:
+                cursor.execute('''INSERT INTO fleet_nodes (node_id, url) VALUES (%s, %s)
+                                  ON CONFLICT (node_id) DO NOTHING''', (node_id, url))
+                cursor.execute("SELECT last_seq, epoch FROM fleet_nodes WHERE node_id = %s FOR UPDATE", (node_id,))
+                last_seq, stored_epoch = cursor.fetchone()
+                last_seq = self._fleet_epoch_seq(node_id, last_seq, stored_epoch, epoch)
+
+                rows = []
+                for seq, ts, deltas in sorted(ticks, key=lambda tick: tick[0]):
+                    if seq <= last_seq:
+                        continue
+                    log_date = datetime.fromtimestamp(ts).date()
+                    rows.extend((username, connection_id, log_date, sent_diff, received_diff, None, None)
+                                for username, connection_id, sent_diff, received_diff in deltas)
+                    last_seq = seq
+                # Пользователи из снимка сессий без трафика - нулевые строки: им нужна только запись в БД
+                rows.extend((username, None, None, 0, 0, None, None) for username in active_usernames)
+
+                if rows:
+                    self._load_deltas(cursor, rows)
+                    cursor.execute('''INSERT INTO users (username, created_by, created_by_username)
+                                      SELECT DISTINCT username, %s::bigint, 'Узел ' || %s FROM traffic_deltas
+                                      ON CONFLICT (username) DO NOTHING
+                                      RETURNING username''',
+                                   (Config.SUPER_ADMIN_ID, node_id))
+                    created = [row[0] for row in cursor.fetchall()]
+                    if created:
+                        self.users_version += 1
+                        logger.info(f"Пользователи с узла {node_id} созданы в БД: {', '.join(created)}")
+                    # Пользователь мог переехать на другой узел: размещение - по узлу, который о нем сообщил
+                    cursor.execute('''INSERT INTO user_nodes (username, node_id)
+                                      SELECT DISTINCT username, %s FROM traffic_deltas
+                                      ON CONFLICT (username) DO UPDATE SET node_id = excluded.node_id''',
+                                   (node_id,))
+                    self._add_loaded_traffic(cursor)
+
+                # Активность пользователей узла - по последнему снимку его сессий
+                cursor.execute('''UPDATE users SET is_active = 0
+                                  WHERE is_active = 1 AND NOT (username = ANY(%s::text[]))
+                                    AND username IN (SELECT username FROM user_nodes WHERE node_id = %s)''',
+                               (active_usernames, node_id))
+                changed = cursor.rowcount
+                cursor.execute(f'''UPDATE users
+                                   SET is_active = 1,
+                                       last_connected = {NOW},
+                                       total_connections = total_connections + 1
+                                   WHERE COALESCE(is_active, 0) = 0 AND username = ANY(%s::text[])''',
+                               (active_usernames,))
+                changed += cursor.rowcount
+
+                cursor.execute(f'''UPDATE fleet_nodes
+                                   SET url = %s, last_seq = %s, users_count = %s, last_push = {NOW},
+                                       epoch = COALESCE(%s, epoch)
+                                   WHERE node_id = %s''',
+                               (url, last_seq, users_count, epoch, node_id))
+
+            if changed:
+                self.users_version += 1
+            return last_seq
+        except Exception as e:
+            logger.error(f"Ошибка применения данных узла {node_id}: {str(e)}")
+            return None
+
+    def get_fleet_nodes(self):
+        """Узлы флота: [(node_id, url, last_seq, users_count, last_push)]"""
+        return self._fetchall("SELECT node_id, url, last_seq, users_count, last_push FROM fleet_nodes ORDER BY node_id")
+
+    def get_user_node(self, username):
+        row = self._fetchone("SELECT node_id FROM user_nodes WHERE username = %s", (username,))
+        return row[0] if row else None
+
+    def set_user_node(self, username, node_id):
+        self._execute('''INSERT INTO user_nodes (username, node_id) VALUES (%s, %s)
+                         ON CONFLICT (username) DO UPDATE SET node_id = excluded.node_id''',
+                      (username, node_id))
+
+    def delete_user_node(self, username):
+        self._execute("DELETE FROM user_nodes WHERE username = %s", (username,))
+
+    def get_node_user_counts(self):
+        """Число пользователей на каждом узле по карте размещения: {node_id: count}"""
+        return dict(self._fetchall("SELECT node_id, COUNT(*) FROM user_nodes GROUP BY node_id"))
+
+    # ========== СОСТОЯНИЕ МОНИТОРА ==========
+
+    def get_monitor_state(self, key, default=None):
+        row = self._fetchone("SELECT value FROM monitor_state WHERE key = %s", (key,))
+        return row[0] if row else default
+
+    def set_monitor_state(self, key, value, commit=True):
+        self._execute(f'''INSERT INTO monitor_state (key, value, updated_at) VALUES (%s, %s, {NOW})
+                          ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = {NOW}''',
+                      (key, str(value)))
+
+    def get_monitor_stopped_at(self):
+        row = self._fetchone('''SELECT EXTRACT(EPOCH FROM MAX(updated_at))::bigint FROM monitor_state
+                                WHERE key IN ('warm_state', 'journal_seq')''')
+        return row[0]
+
+    # ========== МЕТОДЫ ДЛЯ РЕЗЕРВНОГО КОПИРОВАНИЯ ==========
+
+    def _select_user_rows(self, table, username, order_column=None):
+        query = f"SELECT * FROM {table} WHERE username = %s"
+        if order_column:
+            query += f" ORDER BY {order_column}"
+        with self.transaction() as cursor:
+            cursor.execute(query, (username,))
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _write_full_backup(self, backup_file):
+        """Все таблицы через COPY TO в один gzip-файл: заголовок таблицы, строки, маркер конца"""
+        with gzip.open(backup_file, 'wt', encoding='utf-8', compresslevel=6) as f:
+            f.write(BACKUP_HEADER)
+            # REPEATABLE READ: все таблицы из одного снимка, запись в это время не блокируется
+            with self.transaction() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                for table in BACKUP_TABLES:
+                    cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+                    columns = [description[0] for description in cursor.description]
+                    f.write(f"-- {table} {','.join(columns)}\n")
+                    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) TO STDOUT", f)
+                    f.write("\\.\n")
+
+    def restore_from_backup_file(self, backup_file_path):
+        """Восстанавливает все таблицы из полного бэкапа одной транзакцией"""
+        try:
+            backup_path = Path(backup_file_path)
+            if not backup_path.exists():
+                return False, f"Файл бэкапа не найден: {backup_path}"
+            if not backup_path.name.endswith(self.BACKUP_SUFFIX):
+                return False, f"Не бэкап PostgreSQL: {backup_path.name}"
+
+            with gzip.open(backup_path, 'rt', encoding='utf-8') as f:
+                if f.readline() != BACKUP_HEADER:
+                    return False, f"Неизвестный формат бэкапа: {backup_path.name}"
+
+                with self.transaction() as cursor:
+                    cursor.execute(f"TRUNCATE {', '.join(BACKUP_TABLES)}")
+                    while True:
+                        line = f.readline()
+                        if not line:
+                            break
+                        _, table, columns = line.split()
+                        if table not in BACKUP_TABLES:
+                            raise ValueError(f"неизвестная таблица в бэкапе: {table}")
+                        cursor.copy_expert(f"COPY {table} ({columns.replace(',', ', ')}) FROM STDIN",
+                                           _CopySection(f))
+
+                    for table in SERIAL_TABLES:
+                        cursor.execute(f'''SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                                                         COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)''')
+                    cursor.execute('''INSERT INTO admins (user_id, username, added_by) VALUES (%s, %s, %s)
+                                      ON CONFLICT (user_id) DO NOTHING''',
+                                   (Config.SUPER_ADMIN_ID, "Супер-админ", Config.SUPER_ADMIN_ID))
+
+            self.quota_version += 1
+            self.users_version += 1
+            return True, "База данных восстановлена из бэкапа"
+        except Exception as e:
+            logger.error(f"Ошибка восстановления БД: {str(e)}")
+            return False, f"Ошибка восстановления БД: {str(e)}"
+
+    # ========== МЕТОДЫ ОБСЛУЖИВАНИЯ БД ==========
+
+    def get_database_files_size(self):
+        """Размер БД на сервере; WAL и SHM у PostgreSQL общие для кластера - 0"""
+        try:
+            size = self._fetchone("SELECT pg_database_size(current_database())")[0] or 0
+        except Exception as e:
+            logger.error(f"Ошибка получения размера БД: {str(e)}")
+            size = 0
+        return {"db": size, "wal": 0, "shm": 0, "total": size}
+
+    def get_freelist_info(self):
+        """Свободное место PostgreSQL переиспользует сам (autovacuum): (0, 0, 0)"""
+        return 0, 0, 0
+
+    def enable_incremental_vacuum(self):
+        """Для PostgreSQL подготовка не нужна"""
+        return True
+
+    def run_maintenance(self, vacuum_pages=None):
+        """VACUUM ANALYZE таблиц, из которых удаляет политика хранения. Ключи результата - как у SQLite"""
+        start_time = time.time()
+        size_before = self.get_database_files_size()
+
+        conn = self._getconn()
+        ok = True
+        try:
+            # VACUUM не выполняется внутри транзакции
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                for table in ('users', 'user_stats', 'session_backup', 'traffic_log', 'active_sessions'):
+                    cursor.execute(f"VACUUM (ANALYZE) {table}")
+        except Exception as e:
+            ok = False
+            logger.error(f"Ошибка VACUUM: {str(e)}")
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+        size_after = self.get_database_files_size()
+        self.maintenance_requested = False
+
+        result = {
+            "time": datetime.now().isoformat(),
+            "duration": time.time() - start_time,
+            "checkpoint_ok": ok,
+            "freed_pages": 0,
+            "freed_bytes": max(0, size_before["total"] - size_after["total"]),
+            "free_pages_left": 0,
+            "size_before": size_before,
+            "size_after": size_after
+        }
+
+        logger.info(f"Обслуживание БД за {result['duration']:.2f} сек: "
+                    f"размер {size_before['total']} -> {size_after['total']} байт")
+        return result
+
+    # ========== ПОЛИТИКА ХРАНЕНИЯ ИСТОРИИ ==========
+
+    def compact_user_stats(self, cutoff_date, batch_size):
+        """Сжимает одну пачку старых строк user_stats в дневные агрегаты. Возвращает число строк"""
+        with self.transaction() as cursor:
+            cursor.execute('''SELECT * FROM user_stats
+                              WHERE connection_start < %s
+                                AND (status != 'active'
+                                     OR COALESCE(session_id, '') NOT IN (SELECT session_hash FROM active_sessions))
+                              ORDER BY id LIMIT %s
+                              FOR UPDATE''',
+                           (cutoff_date, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return 0
+            columns = [description[0] for description in cursor.description]
+            col = {name: i for i, name in enumerate(columns)}
+            daily = self._daily_aggregates(rows, col)
+
+            # Архив пишется и синхронизируется до удаления: при сбое транзакция откатится
+            archive_batch = self._archive_rows('user_stats', columns, rows, col['connection_start'])
+
+            for (username, stat_date), (count, duration, sent, received) in daily.items():
+                cursor.execute('''INSERT INTO user_stats_daily
+                                  (username, stat_date, sessions_count, duration_seconds, bytes_sent, bytes_received)
+                                  VALUES (%s, %s, %s, %s, %s, %s)
+                                  ON CONFLICT (username, stat_date) DO UPDATE SET
+                                      sessions_count = user_stats_daily.sessions_count + excluded.sessions_count,
+                                      duration_seconds = user_stats_daily.duration_seconds + excluded.duration_seconds,
+                                      bytes_sent = user_stats_daily.bytes_sent + excluded.bytes_sent,
+                                      bytes_received = user_stats_daily.bytes_received + excluded.bytes_received''',
+                               (username, stat_date, count, duration, sent, received))
+
+            cursor.execute("DELETE FROM user_stats WHERE id = ANY(%s)", ([row[col['id']] for row in rows],))
+            self.set_monitor_state('archive_user_stats', archive_batch)
+        return len(rows)
+
+    def prune_session_backup(self, cutoff_date, batch_size):
+        """Архивирует и удаляет одну пачку старых строк session_backup. Возвращает число строк"""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT * FROM session_backup WHERE end_time < %s ORDER BY id LIMIT %s FOR UPDATE",
+                           (cutoff_date, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return 0
+            columns = [description[0] for description in cursor.description]
+            id_index = columns.index('id')
+
+            archive_batch = self._archive_rows('session_backup', columns, rows, columns.index('end_time'))
+            cursor.execute("DELETE FROM session_backup WHERE id = ANY(%s)", ([row[id_index] for row in rows],))
+            self.set_monitor_state('archive_session_backup', archive_batch)
+        return len(rows)
@@ -0,0 +1,67 @@
+import logging
+import threading
+from collections import OrderedDict
+from metrics import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache:
+    """Кэш отрисованных страниц (текст + клавиатура) по ключу с версией данных.
+
+    Ключ включает db.users_version, поэтому при изменении данных старые
+    страницы просто перестают запрашиваться и вытесняются. Дополнительно
+    помнит, какая версия страницы сейчас показана в каждом сообщении, чтобы
+    не отправлять в Telegram правку, которая ничего не меняет.
+    """
+
+    def __init__(self):
+        self.pages = OrderedDict()  # {key: значение render()}
+        self.shown = OrderedDict()  # {(chat_id, message_id): key}
+        self.lock = threading.Lock()
+        self.hits_count = 0
+        self.misses_count = 0
+
+    def get(self, key, render):
+        """Возвращает закэшированное значение или вызывает render() и запоминает результат"""
+        with self.lock:
+            if key in self.pages:
+                self.pages.move_to_end(key)
+                self.hits_count += 1
+                metrics.inc('vpnbot_render_cache_total', result='hit')
+                return self.pages[key]
+
+        value = render()
+
+        with self.lock:
+            self.misses_count += 1
+            self.pages[key] = value
+            while len(self.pages) > Config.RENDER_CACHE_SIZE:
+                self.pages.popitem(last=False)
+        metrics.inc('vpnbot_render_cache_total', result='miss')
+        return value
+
+    def is_shown(self, chat_id, message_id, key):
+        """True, если в сообщении уже показана именно эта страница"""
+        with self.lock:
+            return self.shown.get((chat_id, message_id)) == key
+
+    def mark_shown(self, chat_id, message_id, key):
+        with self.lock:
+            self.shown[(chat_id, message_id)] = key
+            self.shown.move_to_end((chat_id, message_id))
+            while len(self.shown) > Config.RENDER_SHOWN_LIMIT:
+                self.shown.popitem(last=False)
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "pages": len(self.pages),
+                "hits": self.hits_count,
+                "misses": self.misses_count
+            }
+
+
+# Глобальный кэш отрисованных страниц
+render_cache = RenderCache()
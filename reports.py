@@ -0,0 +1,117 @@
+import io
+import csv
+import logging
+import tempfile
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class ReportBuilder:
+    """Отчет, который собирается по записям и отправляется целиком.
+
+    Текст копится в буфере, пока помещается в одно сообщение. Если не помещается,
+    отчет уходит одним документом: CSV (когда заданы columns) или TXT с тем же
+    текстом. Документ пишется во временный файл, который до REPORT_SPOOL_SIZE
+    живет в памяти, а дальше - на диске.
+    """
+
+    def __init__(self, title, filename, columns=None, code=False):
+        self.title = title
+        self.filename = filename
+        self.columns = columns
+        self.code = code  # текст сообщения в блоке кода Markdown
+        self.limit = Config.REPORT_MESSAGE_LIMIT - (6 if code else 0)
+
+        self.text = io.StringIO()
+        self.text.write(title)
+        self.length = len(title)
+        self.rows_count = 0
+
+        self.spool = None
+        self.line = None  # буфер одной строки CSV перед записью в файл
+        self.writer = None
+        if columns:
+            self._open_spool()
+            self.line = io.StringIO()
+            self.writer = csv.writer(self.line)
+            self._write_row(columns)
+
+    def _open_spool(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=Config.REPORT_SPOOL_SIZE, mode='w+b')
+
+    def _write_row(self, row):
+        self.writer.writerow(row)
+        self.spool.write(self.line.getvalue().encode('utf-8'))
+        self.line.seek(0)
+        self.line.truncate()
+
+    @property
+    def overflow(self):
+        return self.text is None
+
+    def _spill(self):
+        """Текст больше не помещается в сообщение - дальше пишем только в файл"""
+        if not self.columns:
+            self._open_spool()
+            self.spool.write(self.text.getvalue().encode('utf-8'))
+        self.text = None
+
+    def add(self, text, row=None):
+        """Добавляет запись: text - для сообщения и TXT, row - строка CSV"""
+        self.rows_count += 1
+
+        if self.writer is not None and row is not None:
+            self._write_row(row)
+
+        if self.text is not None:
+            if self.length + len(text) > self.limit:
+                self._spill()
+            else:
+                self.text.write(text)
+                self.length += len(text)
+                return
+
+        if not self.columns:
+            self.spool.write(text.encode('utf-8'))
+
+    def extend(self, records):
+        """Добавляет записи из генератора пар (text, row)"""
+        for text, row in records:
+            self.add(text, row)
+        return self
+
+    def send(self, bot, chat_id, footer=""):
+        """Отправляет отчет сообщением, а если он длинный - документом"""
+        try:
+            if self.text is not None and self.length + len(footer) > self.limit:
+                self._spill()
+
+            if self.text is not None:
+                self.text.write(footer)
+                text = self.text.getvalue()
+                if self.code:
+                    bot.send_message(chat_id, f"```{text}```", parse_mode='Markdown').wait()
+                else:
+                    bot.send_message(chat_id, text).wait()
+                return True
+
+            if not self.columns:
+                self.spool.write(footer.encode('utf-8'))
+
+            extension = 'csv' if self.columns else 'txt'
+            caption = f"{self.title.strip()}\n{footer.strip()}\n📄 Записей: {self.rows_count}".strip()
+            self.spool.seek(0)
+            bot.send_document(chat_id, self.spool, caption=caption[:1024],
+                              visible_file_name=f"{self.filename}.{extension}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка отправки отчета {self.filename}: {str(e)}")
+            return False
+        finally:
+            self.close()
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
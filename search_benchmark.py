@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Замер поиска пользователей (db.search_users) на синтетической БД.
+
+Создает временную БД с заданным числом пользователей, проверяет, что каждый
+запрос идет по индексу (EXPLAIN QUERY PLAN), и печатает время запроса.
+
+    python3 search_benchmark.py [пользователей]
+"""
+import sys
+import time
+import random
+import string
+import tempfile
+from pathlib import Path
+
+from config import Config
+
+QUERIES = (
+    ("префикс, 50 по имени", "ab", dict(order_by_name=True, limit=50)),
+    ("точное имя", None, dict(order_by_name=True, limit=50)),
+    ("подстрока (FTS5)", "*xyz", dict(order_by_name=True, limit=50)),
+    ("подстрока 2 символа", "*xy", dict(order_by_name=True, limit=50)),
+    ("создатель (имя)", "admin:@admin3", dict(order_by_name=True, limit=50)),
+    ("создатель (id)", "admin:3", dict(order_by_name=True, limit=50)),
+    ("активные", "active", dict(order_by_name=True, limit=50)),
+    ("не заходили 30 дней", "unseen:30d", dict(order_by_name=True, limit=50)),
+    ("подстрока + активные", "*xyz active", {}),
+)
+
+
+def generate(db, users):
+    random.seed(42)
+    names = set()
+    while len(names) < users:
+        names.add("".join(random.choices(string.ascii_lowercase + string.digits, k=random.randint(5, 12))))
+
+    rows = []
+    for name in names:
+        admin = random.randint(1, 20)
+        days_ago = random.choice([None, random.randint(0, 90)])
+        rows.append((name, admin, f"@admin{admin}", 1 if random.random() < 0.05 else 0,
+                     None if days_ago is None else f"-{days_ago} days"))
+    db.conn.executemany('''INSERT INTO users (username, created_by, created_by_username, is_active, last_connected)
+                           VALUES (?, ?, ?, ?, CASE WHEN ? IS NULL THEN NULL ELSE datetime('now', ?) END)''',
+                        [(name, admin, admin_name, active, seen, seen) for name, admin, admin_name, active, seen in rows])
+    db.commit()
+    return sorted(names)
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    Config.DB_PATH = Path(tempfile.mkdtemp()) / 'search_benchmark.db'
+    from database import db
+    from user_search import parse_query
+
+    names = generate(db, users)
+    print(f"🔍 Пользователей: {users}, FTS5: {'да' if db.users_fts else 'нет'}\n")
+    print(f"{'запрос':<24} {'найдено':>8} {'время':>10}  план")
+
+    for title, query, extra in QUERIES:
+        query = query or names[len(names) // 2]
+        filters, error = parse_query(query)
+        if error:
+            print(f"{title:<24} ошибка разбора: {error}")
+            continue
+
+        # План того же SQL, что выполнит search_users
+        captured = []
+        original = db.fetch_rows
+        db.fetch_rows = lambda row_class, sql, params=(): captured.append((sql, params)) or []
+        db.search_users(**filters, **extra)
+        db.fetch_rows = original
+        plan = db.execute("EXPLAIN QUERY PLAN " + captured[0][0], captured[0][1]).fetchall()
+        plan = "; ".join(row[3] for row in plan)
+
+        best = None
+        found = 0
+        for _ in range(20):
+            start = time.perf_counter()
+            found = len(db.search_users(**filters, **extra))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(f"{title:<24} {found:>8} {best * 1000:8.3f}мс  {plan}")
+
+    db.conn.close()
+
+
+if __name__ == "__main__":
+    main()
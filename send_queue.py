@@ -0,0 +1,248 @@
+import time
+import logging
+import threading
+from collections import deque
+from metrics import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class SendJob:
+    __slots__ = ('chat_id', 'method', 'args', 'kwargs', 'created', 'retries', 'done', 'result', 'error')
+
+    def __init__(self, chat_id, method, args, kwargs):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.created = time.time()
+        self.retries = 0
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def is_coalescible(self):
+        """Короткий текст без разметки и клавиатуры можно склеить с соседними"""
+        return (self.method == 'send_message' and not self.kwargs and len(self.args) == 1
+                and isinstance(self.args[0], str) and len(self.args[0]) <= Config.SEND_COALESCE_MAX)
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class PendingMessage:
+    """Результат send_message через очередь: сообщение отправляется асинхронно.
+
+    Ошибки отправки пишет в лог воркер. Кому нужен отправленный Message или
+    подтверждение отправки, вызывает wait(): он возвращает Message или
+    выбрасывает ошибку отправки.
+    """
+
+    def __init__(self, job):
+        self._job = job
+
+    def wait(self, timeout=None):
+        if not self._job.done.wait(timeout or Config.SEND_WAIT_TIMEOUT):
+            raise TimeoutError("Сообщение не отправлено: очередь отправки не успела")
+        if self._job.error is not None:
+            raise self._job.error
+        return self._job.result
+
+
+class SendQueue:
+    """Очередь исходящих сообщений Telegram.
+
+    Соблюдает лимиты на чат и общий (GCRA: интервал + допустимый всплеск), повторяет
+    отправку после 429 через retry_after, склеивает подряд идущие короткие тексты
+    в один чат и сохраняет порядок сообщений внутри чата.
+    """
+
+    def __init__(self):
+        self.chats = {}  # {chat_id: deque(SendJob)}
+        self.chat_tat = {}  # {chat_id: теоретическое время следующей отправки}
+        self.global_tat = 0
+        self.paused_until = {}  # {chat_id: время окончания retry_after}
+        self.global_paused_until = 0
+        self.busy = set()
+        self.depth = 0
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.cond = threading.Condition()
+        self.direct = {}  # исходные методы бота
+        self.workers = []
+
+    def install(self, bot):
+        """Направляет bot.send_message и bot.send_document через очередь"""
+        if self.direct:
+            return
+
+        self.direct = {
+            'send_message': bot.send_message,
+            'send_document': bot.send_document
+        }
+
+        def queued_send_message(chat_id, text, *args, **kwargs):
+            return PendingMessage(self.put(chat_id, 'send_message', (text,) + args, kwargs))
+
+        def queued_send_document(chat_id, document, *args, **kwargs):
+            # Файл читается воркером, пока вызывающий держит его открытым, поэтому ждем
+            job = self.put(chat_id, 'send_document', (document,) + args, kwargs)
+            return PendingMessage(job).wait()
+
+        bot.send_message = queued_send_message
+        bot.send_document = queued_send_document
+
+        for i in range(max(1, Config.SEND_WORKERS)):
+            worker = threading.Thread(target=self._worker, daemon=True, name=f"SendQueue-{i}")
+            worker.start()
+            self.workers.append(worker)
+
+        logger.info(f"Очередь отправки запущена ({len(self.workers)} потоков)")
+
+    def put(self, chat_id, method, args, kwargs):
+        job = SendJob(chat_id, method, args, kwargs)
+        with self.cond:
+            self.chats.setdefault(chat_id, deque()).append(job)
+            self.depth += 1
+            metrics.set('vpnbot_send_queue_depth', self.depth)
+            self.cond.notify()
+        return job
+
+    def _next_ready(self, now):
+        """Выбирает чат, готовый к отправке. Возвращает (chat_id, None) или (None, сколько ждать)"""
+        wait = None
+
+        global_ready = max(self.global_paused_until,
+                           self.global_tat - Config.SEND_GLOBAL_BURST / Config.SEND_GLOBAL_RATE)
+        if global_ready > now:
+            return None, global_ready - now
+
+        for chat_id, jobs in self.chats.items():
+            if not jobs or chat_id in self.busy:
+                continue
+
+            ready_at = max(self.paused_until.get(chat_id, 0),
+                           self.chat_tat.get(chat_id, 0) - Config.SEND_CHAT_BURST / Config.SEND_CHAT_RATE)
+            head = jobs[0]
+            if head.is_coalescible():
+                # Короткий текст чуть ждет соседей, чтобы уйти одним сообщением
+                ready_at = max(ready_at, head.created + Config.SEND_COALESCE_DELAY)
+
+            if ready_at <= now:
+                return chat_id, None
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+
+        return None, wait
+
+    def _take(self, chat_id):
+        """Снимает голову очереди чата и склеивает с ней подряд идущие короткие тексты"""
+        jobs = self.chats[chat_id]
+        batch = [jobs.popleft()]
+
+        if batch[0].is_coalescible():
+            length = len(batch[0].args[0])
+            while jobs and jobs[0].is_coalescible():
+                next_length = length + 2 + len(jobs[0].args[0])
+                if next_length > Config.SEND_MESSAGE_LIMIT:
+                    break
+                batch.append(jobs.popleft())
+                length = next_length
+
+        if not jobs:
+            del self.chats[chat_id]
+        return batch
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    chat_id, wait = self._next_ready(now)
+                    if chat_id is not None:
+                        break
+                    self.cond.wait(wait)
+
+                batch = self._take(chat_id)
+                self.busy.add(chat_id)
+                self.chat_tat[chat_id] = max(self.chat_tat.get(chat_id, 0), now) + 1 / Config.SEND_CHAT_RATE
+                self.global_tat = max(self.global_tat, now) + 1 / Config.SEND_GLOBAL_RATE
+
+            self._send(chat_id, batch)
+
+    def _send(self, chat_id, batch):
+        head = batch[0]
+        args = head.args
+        if len(batch) > 1:
+            args = ("\n\n".join(job.args[0] for job in batch),)
+        elif head.retries and hasattr(args[0], 'seek'):
+            # Повтор отправки файла - читаем его с начала
+            args[0].seek(0)
+
+        result, error, retry_after = None, None, None
+        try:
+            result = self.direct[head.method](chat_id, *args, **head.kwargs)
+        except Exception as e:
+            retry_after = self._get_retry_after(e)
+            error = e
+
+        with self.cond:
+            self.busy.discard(chat_id)
+
+            if retry_after is not None and head.retries < Config.SEND_MAX_RETRIES:
+                # 429: возвращаем пачку в начало очереди чата и ждем, сколько просит Telegram
+                for job in batch:
+                    job.retries += 1
+                self.chats.setdefault(chat_id, deque()).extendleft(reversed(batch))
+                pause_until = time.time() + retry_after
+                self.paused_until[chat_id] = pause_until
+                if retry_after >= Config.SEND_GLOBAL_PAUSE_THRESHOLD:
+                    # Долгая пауза - ограничение на весь бот, а не на один чат
+                    self.global_paused_until = max(self.global_paused_until, pause_until)
+                metrics.inc('vpnbot_send_retries_total')
+                logger.warning(f"Telegram 429 для чата {chat_id}, повтор через {retry_after} сек")
+                self.cond.notify_all()
+                return
+
+            self.depth -= len(batch)
+            metrics.set('vpnbot_send_queue_depth', self.depth)
+            if error is None:
+                self.sent_count += 1
+                self.coalesced_count += len(batch) - 1
+                if len(batch) > 1:
+                    metrics.inc('vpnbot_send_coalesced_total', len(batch) - 1)
+            self.cond.notify_all()
+
+        now = time.time()
+        for job in batch:
+            metrics.observe('vpnbot_send_latency_seconds', now - job.created, method=job.method)
+            job.finish(result, error)
+
+        if error is not None:
+            metrics.inc('vpnbot_send_errors_total', method=head.method)
+            logger.error(f"Ошибка отправки в чат {chat_id}: {str(error)}")
+
+    @staticmethod
+    def _get_retry_after(error):
+        if getattr(error, 'error_code', None) != 429:
+            return None
+        try:
+            return int(error.result_json.get('parameters', {}).get('retry_after', 1))
+        except (AttributeError, TypeError, ValueError):
+            return 1
+
+    def get_status(self):
+        with self.cond:
+            return {
+                "depth": self.depth,
+                "chats": len(self.chats),
+                "sent": self.sent_count,
+                "coalesced": self.coalesced_count,
+                "paused_chats": sum(1 for until in self.paused_until.values() if until > time.time())
+            }
+
+
+# Глобальная очередь исходящих сообщений
+send_queue = SendQueue()
@@ -0,0 +1,574 @@
+import logging
+import time
+import json
+import gzip
+import os
+import re
+import hashlib
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import datetime, timedelta
+from config import Config
+from alerts import alerts
+
+logger = logging.getLogger(__name__)
+
+# Строки users: полная и проекции для списков. Колонки перечислены явно -
+# в старых БД после миграций порядок колонок в SELECT * другой
+UserRow = namedtuple('UserRow', (
+    'id', 'username', 'created_by', 'created_by_username', 'created_at', 'total_connections',
+    'last_connected', 'total_bytes_sent', 'total_bytes_received', 'is_active', 'last_updated',
+    'quota_daily', 'quota_monthly', 'quota_total', 'quota_action'
+))
+UserSummary = namedtuple('UserSummary', (
+    'username', 'created_by_username', 'created_at', 'total_connections', 'last_connected',
+    'total_bytes_sent', 'total_bytes_received', 'is_active'
+))
+UserStatus = namedtuple('UserStatus', ('username', 'created_by_username', 'is_active'))
+
+USER_SUMMARY_COLUMNS = '''username, created_by_username, created_at, COALESCE(total_connections, 0),
+                          last_connected, COALESCE(total_bytes_sent, 0), COALESCE(total_bytes_received, 0),
+                          COALESCE(is_active, 0)'''
+
+# Таблица выгрузки -> колонка, по которой фильтруется период
+EXPORT_TABLES = {
+    'traffic_log': 'log_date',
+    'user_stats': 'connection_start',
+    'session_backup': 'end_time',
+}
+
+
+class Storage(ABC):
+    """Хранилище бота: пользователи, администраторы, сессии, трафик, бэкапы.
+
+    Реализации - Database (SQLite, database.py) и PostgresStorage (postgres_storage.py),
+    выбирается по Config.STORAGE_BACKEND. Здесь общая часть, не зависящая от СУБД
+    (файлы бэкапов, архивы политики хранения, счетчики версий для кэшей); запросы -
+    в реализациях (абстрактные методы: реализация без них не создается). Время хранится
+    строками 'YYYY-MM-DD HH:MM:SS' (UTC), как в SQLite.
+    """
+
+    # Расширение файлов полного бэкапа (по нему бэкапы отличаются от JSON-описаний)
+    BACKUP_SUFFIX = '.db'
+
+    def __init__(self):
+        self.backup_dir = Config.BACKUP_DIR
+        # Выставляется после массовых DELETE, чтобы обслуживание прошло в ближайшее окно простоя
+        self.maintenance_requested = False
+        # Увеличивается при изменении квот и обнулении трафика: монитор перечитывает счетчики квот
+        self.quota_version = 0
+        # Увеличивается при любом изменении того, что видно в списках пользователей
+        # (состав, трафик, активность): по нему сбрасываются отрисованные страницы
+        self.users_version = 0
+        self.users_fts = False  # есть ли индекс для поиска по подстроке
+
+    # ========== ПОЛЬЗОВАТЕЛИ ==========
+
+    @abstractmethod
+    def user_exists(self, username):
+        pass
+
+    @abstractmethod
+    def add_user(self, username, created_by, created_by_username):
+        """True, если добавлен; False, если такой уже есть"""
+
+    @abstractmethod
+    def ensure_user_exists(self, username):
+        """Создает пользователя, которого видно в ipsec, но нет в БД"""
+
+    @abstractmethod
+    def get_all_users(self):
+        """[UserRow], новые первыми"""
+
+    @abstractmethod
+    def get_user(self, username):
+        """UserRow или None"""
+
+    @abstractmethod
+    def get_user_summaries(self, created_by=None, order_by_traffic=False, limit=None):
+        """[UserSummary] для списков"""
+
+    @abstractmethod
+    def get_user_statuses(self, created_by=None):
+        """[UserStatus] для кнопок выбора"""
+
+    @abstractmethod
+    def search_users(self, name=None, substring=False, admin=None, is_active=None, seen_within=None,
+                     unseen_for=None, order_by_name=False, limit=None, offset=0):
+        """[UserSummary] по фильтрам user_search.parse_query"""
+
+    @abstractmethod
+    def get_usernames(self, created_by=None):
+        pass
+
+    @abstractmethod
+    def delete_user(self, username):
+        """Удаляет пользователя (с JSON-бэкапом его данных)"""
+
+    @abstractmethod
+    def clear_all_users(self):
+        """Удаляет всех пользователей и историю (после полного бэкапа)"""
+
+    @abstractmethod
+    def get_user_count(self):
+        pass
+
+    @abstractmethod
+    def get_active_users_count(self):
+        pass
+
+    @abstractmethod
+    def get_user_statistics(self, username):
+        """Итоги пользователя, трафик за 30 дней и число активных сессий (dict) или None"""
+
+    # ========== КВОТЫ ==========
+
+    @abstractmethod
+    def get_user_quotas(self):
+        """{username: {'created_by', 'daily', 'monthly', 'total', 'action'}} - только с ограничениями"""
+
+    @abstractmethod
+    def set_user_quota(self, username, kind=None, limit=None, action=None):
+        pass
+
+    @abstractmethod
+    def get_quota_usage(self, username, day, month_start):
+        """(за день, за месяц, всего) байт"""
+
+    # ========== АДМИНИСТРАТОРЫ ==========
+
+    @abstractmethod
+    def is_admin(self, user_id):
+        pass
+
+    def is_super_admin(self, user_id):
+        return user_id == Config.SUPER_ADMIN_ID
+
+    @abstractmethod
+    def get_all_admins(self):
+        """[(user_id, username, added_at, кем добавлен)]"""
+
+    @abstractmethod
+    def add_admin(self, user_id, username, added_by):
+        pass
+
+    @abstractmethod
+    def delete_admin(self, user_id):
+        pass
+
+    # ========== ТРАФИК ==========
+
+    @abstractmethod
+    def update_traffic(self, username, bytes_sent_diff, bytes_received_diff, connection_id=None):
+        pass
+
+    @abstractmethod
+    def apply_traffic_batch(self, entries, journal_seq=None):
+        """Записывает дельты монитора одной транзакцией вместе с seq журнала.
+
+        entries: [(username, connection_id, sent_diff, received_diff, absolute_sent, absolute_received)]
+        """
+
+    @abstractmethod
+    def get_daily_traffic(self, date_from, date_to, username=None):
+        """[(log_date, sent, received)] за период, по пользователю или по серверу"""
+
+    @abstractmethod
+    def get_traffic_version(self, username=None):
+        """Метка последнего изменения трафика для кэшей"""
+
+    @abstractmethod
+    def get_history_rows(self, date_from, date_to):
+        """Строки для аналитики за период (включительно):
+        ([(username, log_date, байт за день)], [(username, connection_start, duration_seconds, байт)])
+        """
+
+    @abstractmethod
+    def get_last_session_id(self):
+        """Наибольший id в user_stats (метка появления новых сессий) или None"""
+
+    @abstractmethod
+    def export_query(self, table, date_from=None, date_to=None, usernames=None):
+        """Контекстный менеджер выгрузки: (колонки, целочисленные колонки, итератор пачек строк).
+
+        Строки читаются пачками по EXPORT_BATCH_SIZE, не мешая записи монитора.
+        """
+
+    @abstractmethod
+    def reset_all_traffic(self):
+        pass
+
+    @abstractmethod
+    def reset_user_traffic(self, username):
+        pass
+
+    # ========== СЕССИИ ==========
+
+    def create_session_hash(self, username, connection_id, client_ip):
+        """Создает уникальный хэш для сессии"""
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        data = f"{username}_{connection_id}_{client_ip}_{timestamp}"
+        return hashlib.md5(data.encode()).hexdigest()[:16]
+
+    @abstractmethod
+    def register_session(self, username, connection_id, client_ip, absolute_sent, absolute_received):
+        """Продолжает сессию (username, connection_id) или открывает новую; возвращает ее хэш или None"""
+
+    @abstractmethod
+    def get_session_base(self, username):
+        """Счетчики последней сессии пользователя: (sent, received, connection_id) или None"""
+
+    @abstractmethod
+    def get_active_sessions(self):
+        """[(username, connection_id, session_hash, last_bytes_sent, last_bytes_received)]"""
+
+    @abstractmethod
+    def finalize_session(self, username, connection_id, session_hash, reason="normal_disconnect", commit=True):
+        pass
+
+    def finalize_all_sessions(self, reason="shutdown", deadline=None):
+        """Завершает все активные сессии одной транзакцией. Возвращает (завершено, всего)"""
+        sessions = [(username, connection_id, session_hash)
+                    for username, connection_id, session_hash, _, _ in self.get_active_sessions()]
+        return self.finalize_sessions(sessions, reason, deadline)
+
+    @abstractmethod
+    def finalize_sessions(self, sessions, reason, deadline=None):
+        """Завершает сессии [(username, connection_id, session_hash)]; возвращает (завершено, всего)"""
+
+    @abstractmethod
+    def cleanup_old_sessions(self, active_usernames):
+        pass
+
+    # ========== ФЛОТ УЗЛОВ ==========
+
+    @abstractmethod
+    def apply_fleet_push(self, node_id, url, ticks, active_usernames, users_count, epoch=None):
+        """Применяет дельты тиков узла; возвращает последний учтенный seq или None"""
+
+    @staticmethod
+    def _fleet_epoch_seq(node_id, last_seq, stored_epoch, epoch):
+        """Учтенный seq узла с учетом смены epoch (БД узла пересоздана - seq начинается с 1)"""
+        if epoch and stored_epoch and epoch != stored_epoch:
+            logger.warning(f"Узел {node_id} начал журнал заново (новая БД узла), "
+                           f"учтенный seq {last_seq} сброшен")
+            return 0
+        return last_seq or 0
+
+    @abstractmethod
+    def get_fleet_nodes(self):
+        """[(node_id, url, last_seq, users_count, last_push)]"""
+
+    @abstractmethod
+    def get_user_node(self, username):
+        pass
+
+    @abstractmethod
+    def set_user_node(self, username, node_id):
+        pass
+
+    @abstractmethod
+    def delete_user_node(self, username):
+        pass
+
+    @abstractmethod
+    def get_node_user_counts(self):
+        """{node_id: число пользователей}"""
+
+    # ========== СОСТОЯНИЕ МОНИТОРА ==========
+
+    @abstractmethod
+    def get_monitor_state(self, key, default=None):
+        pass
+
+    @abstractmethod
+    def set_monitor_state(self, key, value, commit=True):
+        pass
+
+    @abstractmethod
+    def get_monitor_stopped_at(self):
+        """Unix-время последней записи warm_state/journal_seq (момент остановки монитора) или None"""
+
+    # ========== РЕЗЕРВНОЕ КОПИРОВАНИЕ ==========
+
+    @abstractmethod
+    def _select_user_rows(self, table, username, order_column=None):
+        """Все строки таблицы пользователя как словари (для JSON-бэкапа)"""
+
+    @abstractmethod
+    def _write_full_backup(self, backup_file):
+        """Пишет полную копию БД в файл backup_file"""
+
+    @abstractmethod
+    def restore_from_backup_file(self, backup_file_path):
+        """Восстанавливает БД из файла полного бэкапа: (успех, сообщение)"""
+
+    def backup_user_data(self, username, reason):
+        """Создает резервную копию данных пользователя"""
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            backup_file = self.backup_dir / f"user_{username}_{timestamp}.json"
+
+            users = self._select_user_rows('users', username)
+            user_data = {
+                "username": username,
+                "backup_time": datetime.now().isoformat(),
+                "backup_reason": reason,
+                "user_info": users[0] if users else None,
+                "stats": self._select_user_rows('user_stats', username, 'connection_start'),
+                "stats_daily": self._select_user_rows('user_stats_daily', username, 'stat_date'),
+                "traffic_logs": self._select_user_rows('traffic_log', username, 'log_date')
+            }
+
+            with open(backup_file, 'w', encoding='utf-8') as f:
+                json.dump(user_data, f, ensure_ascii=False, indent=2, default=str)
+
+            logger.info(f"Создана резервная копия данных пользователя {username}")
+            return str(backup_file)
+
+        except Exception as e:
+            logger.error(f"Ошибка создания резервной копии для {username}: {str(e)}")
+            return None
+
+    def create_full_backup(self, reason="manual"):
+        """Создает полную резервную копию базы данных"""
+        try:
+            self.backup_dir.mkdir(parents=True, exist_ok=True)
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            backup_file = self.backup_dir / f"full_backup_{timestamp}{self.BACKUP_SUFFIX}"
+
+            self._write_full_backup(backup_file)
+
+            json_file = self.backup_dir / f"full_backup_{timestamp}.json"
+
+            backup_data = {
+                "backup_time": datetime.now().isoformat(),
+                "backup_reason": reason,
+                "database_file": str(backup_file),
+                "summary": {
+                    "total_users": self.get_user_count(),
+                    "total_admins": len(self.get_all_admins())
+                }
+            }
+
+            with open(json_file, 'w', encoding='utf-8') as f:
+                json.dump(backup_data, f, ensure_ascii=False, indent=2, default=str)
+
+            # Очищаем старые бэкапы
+            self.cleanup_old_backups()
+
+            logger.info(f"Создана полная резервная копия: {backup_file}")
+            alerts.resolve('backup', "Резервное копирование снова работает")
+            return str(backup_file)
+
+        except Exception as e:
+            logger.error(f"Ошибка создания полной резервной копии: {str(e)}")
+            alerts.raise_alert('backup', f"Ошибка создания резервной копии ({reason}): {str(e)}", 'critical')
+            return None
+
+    def get_last_full_backup_age(self):
+        """Возвращает возраст последнего полного бэкапа в секундах или None"""
+        try:
+            mtimes = [f.stat().st_mtime for f in self.backup_dir.glob(f"full_backup_*{self.BACKUP_SUFFIX}")
+                      if f.is_file()]
+            if not mtimes:
+                return None
+            return max(0, time.time() - max(mtimes))
+        except Exception as e:
+            logger.error(f"Ошибка определения возраста бэкапа: {str(e)}")
+            return None
+
+    def cleanup_old_backups(self):
+        """Удаляет старые резервные копии"""
+        try:
+            cutoff_date = datetime.now() - timedelta(days=Config.BACKUP_RETENTION_DAYS)
+
+            for backup_file in self.backup_dir.glob("*"):
+                if backup_file.is_file():
+                    file_time = datetime.fromtimestamp(backup_file.stat().st_mtime)
+                    if file_time < cutoff_date:
+                        backup_file.unlink()
+                        logger.info(f"Удален старый бэкап: {backup_file.name}")
+
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка очистки старых бэкапов: {str(e)}")
+            return False
+
+    def get_backup_info(self):
+        """Возвращает информацию о резервных копиях"""
+        try:
+            backups = []
+            db_backups = []
+            total_size = 0
+            db_total_size = 0
+
+            def _display_time(file_path):
+                # Для full_backup_YYYYMMDD_HHMMSS.* берем время из имени файла,
+                # потому что mtime может быть одинаковым при copy2/WAL.
+                match = re.match(r"^full_backup_(\d{8})_(\d{6})\.", file_path.name)
+                if match:
+                    try:
+                        return datetime.strptime(
+                            f"{match.group(1)}_{match.group(2)}",
+                            "%Y%m%d_%H%M%S"
+                        )
+                    except Exception:
+                        pass
+                return datetime.fromtimestamp(file_path.stat().st_mtime)
+
+            for backup_file in sorted(self.backup_dir.glob("*"), key=_display_time, reverse=True):
+                if backup_file.is_file():
+                    display_dt = _display_time(backup_file)
+                    file_info = {
+                        "name": backup_file.name,
+                        "size": backup_file.stat().st_size,
+                        "modified": display_dt.isoformat(),
+                        "path": str(backup_file)
+                    }
+                    backups.append(file_info)
+                    total_size += file_info["size"]
+                    if backup_file.name.endswith(self.BACKUP_SUFFIX):
+                        db_backups.append(file_info)
+                        db_total_size += file_info["size"]
+
+            return {
+                "total_backups": len(backups),
+                "total_size": total_size,
+                "total_db_backups": len(db_backups),
+                "db_total_size": db_total_size,
+                # Оставляем общие файлы для совместимости
+                "backups": backups[:10],
+                # Отдельно список реальных бэкапов БД
+                "db_backups": db_backups[:10]
+            }
+        except Exception as e:
+            logger.error(f"Ошибка получения информации о бэкапах: {str(e)}")
+            return {
+                "total_backups": 0,
+                "total_size": 0,
+                "total_db_backups": 0,
+                "db_total_size": 0,
+                "backups": [],
+                "db_backups": []
+            }
+
+    # ========== ОБСЛУЖИВАНИЕ БД ==========
+
+    @abstractmethod
+    def get_database_files_size(self):
+        """{'db', 'wal', 'shm', 'total'} в байтах"""
+
+    def get_database_size(self):
+        """Возвращает реальный размер базы данных на диске в байтах"""
+        return self.get_database_files_size()["total"]
+
+    @abstractmethod
+    def get_freelist_info(self):
+        """(свободных страниц, размер страницы, режим auto_vacuum)"""
+
+    @abstractmethod
+    def enable_incremental_vacuum(self):
+        """Однократная подготовка хранилища к обслуживанию при запуске. True, если готово"""
+
+    @abstractmethod
+    def run_maintenance(self, vacuum_pages=None):
+        """Обслуживание в окне простоя; словарь с результатами (см. Database.run_maintenance)"""
+
+    # ========== ПОЛИТИКА ХРАНЕНИЯ ИСТОРИИ ==========
+
+    @abstractmethod
+    def compact_user_stats(self, cutoff_date, batch_size):
+        """Сжимает одну пачку старых строк user_stats в дневные агрегаты. Возвращает число строк"""
+
+    @abstractmethod
+    def prune_session_backup(self, cutoff_date, batch_size):
+        """Архивирует и удаляет одну пачку старых строк session_backup. Возвращает число строк"""
+
+    def _archive_rows(self, table, columns, rows, date_index):
+        """Пишет пачку строк в сжатые архивы archive/<table>_YYYY-MM_<номер пачки>.jsonl.gz.
+
+        Номер пачки сохраняется (archive_<table> в monitor_state) той же транзакцией, что удаляет
+        строки. Если удаление не прошло, следующая попытка получит тот же номер и перезапишет
+        файлы пачки, так что строки не попадут в архив дважды. Возвращает номер пачки.
+        """
+        batch = int(self.get_monitor_state(f"archive_{table}", 0)) + 1
+        by_month = {}
+        for row in rows:
+            month = str(row[date_index] or "unknown")[:7]
+            by_month.setdefault(month, []).append(row)
+
+        Config.ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+        # Файлы прерванной попытки с тем же номером (месяцы могли быть другими)
+        for stale_file in Config.ARCHIVE_DIR.glob(f"{table}_*_{batch:06d}.jsonl.gz"):
+            stale_file.unlink()
+
+        for month, month_rows in by_month.items():
+            archive_file = Config.ARCHIVE_DIR / f"{table}_{month}_{batch:06d}.jsonl.gz"
+            temp_file = archive_file.with_name(archive_file.name + '.tmp')
+            with open(temp_file, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                    for row in month_rows:
+                        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str)
+                        f.write(line.encode('utf-8') + b"\n")
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(temp_file, archive_file)
+        return batch
+
+    @staticmethod
+    def _daily_aggregates(rows, col):
+        """Строки user_stats -> {(username, дата): [сессий, секунд, отправлено, получено]}"""
+        daily = {}
+        for row in rows:
+            key = (row[col['username']], str(row[col['connection_start']])[:10])
+            agg = daily.setdefault(key, [0, 0, 0, 0])
+            agg[0] += 1
+            agg[1] += row[col['duration_seconds']] or 0
+            agg[2] += row[col['bytes_sent']] or 0
+            agg[3] += row[col['bytes_received']] or 0
+        return daily
+
+    def apply_retention(self, max_batches=None):
+        """Применяет политику хранения ограниченным числом пачек.
+
+        Возвращает словарь: сколько строк обработано и остались ли еще старые строки.
+        """
+        if max_batches is None:
+            max_batches = Config.RETENTION_MAX_BATCHES
+        batch_size = Config.RETENTION_BATCH_SIZE
+
+        now = datetime.now()
+        stats_cutoff = (now - timedelta(days=Config.STATS_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        backup_cutoff = (now - timedelta(days=Config.SESSION_BACKUP_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+
+        result = {"user_stats": 0, "session_backup": 0, "pending": False}
+        try:
+            batches = 0
+            while batches < max_batches:
+                processed = self.compact_user_stats(stats_cutoff, batch_size)
+                if not processed:
+                    break
+                result["user_stats"] += processed
+                batches += 1
+
+            while batches < max_batches:
+                processed = self.prune_session_backup(backup_cutoff, batch_size)
+                if not processed:
+                    break
+                result["session_backup"] += processed
+                batches += 1
+
+            result["pending"] = batches >= max_batches
+
+            if result["user_stats"] or result["session_backup"]:
+                self.maintenance_requested = True
+                logger.info(f"Политика хранения: user_stats -{result['user_stats']}, "
+                            f"session_backup -{result['session_backup']}"
+                            f"{', продолжение в следующем окне' if result['pending'] else ''}")
+            return result
+
+        except Exception as e:
+            logger.error(f"Ошибка применения политики хранения: {str(e)}")
+            result["pending"] = True
+            return result
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Проверка хранилищ: один сценарий на SQLite и PostgreSQL, сравнение результатов
+и замер записи дельт трафика через COPY против построчной записи.
+
+PostgreSQL берется из POSTGRES_DSN; для проверки создается и затем удаляется
+отдельная база. Без POSTGRES_DSN запускается временный локальный сервер через
+pgserver (pip install pgserver), если он установлен.
+
+    python3 storage_check.py [сессий в замере]
+"""
+import os
+import sys
+import time
+import tempfile
+from datetime import date, datetime, timedelta
+
+os.environ['VPNBOT_DATA_DIR'] = tempfile.mkdtemp(prefix='storage_check_')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+
+
+def throwaway_dsn():
+    """DSN сервера и имя отдельной базы для проверки"""
+    dsn = os.environ.get('POSTGRES_DSN')
+    if not dsn:
+        try:
+            import pgserver
+        except ImportError:
+            sys.exit("Нужен POSTGRES_DSN или pgserver (pip install pgserver)")
+        server = pgserver.get_server(os.path.join(os.environ['VPNBOT_DATA_DIR'], 'pgdata'), cleanup_mode='delete')
+        dsn = server.get_uri()
+    return dsn
+
+
+def create_database(dsn, name, drop=False):
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {name}")
+        if not drop:
+            cursor.execute(f"CREATE DATABASE {name}")
+    conn.close()
+    from psycopg2.extensions import make_dsn, parse_dsn
+    return make_dsn(**dict(parse_dsn(dsn), dbname=name))
+
+
+def scenario(store):
+    """Операции бота по порядку; результат - то, что видно снаружи (без id и времени)"""
+    result = {}
+    today = date.today()
+
+    for number in range(6):
+        store.add_user(f"user{number}", 100 + number % 2, f"admin{number % 2}")
+    result['duplicate_user'] = store.add_user("user0", 100, "admin0")
+    result['admins'] = (store.add_admin(555, "helper", 1), store.add_admin(555, "helper", 1),
+                        store.is_admin(555), store.delete_admin(555), store.is_admin(555))
+    store.set_user_quota("user1", 'daily', 10 ** 9, 'disconnect')
+    result['quotas'] = store.get_user_quotas()
+
+    # Сессии и пачка дельт монитора
+    hashes = {}
+    for number in range(4):
+        hashes[number] = store.register_session(f"user{number}", str(number + 1), f"10.0.0.{number}", 0, 0)
+    result['same_hash'] = store.register_session("user0", "1", "10.0.0.0", 0, 0) == hashes[0]
+    entries = [(f"user{number}", str(number + 1), 1000 * (number + 1), 5000 * (number + 1),
+                1000 * (number + 1), 5000 * (number + 1)) for number in range(4)]
+    result['batch'] = store.apply_traffic_batch(entries, journal_seq=7)
+    result['batch_again'] = store.apply_traffic_batch(entries[:1], journal_seq=8)
+    result['journal_seq'] = store.get_monitor_state('journal_seq')
+    result['session_base'] = tuple(store.get_session_base("user2"))
+    result['active_sessions'] = sorted((row[0], row[1], row[3], row[4]) for row in store.get_active_sessions())
+    result['update_traffic'] = store.update_traffic("user5", 7, 9)
+
+    result['users'] = sorted((user.username, user.created_by, user.created_by_username, user.total_connections,
+                              user.total_bytes_sent, user.total_bytes_received, user.is_active,
+                              user.quota_daily, user.quota_action) for user in store.get_all_users())
+    result['summaries'] = [(user.username, user.total_bytes_sent) for user in
+                           store.get_user_summaries(order_by_traffic=True, limit=2)]
+    result['search'] = {
+        'prefix': [user.username for user in store.search_users(name="USER1", order_by_name=True)],
+        'substring': [user.username for user in store.search_users(name="er3", substring=True)],
+        'admin': [user.username for user in store.search_users(admin="ADMIN1", order_by_name=True)],
+        'admin_id': [user.username for user in store.search_users(admin=100, order_by_name=True)],
+        'active': [user.username for user in store.search_users(is_active=True, seen_within=3600,
+                                                                 order_by_name=True, limit=2, offset=1)],
+        'unseen': [user.username for user in store.search_users(unseen_for=3600, order_by_name=True)],
+        'escape': [user.username for user in store.search_users(name="user_", substring=True)],
+    }
+    result['statuses'] = sorted(store.get_user_statuses(created_by=101))
+    result['quota_usage'] = store.get_quota_usage("user1", today.isoformat(), today.replace(day=1).isoformat())
+    result['daily'] = store.get_daily_traffic(today - timedelta(days=1), today)
+    statistics = store.get_user_statistics("user3")
+    result['statistics'] = {key: value for key, value in statistics.items() if key != 'last_connected'}
+    result['counts'] = (store.get_user_count(), store.get_active_users_count())
+
+    # Завершение сессий: явное, пакетное, очистка по списку активных
+    result['finalize'] = store.finalize_session("user0", "1", hashes[0], "check")
+    result['finalize_missing'] = store.finalize_session("user0", "1", hashes[0], "check")
+    result['finalize_sessions'] = store.finalize_sessions([("user1", "2", hashes[1])], "check")
+    result['cleanup'] = store.cleanup_old_sessions(["user2"])
+    result['after_cleanup'] = (sorted(row[0] for row in store.get_active_sessions()),
+                               store.get_active_users_count())
+    store.register_session("user4", "9", "10.0.0.9", 0, 0)
+    result['finalize_all'] = store.finalize_all_sessions("check")
+
+    # Флот: повторная отправка тех же тиков не удваивает трафик
+    ticks = [(1, time.time(), [("user0", "1", 10, 20), ("remote1", "5", 30, 40)]),
+             (2, time.time(), [("remote1", "5", 1, 2)])]
+    result['fleet_push'] = store.apply_fleet_push("node1", "http://node1", ticks, ["remote1", "remote2"], 3, "epoch1")
+    result['fleet_resend'] = store.apply_fleet_push("node1", "http://node1", ticks, ["remote1"], 3, "epoch1")
+    result['fleet_nodes'] = [row[:4] for row in store.get_fleet_nodes()]
+    result['fleet_users'] = sorted((user.username, user.total_bytes_sent, user.total_bytes_received, user.is_active)
+                                   for user in store.get_all_users() if user.username.startswith('remote'))
+    store.set_user_node("user0", "node2")
+    result['user_nodes'] = (store.get_user_node("remote1"), store.get_user_node("user0"),
+                            store.get_node_user_counts())
+    # Узел с пересозданной БД (новый epoch) начинает seq с 1; пользователь переехал на node1
+    result['fleet_new_epoch'] = store.apply_fleet_push("node1", "http://node1", [(1, time.time(), [("remote1", "5", 3, 4)])],
+                                                       ["remote1", "user0"], 3, "epoch2")
+    result['fleet_after_epoch'] = (store.get_user("remote1").total_bytes_sent, store.get_user_node("user0"))
+    store.delete_user_node("user0")
+
+    # История, выгрузка
+    log_rows, session_rows = store.get_history_rows(today.isoformat(), today.isoformat())
+    result['history'] = (sorted(log_rows), len(session_rows))
+    result['last_session_id'] = store.get_last_session_id() is not None
+    with store.export_query('traffic_log', today, today, ["user0", "user3"]) as (columns, integer_columns, batches):
+        rows = [row for batch in batches for row in batch]
+        result['export'] = (columns, sorted(integer_columns), sorted((row[1], str(row[2]), row[3]) for row in rows))
+
+    # Бэкап и восстановление
+    backup_file = store.create_full_backup("check")
+    result['backup_listed'] = store.get_backup_info()['db_backups'][0]['path'] == backup_file
+    store.delete_user("user5")
+    store.reset_user_traffic("user3")
+    result['before_restore'] = (store.user_exists("user5"), store.get_user("user3").total_bytes_sent)
+    result['restore'] = store.restore_from_backup_file(backup_file)[0]
+    result['after_restore'] = (store.user_exists("user5"), store.get_user("user3").total_bytes_sent,
+                               store.get_user_count())
+    result['add_after_restore'] = store.add_user("user6", 100, "admin0")
+
+    # Политика хранения: все завершенные сессии старше завтрашнего дня
+    cutoff = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    result['compact'] = store.compact_user_stats(cutoff, 100)
+    result['prune'] = store.prune_session_backup(cutoff, 100)
+    result['reset_all'] = store.reset_all_traffic()
+    result['after_reset'] = sorted((user.username, user.total_bytes_sent) for user in store.get_all_users())
+    result['maintenance'] = sorted(store.run_maintenance())
+    return result
+
+
+def benchmark(store, sessions):
+    """Запись одного тика дельт: apply_traffic_batch (COPY) и построчные UPDATE/INSERT"""
+    from postgres_storage import NOW
+    names = [f"bench{number:05d}" for number in range(sessions)]
+    with store.transaction() as cursor:
+        cursor.execute("INSERT INTO users (username, created_by, created_by_username) "
+                       "SELECT unnest(%s::text[]), 1, 'bench'", (names,))
+        cursor.execute("INSERT INTO active_sessions (username, connection_id, session_hash) "
+                       "SELECT unnest(%s::text[]), '1', 'h'", (names,))
+
+    def entries(tick):
+        return [(name, '1', 1000 + tick, 9000 + tick, (1000 + tick) * tick, (9000 + tick) * tick)
+                for name in names]
+
+    def row_by_row(batch):
+        today = date.today()
+        with store.transaction() as cursor:
+            for username, connection_id, sent, received, absolute_sent, absolute_received in batch:
+                cursor.execute(f'''UPDATE users SET total_bytes_sent = total_bytes_sent + %s,
+                                       total_bytes_received = total_bytes_received + %s, last_updated = {NOW}
+                                   WHERE username = %s''', (sent, received, username))
+                cursor.execute('''INSERT INTO traffic_log (username, log_date, bytes_sent, bytes_received)
+                                  VALUES (%s, %s, %s, %s)
+                                  ON CONFLICT (username, log_date) DO UPDATE SET
+                                      bytes_sent = traffic_log.bytes_sent + excluded.bytes_sent,
+                                      bytes_received = traffic_log.bytes_received + excluded.bytes_received''',
+                               (username, today, sent, received))
+                cursor.execute(f'''UPDATE active_sessions SET last_bytes_sent = %s, last_bytes_received = %s,
+                                       last_updated = {NOW}
+                                   WHERE username = %s AND connection_id = %s''',
+                               (absolute_sent, absolute_received, username, connection_id))
+
+    timings = {}
+    for title, write in (('построчно', row_by_row), ('COPY', store.apply_traffic_batch)):
+        best = None
+        for tick in range(3):
+            batch = entries(tick)
+            start = time.perf_counter()
+            write(batch)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[title] = best
+
+    expected = sum(1000 + tick for tick in range(3)) * 2
+    totals = {row[0] for row in store._fetchall("SELECT total_bytes_sent FROM users WHERE username LIKE 'bench%%'")}
+    assert totals == {expected}, totals
+    return timings
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    server_dsn = throwaway_dsn()
+    dsn = create_database(server_dsn, f"vpnbot_check_{os.getpid()}")
+
+    from config import Config
+    Config.ensure_directories()
+    from database import db
+    from postgres_storage import PostgresStorage
+
+    postgres = PostgresStorage(dsn)
+    try:
+        print(f"🗄️  SQLite: {Config.DB_PATH}\n🐘 PostgreSQL: {postgres.dsn} (pg_trgm: {postgres.users_fts})")
+        sqlite_result = scenario(db)
+        postgres_result = scenario(postgres)
+
+        mismatched = [key for key in sqlite_result if sqlite_result[key] != postgres_result.get(key)]
+        for key in mismatched:
+            print(f"❌ {key}:\n   sqlite:   {sqlite_result[key]}\n   postgres: {postgres_result.get(key)}")
+        print(f"🔍 Сценарий: {len(sqlite_result)} проверок, расхождений: {len(mismatched)}")
+
+        timings = benchmark(postgres, sessions)
+        print(f"⏱️  Тик из {sessions} сессий: " +
+              ", ".join(f"{title} {seconds * 1000:.1f} мс" for title, seconds in timings.items()) +
+              f" ({timings['построчно'] / timings['COPY']:.1f}x)")
+        assert not mismatched, mismatched
+        print("✅ Проверка хранилищ пройдена")
+    finally:
+        postgres.close()
+        create_database(server_dsn, f"vpnbot_check_{os.getpid()}", drop=True)
+
+
+if __name__ == "__main__":
+    main()
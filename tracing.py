@@ -0,0 +1,182 @@
+import io
+import time
+import logging
+import cProfile
+import pstats
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from metrics import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Слушатели спанов: callback(name, duration_seconds)
+_span_listeners = []
+_local = threading.local()
+
+
+def add_span_listener(callback):
+    """Подключает внешний обработчик спанов (трассировка, логирование и т.п.)"""
+    if callback not in _span_listeners:
+        _span_listeners.append(callback)
+
+
+def remove_span_listener(callback):
+    if callback in _span_listeners:
+        _span_listeners.remove(callback)
+
+
+@contextmanager
+def span(name):
+    """Замеряет фазу тика: пишет в трассу текущего тика, в метрики и слушателям"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((name, duration))
+        metrics.observe('vpnbot_tick_phase_seconds', duration, phase=name)
+        for callback in _span_listeners:
+            try:
+                callback(name, duration)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика спана {name}: {str(e)}")
+
+
+@contextmanager
+def trace_tick():
+    """Собирает спаны одного тика; отдает список [(фаза, длительность)]"""
+    spans = []
+    _local.spans = spans
+    try:
+        yield spans
+    finally:
+        _local.spans = None
+
+
+def format_spans(spans):
+    return ", ".join(f"{name}={duration:.2f}s" for name, duration in spans)
+
+
+class TickProfiler:
+    """Профилирование следующих N тиков мониторинга по запросу администратора"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.total_ticks = 0
+        self.engine = None
+        self.callback = None
+        self.profiler = None
+        self.sessions = []
+
+    @staticmethod
+    def available_engines():
+        engines = ['cprofile']
+        try:
+            import pyinstrument  # noqa: F401
+            engines.append('pyinstrument')
+        except ImportError:
+            pass
+        return engines
+
+    def is_active(self):
+        return self.remaining > 0
+
+    def request(self, ticks, callback, engine='cprofile'):
+        """Запрашивает профиль следующих ticks тиков; callback(path, summary) по готовности"""
+        if engine not in self.available_engines():
+            return False, f"Профилировщик {engine} недоступен"
+
+        with self.lock:
+            if self.remaining > 0:
+                return False, f"Профилирование уже идет, осталось тиков: {self.remaining}"
+
+            self.total_ticks = max(1, min(ticks, Config.PROFILE_MAX_TICKS))
+            self.engine = engine
+            self.callback = callback
+            self.sessions = []
+            self.profiler = cProfile.Profile() if engine == 'cprofile' else None
+            # Последним: по remaining тик решает, что запрос готов
+            self.remaining = self.total_ticks
+
+        return True, f"Профилирование следующих {self.total_ticks} тиков ({engine})"
+
+    @contextmanager
+    def profile_tick(self):
+        """Оборачивает тик профилировщиком, если есть активный запрос"""
+        with self.lock:
+            remaining, engine, profiler = self.remaining, self.engine, self.profiler
+        if remaining <= 0:
+            yield
+            return
+
+        pyinstrument_profiler = None
+        if engine == 'cprofile':
+            profiler.enable()
+        else:
+            from pyinstrument import Profiler
+            pyinstrument_profiler = Profiler()
+            pyinstrument_profiler.start()
+
+        try:
+            yield
+        finally:
+            if pyinstrument_profiler is not None:
+                pyinstrument_profiler.stop()
+                self.sessions.append(pyinstrument_profiler.last_session)
+            else:
+                profiler.disable()
+
+            # Запрос освобождается после finish: до этого request() не подменит профиль
+            if remaining <= 1:
+                self.finish()
+            with self.lock:
+                self.remaining -= 1
+
+    def finish(self):
+        """Сохраняет профиль в файл и передает его в callback"""
+        callback = self.callback
+        self.callback = None
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        try:
+            if self.engine == 'cprofile':
+                stream = io.StringIO()
+                stats = pstats.Stats(self.profiler, stream=stream)
+                stats.sort_stats('cumulative').print_stats(60)
+                summary = f"cProfile, тиков: {self.total_ticks}, вызовов: {stats.total_calls}, " \
+                          f"время: {stats.total_tt:.2f} сек"
+                content = stream.getvalue().encode('utf-8')
+                suffix = '.txt'
+            else:
+                from pyinstrument.session import Session
+                from pyinstrument.renderers import HTMLRenderer
+                session = self.sessions[0]
+                for other in self.sessions[1:]:
+                    session = Session.combine(session, other)
+                summary = f"pyinstrument, тиков: {self.total_ticks}, время: {session.duration:.2f} сек"
+                content = HTMLRenderer().render(session).encode('utf-8')
+                suffix = '.html'
+
+            with tempfile.NamedTemporaryFile(prefix=f"tick_profile_{timestamp}_", suffix=suffix,
+                                             delete=False) as f:
+                f.write(content)
+                path = f.name
+        except Exception as e:
+            logger.error(f"Ошибка сохранения профиля: {str(e)}")
+            path, summary = None, f"Ошибка сохранения профиля: {str(e)}"
+        finally:
+            self.profiler = None
+            self.sessions = []
+
+        logger.info(f"Профиль тиков готов: {summary}")
+        if callback:
+            try:
+                callback(path, summary)
+            except Exception as e:
+                logger.error(f"Ошибка отправки профиля: {str(e)}")
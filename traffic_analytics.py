@@ -0,0 +1,292 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from config import Config
+from utils import format_bytes, format_time_delta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин длительности сессий, сек
+DURATION_BINS = (0, 60, 300, 900, 3600, 3 * 3600, 12 * 3600)
+DURATION_LABELS = ('< 1 мин', '1-5 мин', '5-15 мин', '15-60 мин', '1-3 ч', '3-12 ч', '> 12 ч')
+WEEKDAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+HEAT_CHARS = " ░▒▓█"
+
+
+def numpy_available():
+    return np is not None
+
+
+class TrafficWindow:
+    """История за период в колоночном виде: массивы NumPy вместо строк БД.
+
+    traffic_log - по строке на пользователя и день, user_stats - по строке на
+    сессию. Пользователи закодированы индексами в usernames, дни - смещением
+    от date_from. Сессии - только с sessions_from: более старые строки user_stats
+    политика хранения сжимает в дневные итоги без времени начала и длительности.
+    """
+
+    def __init__(self, date_from, date_to, usernames, log_user, log_day, log_bytes,
+                 session_user, session_start, session_duration, session_bytes, sessions_from=None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.sessions_from = max(date_from, sessions_from or date_from)
+        self.days = (date_to - date_from).days + 1
+        self.usernames = usernames
+        self.log_user = log_user
+        self.log_day = log_day
+        self.log_bytes = log_bytes
+        self.session_user = session_user
+        self.session_start = session_start  # datetime64[s]
+        self.session_duration = session_duration
+        self.session_bytes = session_bytes
+        self._matrix = None
+
+    @classmethod
+    def from_rows(cls, date_from, date_to, log_rows, session_rows, sessions_from=None):
+        """log_rows: (username, log_date, bytes); session_rows: (username, connection_start, duration, bytes)"""
+        usernames = sorted({row[0] for row in log_rows} | {row[0] for row in session_rows})
+        index = {name: i for i, name in enumerate(usernames)}
+        origin = np.datetime64(date_from, 'D')
+
+        log_columns = tuple(zip(*log_rows)) or ((), (), ())
+        session_columns = tuple(zip(*session_rows)) or ((), (), (), ())
+
+        window = cls(
+            date_from, date_to, usernames,
+            log_user=np.fromiter((index[name] for name in log_columns[0]), dtype=np.int32, count=len(log_rows)),
+            log_day=(np.array(log_columns[1], dtype='datetime64[D]') - origin).astype(np.int32),
+            log_bytes=np.array(log_columns[2], dtype=np.int64),
+            session_user=np.fromiter((index[name] for name in session_columns[0]), dtype=np.int32,
+                                     count=len(session_rows)),
+            session_start=np.array(session_columns[1], dtype='datetime64[s]'),
+            session_duration=np.array(session_columns[2], dtype=np.int64),
+            session_bytes=np.array(session_columns[3], dtype=np.int64),
+            sessions_from=sessions_from
+        )
+        if window.sessions_from > date_from:
+            # Сессии раньше границы хранения могли быть уже частично сжаты - отбрасываем все
+            keep = window.session_start >= np.datetime64(window.sessions_from, 's')
+            window.session_user = window.session_user[keep]
+            window.session_start = window.session_start[keep]
+            window.session_duration = window.session_duration[keep]
+            window.session_bytes = window.session_bytes[keep]
+        return window
+
+    def for_users(self, usernames):
+        """Окно только по выбранным пользователям (без повторного чтения БД)"""
+        wanted = set(usernames)
+        selected = [i for i, name in enumerate(self.usernames) if name in wanted]
+        remap = np.full(len(self.usernames), -1, dtype=np.int32)
+        remap[selected] = np.arange(len(selected), dtype=np.int32)
+
+        log_mask = remap[self.log_user] >= 0
+        session_mask = remap[self.session_user] >= 0
+        return TrafficWindow(
+            self.date_from, self.date_to, [self.usernames[i] for i in selected],
+            remap[self.log_user[log_mask]], self.log_day[log_mask], self.log_bytes[log_mask],
+            remap[self.session_user[session_mask]], self.session_start[session_mask],
+            self.session_duration[session_mask], self.session_bytes[session_mask],
+            sessions_from=self.sessions_from
+        )
+
+    def daily_matrix(self):
+        """Матрица пользователи x дни с трафиком за день (дни без трафика - нули)"""
+        if self._matrix is None:
+            cells = len(self.usernames) * self.days
+            flat = np.bincount(self.log_user.astype(np.int64) * self.days + self.log_day,
+                               weights=self.log_bytes, minlength=cells)
+            self._matrix = flat[:cells].reshape(len(self.usernames), self.days)
+        return self._matrix
+
+
+def user_percentiles(window, percentiles=(50, 90, 99)):
+    """Перцентили дневного трафика по каждому пользователю: {'total', 'max', 50: array, 90: ...}"""
+    matrix = window.daily_matrix()
+    result = {'total': matrix.sum(axis=1), 'max': matrix.max(axis=1, initial=0)}
+    if matrix.size:
+        for q, values in zip(percentiles, np.percentile(matrix, percentiles, axis=1)):
+            result[q] = values
+    else:
+        for q in percentiles:
+            result[q] = np.zeros(len(window.usernames))
+    return result
+
+
+def _utc_to_local(seconds):
+    """Секунды UTC -> местное время сервера (с учетом перехода на летнее время)"""
+    if not len(seconds):
+        return seconds
+    # Смещение меняется не чаще раза в час: считаем его по уникальным часам, а не по сессиям
+    hours, inverse = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(int(h) * 3600).tm_gmtoff for h in hours], dtype=np.int64)
+    return seconds + offsets[inverse]
+
+
+def weekly_heatmap(window):
+    """Трафик сессий по дню недели (строки, Пн=0) и часу начала (столбцы) по местному времени: массив 7x24"""
+    # connection_start хранится в UTC (CURRENT_TIMESTAMP), а даты отчета - местные
+    seconds = _utc_to_local(window.session_start.astype(np.int64))
+    # 1970-01-01 - четверг, поэтому сдвиг на 3 дает понедельник = 0
+    weekday = (seconds // 86400 + 3) % 7
+    hour = (seconds // 3600) % 24
+    return np.bincount(weekday * 24 + hour, weights=window.session_bytes, minlength=168).reshape(7, 24)
+
+
+def growth_trends(window):
+    """Дневные итоги сервера, наклон тренда (байт/день) и изменение последней недели к предыдущей"""
+    matrix = window.daily_matrix()
+    daily = matrix.sum(axis=0)
+
+    # Наклон МНК сразу для всех пользователей: cov(x, y) / var(x)
+    x = np.arange(window.days, dtype=np.float64)
+    x_centered = x - x.mean()
+    denominator = (x_centered ** 2).sum()
+    if denominator > 0:
+        user_slopes = (matrix - matrix.mean(axis=1, keepdims=True)) @ x_centered / denominator
+        slope = float(x_centered @ (daily - daily.mean()) / denominator)
+    else:
+        user_slopes = np.zeros(len(window.usernames))
+        slope = 0.0
+
+    week_change = None
+    if window.days >= 14:
+        last_week = daily[-7:].sum()
+        previous_week = daily[-14:-7].sum()
+        if previous_week > 0:
+            week_change = (last_week - previous_week) / previous_week * 100
+
+    return {'daily': daily, 'slope': slope, 'user_slopes': user_slopes, 'week_change': week_change}
+
+
+def duration_distribution(window, percentiles=(50, 90, 99)):
+    """Распределение длительности сессий по корзинам DURATION_BINS и перцентили"""
+    durations = window.session_duration
+    counts, _ = np.histogram(durations, bins=DURATION_BINS + (np.iinfo(np.int64).max,))
+    result = {'counts': counts, 'count': int(durations.size), 'mean': float(durations.mean()) if durations.size else 0}
+    for q in percentiles:
+        result[q] = float(np.percentile(durations, q)) if durations.size else 0
+    return result
+
+
+def _scale(values, chars, top=None):
+    """Строка символов, пропорциональных значениям (относительно top или максимума)"""
+    if top is None:
+        top = values.max() if values.size else 0
+    if top <= 0:
+        return chars[0] * len(values)
+    levels = np.minimum((values / top * (len(chars) - 1)).round().astype(int), len(chars) - 1)
+    return "".join(chars[level] for level in levels)
+
+
+class TrafficAnalytics:
+    """Аналитика истории трафика для /report.
+
+    Окно истории читается из БД один раз и кэшируется по периоду; кэш
+    сбрасывается, когда меняются данные (seq журнала трафика, новые сессии,
+    обнуление трафика).
+    """
+
+    def __init__(self):
+        self.cache = OrderedDict()  # {(date_from, date_to, sessions_from): (version, TrafficWindow)}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _data_version():
+        from database import db
+        return db.get_monitor_state('journal_seq'), db.get_last_session_id(), db.quota_version
+
+    @staticmethod
+    def _load(date_from, date_to, sessions_from):
+        from database import db
+        log_rows, session_rows = db.get_history_rows(date_from.isoformat(), date_to.isoformat())
+        return TrafficWindow.from_rows(date_from, date_to, log_rows, session_rows, sessions_from)
+
+    def get_window(self, days, date_to=None):
+        """Окно истории за последние days дней (из кэша, если данные не менялись)"""
+        if np is None:
+            return None
+
+        date_to = date_to or date.today()
+        date_from = date_to - timedelta(days=days - 1)
+        # Отдельные сессии есть только за STATS_RETENTION_DAYS: старше - дневные итоги
+        sessions_from = date.today() - timedelta(days=Config.STATS_RETENTION_DAYS - 1)
+        key = (date_from, date_to, sessions_from)
+
+        try:
+            version = self._data_version()
+            with self.lock:
+                cached = self.cache.get(key)
+                if cached and cached[0] == version:
+                    self.cache.move_to_end(key)
+                    return cached[1]
+
+            window = self._load(date_from, date_to, sessions_from)
+
+            with self.lock:
+                self.cache[key] = (version, window)
+                self.cache.move_to_end(key)
+                while len(self.cache) > Config.ANALYTICS_CACHE_SIZE:
+                    self.cache.popitem(last=False)
+            return window
+
+        except Exception as e:
+            logger.error(f"Ошибка загрузки истории для аналитики: {str(e)}")
+            return None
+
+    def iter_report(self, window):
+        """Текст отчета /report блоками - для ReportBuilder"""
+        trends = growth_trends(window)
+        daily = trends['daily']
+        total = daily.sum()
+
+        text = (f"📈 Всего: {format_bytes(total)}, в среднем {format_bytes(total / window.days)}/день\n"
+                f"Тренд: {'+' if trends['slope'] >= 0 else '-'}{format_bytes(abs(trends['slope']))}/день")
+        if trends['week_change'] is not None:
+            text += f", неделя к неделе {trends['week_change']:+.0f}%"
+        text += f"\n{_scale(daily, SPARK_CHARS)}\n\n"
+        yield text, None
+
+        if window.usernames:
+            stats = user_percentiles(window)
+            order = np.argsort(stats['total'])[::-1][:Config.ANALYTICS_TOP_USERS]
+            text = f"👥 Пользователи (топ {len(order)}), трафик за день p50 / p90 / max:\n"
+            for i in order:
+                slope = trends['user_slopes'][i]
+                text += (f"{window.usernames[i]}: {format_bytes(stats['total'][i])}\n"
+                         f"   {format_bytes(stats[50][i])} / {format_bytes(stats[90][i])} / "
+                         f"{format_bytes(stats['max'][i])}, тренд {'↗' if slope >= 0 else '↘'}"
+                         f"{format_bytes(abs(slope))}/день\n")
+            yield text + "\n", None
+
+        heatmap = weekly_heatmap(window)
+        durations = duration_distribution(window)
+        if window.sessions_from > window.date_from and (heatmap.any() or durations['count']):
+            yield (f"ℹ️ Сессии ниже - с {window.sessions_from}: более старые хранятся только "
+                   f"дневными итогами ({Config.STATS_RETENTION_DAYS} дн.)\n\n"), None
+
+        if heatmap.any():
+            text = "🗓 Трафик сессий по дням недели и часам начала:\n   0     6     12    18\n"
+            for weekday, row in enumerate(heatmap):
+                text += f"{WEEKDAY_NAMES[weekday]} {_scale(row, HEAT_CHARS, heatmap.max())}\n"
+            yield text + "\n", None
+
+        if durations['count']:
+            text = (f"⏱ Сессии: {durations['count']}, медиана {format_time_delta(durations[50])}, "
+                    f"p90 {format_time_delta(durations[90])}, среднее {format_time_delta(durations['mean'])}\n")
+            for label, count in zip(DURATION_LABELS, durations['counts']):
+                share = count / durations['count'] * 100
+                text += f"{label:<10}{share:5.1f}% {'█' * int(round(share / 5))}\n"
+            yield text, None
+
+
+# Глобальный экземпляр аналитики
+analytics = TrafficAnalytics()
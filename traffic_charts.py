@@ -0,0 +1,180 @@
+import io
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from config import Config
+from utils import format_bytes
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')  # рендер в память, дисплей не нужен
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+except ImportError:
+    matplotlib = None
+
+logger = logging.getLogger(__name__)
+
+
+def charts_available():
+    return matplotlib is not None
+
+
+class ChartRenderer:
+    """Графики трафика по дням из traffic_log.
+
+    Готовые PNG кэшируются по (пользователь, период, метка последнего изменения
+    трафика): повторный запрос без новых данных не рисует график заново. После
+    первой отправки запоминается file_id Telegram, и дальше картинка уходит
+    ссылкой, без повторной загрузки.
+    """
+
+    def __init__(self):
+        self.cache = OrderedDict()  # {key: {'png': bytes, 'file_id': str}}
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()  # matplotlib не гарантирует потокобезопасность
+        self.renders_count = 0
+        self.hits_count = 0
+
+    def get_chart(self, username, days, date_to=None):
+        """Возвращает (key, entry) - entry содержит file_id или png; (None, None) при ошибке"""
+        from database import db
+
+        if matplotlib is None:
+            return None, None
+
+        date_to = date_to or date.today()
+        date_from = date_to - timedelta(days=days - 1)
+
+        try:
+            key = (username, date_from, date_to, db.get_traffic_version(username))
+            with self.lock:
+                entry = self.cache.get(key)
+                if entry is not None:
+                    self.cache.move_to_end(key)
+                    self.hits_count += 1
+                    return key, entry
+
+            rows = db.get_daily_traffic(date_from, date_to, username)
+            png = self._render(username, date_from, date_to, rows)
+            entry = {'png': png, 'file_id': None}
+
+            with self.lock:
+                self.renders_count += 1
+                # Старые версии графика этого пользователя и периода больше не понадобятся
+                for old_key in [k for k in self.cache if k[:3] == key[:3]]:
+                    del self.cache[old_key]
+                self.cache[key] = entry
+                while len(self.cache) > Config.CHART_CACHE_SIZE:
+                    self.cache.popitem(last=False)
+            return key, entry
+
+        except Exception as e:
+            logger.error(f"Ошибка построения графика: {str(e)}")
+            return None, None
+
+    def remember_file_id(self, key, file_id):
+        """Запоминает file_id отправленной картинки"""
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                entry['file_id'] = file_id
+
+    def _render(self, username, date_from, date_to, rows):
+        days = (date_to - date_from).days + 1
+        dates = [date_from + timedelta(days=i) for i in range(days)]
+        by_date = {str(row[0]): row for row in rows}
+        sent = [by_date[str(day)][1] if str(day) in by_date else 0 for day in dates]
+        received = [by_date[str(day)][2] if str(day) in by_date else 0 for day in dates]
+        totals = [s + r for s, r in zip(sent, received)]
+
+        # Ось Y в одной двоичной единице, чтобы деления были круглыми
+        unit, unit_name = 1, 'B'
+        for size, name in ((1024 ** 4, 'TB'), (1024 ** 3, 'GB'), (1024 ** 2, 'MB'), (1024, 'KB')):
+            if max(totals, default=0) >= size:
+                unit, unit_name = size, name
+                break
+
+        # Скользящее среднее за 7 дней показывает тренд без дневного шума
+        window = 7
+        average = []
+        running = 0
+        for i, value in enumerate(totals):
+            running += value
+            if i >= window:
+                running -= totals[i - window]
+            average.append(running / min(i + 1, window))
+
+        with self.render_lock:
+            figure = Figure(figsize=(Config.CHART_WIDTH, Config.CHART_HEIGHT), dpi=Config.CHART_DPI)
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot(111)
+
+            received_scaled = [value / unit for value in received]
+            ax.bar(dates, received_scaled, width=0.8, color='#4c9be8', label='Получено')
+            ax.bar(dates, [value / unit for value in sent], width=0.8, bottom=received_scaled,
+                   color='#f5a142', label='Отправлено')
+            if days >= window:
+                ax.plot(dates, [value / unit for value in average], color='#333333', linewidth=1.5,
+                        label='Среднее за 7 дней')
+
+            locator = AutoDateLocator()
+            ax.xaxis.set_major_locator(locator)
+            ax.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+            ax.set_ylabel(unit_name)
+            ax.grid(axis='y', alpha=0.3)
+            ax.set_axisbelow(True)
+            ax.legend(loc='upper left', fontsize='small')
+            ax.set_title(f"{'Трафик ' + username if username else 'Трафик сервера'}: "
+                         f"{date_from:%d.%m.%Y} - {date_to:%d.%m.%Y}, всего {format_bytes(sum(totals))}")
+            figure.tight_layout()
+
+            buffer = io.BytesIO()
+            figure.savefig(buffer, format='png')
+
+        logger.info(f"Построен график {username or 'сервера'} за {days} дн. ({buffer.tell()} байт)")
+        return buffer.getvalue()
+
+    def send_chart(self, bot, chat_id, username, days):
+        """Отправляет график: по file_id, если он уже был отправлен, иначе загружает PNG"""
+        key, entry = self.get_chart(username, days)
+        if entry is None:
+            return False
+
+        caption = f"📊 {username or 'Сервер'}, {days} дн. ({datetime.now():%d.%m.%Y %H:%M})"
+        file_id = entry['file_id']
+        if file_id:
+            try:
+                bot.send_photo(chat_id, file_id, caption=caption)
+                return True
+            except Exception as e:
+                logger.warning(f"file_id графика не принят, загружаем заново: {str(e)}")
+                with self.lock:
+                    self.cache.pop(key, None)
+                key, entry = self.get_chart(username, days)
+                if entry is None:
+                    return False
+
+        try:
+            message = bot.send_photo(chat_id, io.BytesIO(entry['png']), caption=caption)
+        except Exception as e:
+            logger.error(f"Ошибка отправки графика: {str(e)}")
+            return False
+
+        if message is not None and getattr(message, 'photo', None):
+            self.remember_file_id(key, message.photo[-1].file_id)
+        return True
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "cached": len(self.cache),
+                "renders": self.renders_count,
+                "hits": self.hits_count
+            }
+
+
+# Глобальный рендерер графиков
+charts = ChartRenderer()
@@ -0,0 +1,116 @@
+import os
+import csv
+import gzip
+import json
+import time
+import logging
+from datetime import datetime
+from config import Config
+from storage import EXPORT_TABLES
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class TrafficExporter:
+    """Выгрузка истории трафика в файл.
+
+    Строки читаются через db.export_query пачками (в SQLite - отдельным соединением
+    только для чтения), поэтому память не растет с размером истории, а монитор не
+    ждет выгрузку. CSV и JSON Lines сжимаются gzip, Parquet - собственным сжатием zstd.
+    """
+
+    def export(self, table, fmt='csv', date_from=None, date_to=None, usernames=None):
+        """Выгружает таблицу в файл. Возвращает (True, {'path', 'rows', 'size', 'seconds'}) или (False, ошибка)"""
+        if table not in EXPORT_TABLES:
+            return False, f"Таблица: {', '.join(EXPORT_TABLES)}"
+        if fmt not in EXPORT_FORMATS:
+            return False, f"Формат: {', '.join(EXPORT_FORMATS)}"
+        if fmt == 'parquet' and not parquet_available():
+            return False, "Для Parquet нужен pyarrow (pip install pyarrow)"
+
+        Config.EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        extension = 'parquet' if fmt == 'parquet' else f"{fmt}.gz"
+        path = Config.EXPORT_DIR / f"{table}_{timestamp}.{extension}"
+
+        start = time.time()
+        try:
+            from database import db
+            with db.export_query(table, date_from, date_to, usernames) as (columns, integer_columns, batches):
+                if fmt == 'csv':
+                    rows = self._write_csv(path, columns, batches)
+                elif fmt == 'jsonl':
+                    rows = self._write_jsonl(path, columns, batches)
+                else:
+                    rows = self._write_parquet(path, columns, integer_columns, batches)
+
+            seconds = time.time() - start
+            size = path.stat().st_size
+            logger.info(f"Выгрузка {table} ({fmt}): {rows} строк, {size} байт за {seconds:.1f} сек")
+            return True, {"path": str(path), "rows": rows, "size": size, "seconds": seconds}
+
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки {table}: {str(e)}")
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return False, f"Ошибка выгрузки: {str(e)}"
+
+    @staticmethod
+    def _write_csv(path, columns, batches):
+        rows = 0
+        with gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6) as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for batch in batches:
+                writer.writerows(batch)
+                rows += len(batch)
+        return rows
+
+    @staticmethod
+    def _write_jsonl(path, columns, batches):
+        rows = 0
+        with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as f:
+            for batch in batches:
+                f.write("".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n"
+                                for row in batch))
+                rows += len(batch)
+        return rows
+
+    @staticmethod
+    def _write_parquet(path, columns, integer_columns, batches):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Целочисленные колонки -> int64, остальное (даты, IP, хэши) -> строки
+        schema = pa.schema([
+            (name, pa.int64() if name in integer_columns else pa.string())
+            for name in columns
+        ])
+
+        rows = 0
+        with pq.ParquetWriter(str(path), schema, compression='zstd') as writer:
+            for batch in batches:
+                arrays = []
+                for field, values in zip(schema, zip(*batch)):
+                    if field.type == pa.string():
+                        values = [None if value is None else str(value) for value in values]
+                    arrays.append(pa.array(values, type=field.type))
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                rows += len(batch)
+        return rows
+
+
+# Глобальный экземпляр выгрузки
+exporter = TrafficExporter()
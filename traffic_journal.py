@@ -0,0 +1,110 @@
+import os
+import json
+import logging
+import time
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficJournal:
+    """Журнал упреждающей записи абсолютных счетчиков ipsec.
+
+    Каждый тик дописывается одной строкой JSON с порядковым номером (seq).
+    fsync выполняется пачками раз в JOURNAL_FSYNC_TICKS тиков. После того как
+    монитор записал дельты в БД вместе с seq, журнал усекается; при старте
+    записи с seq больше сохраненного в БД проигрываются повторно.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or Config.TRAFFIC_JOURNAL_PATH
+        self.fsync_ticks = max(1, Config.JOURNAL_FSYNC_TICKS)
+        self.file = None
+        self.seq = 0
+        self.unsynced = 0
+        self.last_fsync = 0
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        return self.file
+
+    def read_records(self, after_seq=0):
+        """Читает записи журнала с seq > after_seq; оборванная последняя строка пропускается"""
+        records = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Поврежденная строка журнала трафика {line_no}, пропускаем")
+                        continue
+                    self.seq = max(self.seq, record.get('seq', 0))
+                    if record.get('seq', 0) > after_seq:
+                        records.append(record)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def append(self, traffic_data):
+        """Дописывает снимок счетчиков текущего тика. Возвращает seq записи"""
+        self.seq += 1
+        record = {
+            'seq': self.seq,
+            'ts': time.time(),
+            'sessions': [
+                [username, data['connection_id'], data['client_ip'],
+                 data['absolute_sent'], data['absolute_received']]
+                for username, data in traffic_data.items()
+            ]
+        }
+
+        try:
+            f = self._open()
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            f.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_ticks:
+                self.sync()
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала трафика: {str(e)}")
+
+        return self.seq
+
+    def sync(self):
+        """Принудительно сбрасывает журнал на диск"""
+        if self.file is None or not self.unsynced:
+            return
+        try:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.last_fsync = time.time()
+        except Exception as e:
+            logger.error(f"Ошибка fsync журнала трафика: {str(e)}")
+
+    def truncate(self):
+        """Очищает журнал после того, как все его записи зафиксированы в БД"""
+        try:
+            f = self._open()
+            f.truncate(0)
+            f.flush()
+            os.fsync(f.fileno())
+            self.unsynced = 0
+        except Exception as e:
+            logger.error(f"Ошибка усечения журнала трафика: {str(e)}")
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def get_size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
@@ -5,13 +5,37 @@ import time
 import threading
 import signal
 import sys
+import json
+from contextlib import nullcontext
 from datetime import datetime
 from database import db
+from db_maintenance import db_maintenance
+from traffic_journal import TrafficJournal
+from traffic_rates import RateTracker
+from traffic_quotas import QuotaEngine
+from metrics import metrics
+from alerts import alerts
+from tracing import span, trace_tick, format_spans, TickProfiler
 from config import Config
 
 logger = logging.getLogger(__name__)
 
 
+class IpsecStatus:
+    """Результат чтения ipsec trafficstatus.
+
+    available=False означает, что источник недоступен (ошибка, таймаут), и пустой
+    sessions в этом случае не значит "нет туннелей" - отключения по нему не фиксируются.
+    """
+
+    __slots__ = ('available', 'sessions', 'error')
+
+    def __init__(self, sessions=None, error=None):
+        self.available = error is None
+        self.sessions = sessions if sessions is not None else {}
+        self.error = error
+
+
 class TrafficMonitor:
     def __init__(self):
         self.update_interval = Config.STATS_UPDATE_INTERVAL
@@ -21,79 +45,164 @@ class TrafficMonitor:
         self.running = True
 
         # Кэш базовых значений трафика (чтобы не запрашивать БД каждый раз)
-        self.base_traffic_cache = {}  # {username: {'sent': X, 'received': Y}}
+        self.base_traffic_cache = {}  # {username: {'sent': X, 'received': Y, 'connection_id': C}}
+
+        # Дельты, еще не записанные в БД: пишутся пачкой раз в TRAFFIC_FLUSH_INTERVAL,
+        # а до этого защищены журналом счетчиков
+        self.flush_interval = Config.TRAFFIC_FLUSH_INTERVAL
+        self.pending_traffic = {}  # {username: {'connection_id', 'sent', 'received', 'absolute_sent', 'absolute_received'}}
+        self.last_flush = time.time()
+        self.journal = TrafficJournal()
+        self.processed_seq = 0  # последний seq журнала, чьи дельты уже в pending_traffic или в БД
+
+        # Сверка сохраненных сессий с первым снимком ipsec после запуска
+        self.warm_restart = Config.WARM_RESTART
+        self.sessions_reconciled = False
+
+        # Живые скорости по последним отсчетам счетчиков (только в памяти)
+        self.rates = RateTracker()
+
+        # Последний успешный снимок ipsec - для живых панелей (/dashboard)
+        self.last_sessions = {}
+        self.last_sessions_time = None
+
+        # Получатель дельт каждого тика (агент флота): callback(seq, ts, traffic_data, deltas)
+        self.tick_listener = None
+
+        # Состояние источников данных для оповещений
+        self.ipsec_failures = 0  # неудачных вызовов ipsec подряд
+        self.ipsec_error = None
+        self.last_flush_duration = 0
+
+        # Сессия считается закрытой только после DISCONNECT_CONFIRM_TICKS отсутствий подряд
+        self.absence_counts = {}  # {(username, connection_id): тиков подряд без сессии в ipsec}
+
+        # Квоты трафика проверяются по дельтам тика
+        self.quotas = QuotaEngine()
+
+        # Трассировка и профилирование тиков
+        self.last_tick_spans = []
+        self.profiler = TickProfiler()
 
         signal.signal(signal.SIGINT, self.graceful_shutdown)
         signal.signal(signal.SIGTERM, self.graceful_shutdown)
 
     def graceful_shutdown(self, signum=None, frame=None):
         logger.info("Получен сигнал завершения, фиксируем трафик...")
+        shutdown_start = time.time()
         self.running = False
-        self.finalize_all_sessions()
+
+        if self.warm_restart:
+            self.save_warm_state()
+        else:
+            self.finalize_all_sessions("shutdown", Config.SHUTDOWN_TIME_BUDGET)
+        finalize_done = time.time()
+
+        self.schedule_shutdown_backup()
+        self.journal.close()
+        backup_done = time.time()
+
+        logger.info(f"Остановка за {backup_done - shutdown_start:.2f} сек: "
+                    f"сессии {finalize_done - shutdown_start:.2f} сек, "
+                    f"бэкап/журнал {backup_done - finalize_done:.2f} сек")
         sys.exit(0)
 
-    def parse_ipsec_status(self):
-        """Парсит вывод ipsec trafficstatus - ТОЛЬКО ЧТЕНИЕ"""
+    def set_tick_listener(self, callback):
+        self.tick_listener = callback
+
+    def read_ipsec_status(self, tick=False):
+        """Читает ipsec trafficstatus - ТОЛЬКО ЧТЕНИЕ, без побочных эффектов (вызывают и обработчики).
+        Возвращает IpsecStatus; счетчик сбоев подряд ведет только тик (track_ipsec_status).
+        Спаны фаз ipsec/parse пишутся только при tick=True, чтобы вызовы из обработчиков
+        не попадали в метрики тика"""
+        if Config.FLEET_ROLE == 'aggregator':
+            # Своего ipsec у агрегатора нет: снимок собирается из последних отправок узлов
+            from fleet import aggregator
+            return IpsecStatus(aggregator.get_sessions())
+
         try:
-            result = subprocess.run(['ipsec', 'trafficstatus'],
-                                    capture_output=True, text=True, timeout=10)
+            with span('ipsec') if tick else nullcontext():
+                result = subprocess.run(['ipsec', 'trafficstatus'],
+                                        capture_output=True, text=True, timeout=10)
             if result.returncode != 0:
+                metrics.inc('vpnbot_ipsec_errors_total', error='returncode')
                 logger.error(f"Ошибка ipsec trafficstatus: {result.stderr}")
-                return {}
-
-            traffic_data = {}
-            lines = result.stdout.split('\n')
-
-            for line in lines:
-                line = line.strip()
-                if not line or 'CN=' not in line:
-                    continue
-
-                # Извлекаем username
-                cn_match = re.search(r"CN=([^,]+)", line)
-                if not cn_match:
-                    continue
-                username = cn_match.group(1).strip()
-
-                # Извлекаем connection_id
-                connection_id = "unknown"
-                id_match = re.search(r'#(\d+):', line)
-                if id_match:
-                    connection_id = id_match.group(1)
-
-                # Извлекаем АБСОЛЮТНЫЕ значения трафика (не разницу!)
-                current_sent = 0
-                current_received = 0
-
-                in_match = re.search(r'inBytes=(\d+)', line)
-                out_match = re.search(r'outBytes=(\d+)', line)
-
-                if in_match:
-                    current_received = int(in_match.group(1))  # Получено клиентом
-                if out_match:
-                    current_sent = int(out_match.group(1))  # Отправлено клиентом
-
-                # Извлекаем IP
-                ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', line)
-                client_ip = ip_match.group(1) if ip_match else "unknown"
-
-                traffic_data[username] = {
-                    'connection_id': connection_id,
-                    'absolute_sent': current_sent,  # АБСОЛЮТНОЕ значение
-                    'absolute_received': current_received,  # АБСОЛЮТНОЕ значение
-                    'client_ip': client_ip,
-                    'raw_line': line
-                }
+                return IpsecStatus(error=f"код {result.returncode}: {result.stderr.strip()[:200]}")
 
+            with span('parse') if tick else nullcontext():
+                traffic_data = self._parse_trafficstatus(result.stdout)
             logger.debug(f"Спарсено {len(traffic_data)} записей из trafficstatus")
-            return traffic_data
+            return IpsecStatus(traffic_data)
 
         except subprocess.TimeoutExpired:
+            metrics.inc('vpnbot_ipsec_errors_total', error='timeout')
             logger.error("Таймаут выполнения ipsec trafficstatus")
-            return {}
+            return IpsecStatus(error="таймаут")
         except Exception as e:
+            metrics.inc('vpnbot_ipsec_errors_total', error='exception')
             logger.error(f"Ошибка парсинга trafficstatus: {str(e)}")
-            return {}
+            return IpsecStatus(error=str(e))
+
+    def parse_ipsec_status(self):
+        """Сессии из ipsec trafficstatus; при недоступном ipsec - пустой словарь"""
+        return self.read_ipsec_status().sessions
+
+    def track_ipsec_status(self, status):
+        """Ведет счетчик неудачных чтений ipsec подряд по снимкам тиков мониторинга"""
+        if status.available:
+            self.ipsec_failures = 0
+            self.ipsec_error = None
+        else:
+            self.ipsec_failures += 1
+            self.ipsec_error = status.error
+
+    def _parse_trafficstatus(self, output):
+        """Разбирает вывод ipsec trafficstatus в {username: данные сессии}"""
+        traffic_data = {}
+        lines = output.split('\n')
+
+        for line in lines:
+            line = line.strip()
+            if not line or 'CN=' not in line:
+                continue
+
+            # Извлекаем username
+            cn_match = re.search(r"CN=([^,]+)", line)
+            if not cn_match:
+                continue
+            username = cn_match.group(1).strip()
+
+            # Извлекаем connection_id
+            connection_id = "unknown"
+            id_match = re.search(r'#(\d+):', line)
+            if id_match:
+                connection_id = id_match.group(1)
+
+            # Извлекаем АБСОЛЮТНЫЕ значения трафика (не разницу!)
+            current_sent = 0
+            current_received = 0
+
+            in_match = re.search(r'inBytes=(\d+)', line)
+            out_match = re.search(r'outBytes=(\d+)', line)
+
+            if in_match:
+                current_received = int(in_match.group(1))  # Получено клиентом
+            if out_match:
+                current_sent = int(out_match.group(1))  # Отправлено клиентом
+
+            # Извлекаем IP
+            ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', line)
+            client_ip = ip_match.group(1) if ip_match else "unknown"
+
+            traffic_data[username] = {
+                'connection_id': connection_id,
+                'absolute_sent': current_sent,  # АБСОЛЮТНОЕ значение
+                'absolute_received': current_received,  # АБСОЛЮТНОЕ значение
+                'client_ip': client_ip,
+                'raw_line': line
+            }
+
+        return traffic_data
 
     def get_base_traffic(self, username):
         """Получает базовые значения трафика для пользователя"""
@@ -103,72 +212,205 @@ class TrafficMonitor:
                 return self.base_traffic_cache[username]
 
             # Получаем из active_sessions (последняя запись)
-            cursor = db.execute(
-                "SELECT last_bytes_sent, last_bytes_received FROM active_sessions WHERE username = ? ORDER BY last_updated DESC LIMIT 1",
-                (username,)
-            )
-            result = cursor.fetchone()
+            result = db.get_session_base(username)
 
             if result:
-                base_sent, base_received = result
+                base_sent, base_received, connection_id = result
                 self.base_traffic_cache[username] = {
                     'sent': base_sent,
-                    'received': base_received
+                    'received': base_received,
+                    'connection_id': connection_id
                 }
                 return self.base_traffic_cache[username]
 
-            # Если нет в active_sessions, берем из последней завершенной сессии
-            cursor = db.execute(
-                "SELECT total_bytes_sent, total_bytes_received FROM users WHERE username = ?",
-                (username,)
-            )
-            result = cursor.fetchone()
-
-            if result:
-                total_sent, total_received = result
-                self.base_traffic_cache[username] = {
-                    'sent': total_sent or 0,
-                    'received': total_received or 0
-                }
-            else:
-                self.base_traffic_cache[username] = {
-                    'sent': 0,
-                    'received': 0
-                }
+            # Активной сессии нет - новая сессия, весь ее трафик новый
+            self.base_traffic_cache[username] = {
+                'sent': 0,
+                'received': 0,
+                'connection_id': None
+            }
 
             return self.base_traffic_cache[username]
 
         except Exception as e:
             logger.error(f"Ошибка получения базового трафика для {username}: {str(e)}")
-            return {'sent': 0, 'received': 0}
+            return {'sent': 0, 'received': 0, 'connection_id': None}
 
-    def update_base_traffic(self, username, absolute_sent, absolute_received):
+    def update_base_traffic(self, username, absolute_sent, absolute_received, connection_id=None):
         """Обновляет базовые значения трафика"""
         try:
             self.base_traffic_cache[username] = {
                 'sent': absolute_sent,
-                'received': absolute_received
+                'received': absolute_received,
+                'connection_id': connection_id
             }
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления кэша для {username}: {str(e)}")
             return False
 
+    def add_pending_traffic(self, username, connection_id, sent_diff, received_diff,
+                            absolute_sent, absolute_received):
+        """Накапливает дельту до следующей пакетной записи в БД"""
+        entry = self.pending_traffic.get(username)
+        if entry is None or entry['connection_id'] != connection_id:
+            if entry is not None:
+                # Сессия сменилась между записями - старую дельту фиксируем сразу
+                self.flush_pending()
+            entry = {'connection_id': connection_id, 'sent': 0, 'received': 0}
+            self.pending_traffic[username] = entry
+
+        entry['sent'] += sent_diff
+        entry['received'] += received_diff
+        entry['absolute_sent'] = absolute_sent
+        entry['absolute_received'] = absolute_received
+
+    def flush_pending(self):
+        """Записывает накопленные дельты в БД одной транзакцией вместе с seq журнала"""
+        flush_start = time.time()
+        entries = [
+            (username, entry['connection_id'], entry['sent'], entry['received'],
+             entry['absolute_sent'], entry['absolute_received'])
+            for username, entry in self.pending_traffic.items()
+        ]
+
+        success = db.apply_traffic_batch(entries, self.processed_seq)
+        self.last_flush_duration = time.time() - flush_start
+        if not success:
+            alerts.raise_alert('db_write', "Ошибка пакетной записи трафика в БД, дельты сохранены в журнале",
+                               'critical', event=True)
+            return False
+
+        self.pending_traffic.clear()
+        self.last_flush = time.time()
+
+        # Все записи журнала учтены в БД - его можно усечь
+        if self.processed_seq >= self.journal.seq:
+            self.journal.truncate()
+
+        return True
+
+    def replay_journal(self):
+        """Проигрывает журнал счетчиков после аварийной остановки (идемпотентно)"""
+        try:
+            applied_seq = int(db.get_monitor_state('journal_seq', 0) or 0)
+            records = self.journal.read_records(after_seq=applied_seq)
+            self.journal.seq = max(self.journal.seq, applied_seq)
+            self.processed_seq = self.journal.seq
+
+            if not records:
+                self.journal.truncate()
+                return 0
+
+            bases = {(username, connection_id): [last_sent, last_received]
+                     for username, connection_id, _, last_sent, last_received in db.get_active_sessions()}
+
+            deltas = {}
+            for record in records:
+                for username, connection_id, client_ip, absolute_sent, absolute_received in record['sessions']:
+                    key = (username, connection_id)
+                    if key not in bases:
+                        # Сессия не успела попасть в БД до сбоя
+                        self.update_active_session_in_db(username, connection_id, client_ip, 0, 0)
+                        bases[key] = [0, 0]
+
+                    base_sent, base_received = bases[key]
+                    if absolute_sent >= base_sent and absolute_received >= base_received:
+                        sent_diff = absolute_sent - base_sent
+                        received_diff = absolute_received - base_received
+                    else:
+                        sent_diff = absolute_sent
+                        received_diff = absolute_received
+
+                    delta = deltas.setdefault(key, [0, 0])
+                    delta[0] += sent_diff
+                    delta[1] += received_diff
+                    bases[key] = [absolute_sent, absolute_received]
+
+            entries = [
+                (username, connection_id, delta[0], delta[1], bases[(username, connection_id)][0],
+                 bases[(username, connection_id)][1])
+                for (username, connection_id), delta in deltas.items()
+            ]
+
+            if not db.apply_traffic_batch(entries, self.journal.seq):
+                logger.error("Не удалось применить журнал трафика, повтор при следующем запуске")
+                return 0
+
+            self.journal.truncate()
+            self.base_traffic_cache.clear()
+
+            total_sent = sum(entry[2] for entry in entries)
+            total_received = sum(entry[3] for entry in entries)
+            logger.info(f"Восстановлено из журнала: {len(records)} тиков, {len(entries)} сессий, "
+                        f"+{total_sent / 1024 / 1024:.1f}MB/+{total_received / 1024 / 1024:.1f}MB")
+            return len(records)
+
+        except Exception as e:
+            logger.error(f"Ошибка проигрывания журнала трафика: {str(e)}")
+            return 0
+
+    def check_alerts(self, new_sessions, disconnected_count):
+        """Проверяет данные тика на пороги и аномалии и отправляет накопленные оповещения"""
+        try:
+            if self.ipsec_failures >= Config.ALERT_IPSEC_FAILURES:
+                alerts.raise_alert('ipsec', f"ipsec trafficstatus не отвечает {self.ipsec_failures} раз подряд: "
+                                            f"{self.ipsec_error}", 'critical')
+            elif self.ipsec_failures == 0:
+                alerts.resolve('ipsec', "ipsec trafficstatus снова отвечает")
+
+                # При недоступном ipsec все сессии выглядят отключенными - это не шторм
+                storm = Config.ALERT_CONNECTION_STORM
+                if new_sessions >= storm or disconnected_count >= storm:
+                    alerts.raise_alert('storm', f"Шторм подключений: +{new_sessions} подключений, "
+                                                f"-{disconnected_count} отключений за тик", event=True)
+
+            rate_limit = Config.ALERT_USER_RATE_MB * 1024 * 1024
+            fast_users = set()
+            for username, sent_rate, received_rate in self.rates.top_talkers(Config.TOP_TALKERS_LIMIT):
+                rate = sent_rate + received_rate
+                if rate < rate_limit:
+                    break
+                key = f"rate:{username}"
+                fast_users.add(key)
+                alerts.raise_alert(key, f"{username}: {rate / 1024 / 1024:.1f} МБ/с "
+                                        f"(порог {Config.ALERT_USER_RATE_MB:g} МБ/с)")
+            alerts.resolve_prefix('rate:', keep=fast_users)
+
+            if self.last_flush_duration >= Config.ALERT_DB_WRITE_SECONDS:
+                alerts.raise_alert('db_latency', f"Медленная запись трафика в БД: "
+                                                 f"{self.last_flush_duration:.1f} сек", event=True)
+                self.last_flush_duration = 0
+
+            alerts.flush()
+        except Exception as e:
+            logger.error(f"Ошибка проверки оповещений: {str(e)}")
+
     def detect_disconnections(self, current_traffic_data):
         """Обнаруживает отключения"""
         try:
             current_usernames = set(current_traffic_data.keys())
 
             # Получаем активные сессии из БД
-            cursor = db.execute("SELECT username, connection_id, session_hash FROM active_sessions")
-            db_sessions = cursor.fetchall()
-
             disconnected = []
+            absence_counts = {}
 
-            for db_username, connection_id, session_hash in db_sessions:
+            for db_username, connection_id, session_hash, _, _ in db.get_active_sessions():
                 if db_username not in current_usernames:
-                    # Пользователь отключился
-                    disconnected.append((db_username, connection_id, session_hash))
+                    # Отключение подтверждается несколькими тиками подряд (гистерезис)
+                    key = (db_username, connection_id)
+                    absences = self.absence_counts.get(key, 0) + 1
+                    if absences >= Config.DISCONNECT_CONFIRM_TICKS:
+                        disconnected.append((db_username, connection_id, session_hash))
+                    else:
+                        absence_counts[key] = absences
+
+            # Вернувшиеся и закрытые сессии из счетчиков выпадают
+            self.absence_counts = absence_counts
+
+            # Перед завершением фиксируем накопленные дельты, иначе итог сессии будет неполным
+            if disconnected and self.pending_traffic:
+                self.flush_pending()
 
             # Завершаем обнаруженные отключения
             for username, connection_id, session_hash in disconnected:
@@ -183,87 +425,176 @@ class TrafficMonitor:
             logger.error(f"Ошибка обнаружения отключений: {str(e)}")
             return 0
 
-    def update_traffic_stats(self):
+    def update_traffic_stats(self, force_flush=False):
+        """Один тик мониторинга с разбивкой по фазам (спанам)"""
+        if Config.FLEET_ROLE == 'aggregator':
+            # Трафик считают узлы, агрегатор получает от них готовые дельты
+            self.last_update = time.time()
+            return len(self.last_sessions), 0, 0
+
+        with trace_tick() as spans:
+            result = self._update_traffic_stats(force_flush)
+
+        self.last_tick_spans = spans
+        tick_duration = sum(duration for _, duration in spans)
+        if tick_duration > Config.SLOW_TICK_THRESHOLD:
+            logger.warning(f"Медленный тик {tick_duration:.1f} сек: {format_spans(spans)}")
+        return result
+
+    def _update_traffic_stats(self, force_flush=False):
         """Основная функция обновления статистики с ПРАВИЛЬНЫМ подсчетом"""
         try:
             start_time = time.time()
 
-            # 1. Получаем текущие АБСОЛЮТНЫЕ значения из ipsec
-            traffic_data = self.parse_ipsec_status()
+            # 1. Получаем текущие АБСОЛЮТНЫЕ значения из ipsec и сразу пишем их в журнал
+            status = self.read_ipsec_status(tick=True)
+            self.track_ipsec_status(status)
+            if not status.available:
+                # Пустой снимок от недоступного ipsec - не повод закрывать сессии
+                logger.warning(f"ipsec недоступен ({status.error}), тик пропущен без фиксации отключений")
+                with span('alerts'):
+                    self.check_alerts(0, 0)
+                if self.pending_traffic and (force_flush or time.time() - self.last_flush >= self.flush_interval):
+                    with span('db_write'):
+                        self.flush_pending()
+                self.last_update = time.time()
+                return 0, 0, 0
+
+            traffic_data = status.sessions
+            with span('journal'):
+                seq = self.journal.append(traffic_data)
+            self.rates.record(traffic_data, start_time)
+            self.last_sessions = traffic_data
+            self.last_sessions_time = start_time
+
+            if not self.sessions_reconciled:
+                with span('reconcile'):
+                    self.reconcile_sessions(traffic_data)
 
             # 2. Фиксируем отключения
-            disconnected_count = self.detect_disconnections(traffic_data)
+            with span('disconnects'):
+                disconnected_count = self.detect_disconnections(traffic_data)
 
             active_usernames = list(traffic_data.keys())
             total_traffic_updated = 0
             total_sent_diff = 0
             total_received_diff = 0
+            quota_violations = []
+            new_sessions = 0
+            tick_deltas = []
 
             # 3. Для каждого активного пользователя
-            for username, data in traffic_data.items():
-                connection_id = data['connection_id']
-                client_ip = data['client_ip']
-                absolute_sent = data['absolute_sent']
-                absolute_received = data['absolute_received']
-
-                # 4. Получаем БАЗОВЫЕ значения
-                base_traffic = self.get_base_traffic(username)
-                base_sent = base_traffic['sent']
-                base_received = base_traffic['received']
-
-                # 5. Вычисляем РАЗНИЦУ (но защищаемся от сбросов/переполнений)
-                sent_diff = 0
-                received_diff = 0
-
-                # Вариант 1: Абсолютные значения больше базовых (нормальный случай)
-                if absolute_sent >= base_sent and absolute_received >= base_received:
-                    sent_diff = absolute_sent - base_sent
-                    received_diff = absolute_received - base_received
-
-                # Вариант 2: Счетчик обнулился (переподключение или переполнение)
-                elif absolute_sent < base_sent or absolute_received < base_received:
-                    # Считаем что это новая сессия, весь трафик - новый
-                    sent_diff = absolute_sent
-                    received_diff = absolute_received
-
-                    logger.info(f"Обнуление счетчика для {username}: "
-                                f"было sent={base_sent}, стало {absolute_sent}, "
-                                f"было received={base_received}, стало {absolute_received}")
-
-                # 6. Если есть трафик - обновляем
-                if sent_diff > 0 or received_diff > 0:
-                    # Обновляем в БД
-                    if db.update_traffic(username, sent_diff, received_diff, connection_id):
+            with span('accounting'):
+                for username, data in traffic_data.items():
+                    connection_id = data['connection_id']
+                    client_ip = data['client_ip']
+                    absolute_sent = data['absolute_sent']
+                    absolute_received = data['absolute_received']
+
+                    # 4. Получаем БАЗОВЫЕ значения
+                    base_traffic = self.get_base_traffic(username)
+                    base_sent = base_traffic['sent']
+                    base_received = base_traffic['received']
+
+                    # 5. Вычисляем РАЗНИЦУ (но защищаемся от сбросов/переполнений)
+                    sent_diff = 0
+                    received_diff = 0
+
+                    # Вариант 1: Абсолютные значения больше базовых (нормальный случай)
+                    if absolute_sent >= base_sent and absolute_received >= base_received:
+                        sent_diff = absolute_sent - base_sent
+                        received_diff = absolute_received - base_received
+
+                    # Вариант 2: Счетчик обнулился (переподключение или переполнение)
+                    elif absolute_sent < base_sent or absolute_received < base_received:
+                        # Считаем что это новая сессия, весь трафик - новый
+                        sent_diff = absolute_sent
+                        received_diff = absolute_received
+
+                        logger.info(f"Обнуление счетчика для {username}: "
+                                    f"было sent={base_sent}, стало {absolute_sent}, "
+                                    f"было received={base_received}, стало {absolute_received}")
+
+                    # 6. Если есть трафик - накапливаем дельту (в БД попадет пачкой)
+                    if sent_diff > 0 or received_diff > 0:
+                        # Новая сессия регистрируется сразу, с базой до этой дельты
+                        if base_traffic.get('connection_id') != connection_id:
+                            new_sessions += 1
+                            self.update_active_session_in_db(
+                                username, connection_id, client_ip,
+                                absolute_sent - sent_diff, absolute_received - received_diff
+                            )
+
+                        pending = self.pending_traffic.get(username)
+                        pending_bytes = pending['sent'] + pending['received'] if pending else 0
+                        quota_violations.extend(self.quotas.consume(
+                            username, connection_id, sent_diff + received_diff, pending_bytes
+                        ))
+
+                        self.add_pending_traffic(username, connection_id, sent_diff, received_diff,
+                                                 absolute_sent, absolute_received)
+                        tick_deltas.append((username, connection_id, sent_diff, received_diff))
                         total_traffic_updated += 1
                         total_sent_diff += sent_diff
                         total_received_diff += received_diff
 
-                        # Обновляем активную сессию
-                        session_hash = self.update_active_session_in_db(
-                            username, connection_id, client_ip, absolute_sent, absolute_received
-                        )
-
                         # Обновляем базовые значения в кэше
-                        self.update_base_traffic(username, absolute_sent, absolute_received)
+                        self.update_base_traffic(username, absolute_sent, absolute_received, connection_id)
 
                         logger.debug(f"Обновлен трафик {username}: "
                                      f"+{sent_diff / 1024 / 1024:.1f}MB sent, "
                                      f"+{received_diff / 1024 / 1024:.1f}MB received")
 
-            # 7. Периодическая очистка
+            self.processed_seq = seq
+
+            if self.tick_listener is not None:
+                try:
+                    self.tick_listener(seq, start_time, traffic_data, tick_deltas)
+                except Exception as e:
+                    logger.error(f"Ошибка передачи дельт тика: {str(e)}")
+
+            if quota_violations:
+                with span('quotas'):
+                    self.quotas.enforce(quota_violations)
+
+            # 7. Пакетная запись дельт в БД
             current_time = time.time()
+            if force_flush or current_time - self.last_flush >= self.flush_interval:
+                with span('db_write'):
+                    self.flush_pending()
+
+            with span('alerts'):
+                self.check_alerts(new_sessions, disconnected_count)
+
+            # 8. Периодическая очистка
             if current_time - self.last_cleanup > self.cleanup_interval:
                 cleanup_start = time.time()
-                db.cleanup_old_sessions(active_usernames)
+                with span('cleanup'):
+                    if self.pending_traffic:
+                        self.flush_pending()
+                    # Сессии, чье отсутствие еще не подтверждено, тоже не трогаем
+                    unconfirmed = {username for username, _ in self.absence_counts}
+                    db.cleanup_old_sessions(list(set(active_usernames) | unconfirmed))
                 cleanup_time = time.time() - cleanup_start
                 self.last_cleanup = current_time
                 logger.info(f"Очистка сессий за {cleanup_time:.2f} сек")
 
-            # 8. Обновляем время
+            # 9. Обновляем время
+            tick_gap = current_time - self.last_update
             self.last_update = current_time
             update_duration = time.time() - start_time
 
-            # 9. Логируем результаты
+            metrics.observe('vpnbot_tick_duration_seconds', update_duration)
+            metrics.set('vpnbot_active_sessions', len(active_usernames))
+            metrics.set('vpnbot_pending_traffic_users', len(self.pending_traffic))
+            metrics.inc('vpnbot_traffic_bytes_total', total_sent_diff, direction='sent')
+            metrics.inc('vpnbot_traffic_bytes_total', total_received_diff, direction='received')
+            metrics.inc('vpnbot_disconnects_total', disconnected_count)
+            if tick_gap > 0:
+                metrics.set('vpnbot_traffic_bytes_per_second', total_sent_diff / tick_gap, direction='sent')
+                metrics.set('vpnbot_traffic_bytes_per_second', total_received_diff / tick_gap, direction='received')
+
+            # 10. Логируем результаты
             if active_usernames or disconnected_count > 0 or total_traffic_updated > 0:
                 log_msg = (f"Обновление: {len(active_usernames)} активных, "
                            f"{disconnected_count} отключений, "
@@ -284,95 +615,125 @@ class TrafficMonitor:
 
     def update_active_session_in_db(self, username, connection_id, client_ip, absolute_sent, absolute_received):
         """Обновляет активную сессию в БД"""
-        try:
-            # Создаем хэш сессии
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            import hashlib
-            data = f"{username}_{connection_id}_{client_ip}_{timestamp}"
-            session_hash = hashlib.md5(data.encode()).hexdigest()[:16]
-
-            # Проверяем существующую сессию
-            cursor = db.execute(
-                "SELECT session_hash FROM active_sessions WHERE username = ? AND connection_id = ?",
-                (username, connection_id)
-            )
-            existing = cursor.fetchone()
-
-            if existing:
-                # Обновляем существующую
-                existing_hash = existing[0]
-                db.execute('''UPDATE active_sessions 
-                           SET last_bytes_sent = ?,
-                               last_bytes_received = ?,
-                               client_ip = ?,
-                               last_updated = CURRENT_TIMESTAMP
-                           WHERE username = ? AND connection_id = ? AND session_hash = ?''',
-                           (absolute_sent, absolute_received, client_ip, username, connection_id, existing_hash))
-                session_hash = existing_hash
-            else:
-                # Создаем новую сессию
-                db.execute('''INSERT INTO active_sessions 
-                           (username, connection_id, session_hash, last_bytes_sent, last_bytes_received, client_ip)
-                           VALUES (?, ?, ?, ?, ?, ?)''',
-                           (username, connection_id, session_hash, absolute_sent, absolute_received, client_ip))
-
-                # Регистрируем начало подключения
-                try:
-                    db.execute('''INSERT INTO user_stats 
-                               (username, connection_start, client_ip, status, session_id)
-                               VALUES (?, CURRENT_TIMESTAMP, ?, 'active', ?)''',
-                               (username, client_ip, session_hash))
-                except Exception as e:
-                    # Если нет колонки session_id
-                    db.execute('''INSERT INTO user_stats 
-                               (username, connection_start, client_ip, status)
-                               VALUES (?, CURRENT_TIMESTAMP, ?, 'active')''',
-                               (username, client_ip))
-
-                # Увеличиваем счетчик подключений
-                db.execute('''UPDATE users 
-                           SET total_connections = total_connections + 1,
-                               last_connected = CURRENT_TIMESTAMP,
-                               is_active = 1
-                           WHERE username = ?''',
-                           (username,))
-
-            db.commit()
-            return session_hash
+        return db.register_session(username, connection_id, client_ip, absolute_sent, absolute_received)
 
-        except Exception as e:
-            logger.error(f"Ошибка обновления сессии в БД {username}: {str(e)}")
-            return None
-
-    def finalize_all_sessions(self):
-        """Завершает все активные сессии"""
+    def finalize_all_sessions(self, reason="shutdown", time_budget=None):
+        """Завершает все активные сессии одной транзакцией в пределах time_budget секунд"""
         try:
             logger.info("Завершение всех активных сессий...")
+            phase_start = time.time()
+            deadline = phase_start + time_budget if time_budget else None
 
-            # Создаем резервную копию
-            backup_file = db.create_full_backup("shutdown_backup")
-            if backup_file:
-                logger.info(f"Создана резервная копия: {backup_file}")
-
-            # Получаем все активные сессии
-            cursor = db.execute("SELECT username, connection_id, session_hash FROM active_sessions")
-            active_sessions = cursor.fetchall()
+            # Сначала фиксируем накопленные дельты
+            if self.pending_traffic:
+                self.flush_pending()
+            flush_time = time.time() - phase_start
 
-            completed = 0
-            for username, connection_id, session_hash in active_sessions:
-                if db.finalize_session(username, connection_id, session_hash, "shutdown"):
-                    completed += 1
+            finalize_start = time.time()
+            completed, total = db.finalize_all_sessions(reason, deadline)
+            finalize_time = time.time() - finalize_start
 
             # Очищаем кэш
             self.base_traffic_cache.clear()
 
-            logger.info(f"Завершено {completed} сессий")
+            logger.info(f"Завершено {completed}/{total} сессий: "
+                        f"запись дельт {flush_time:.2f} сек, завершение {finalize_time:.2f} сек")
             return completed
 
         except Exception as e:
             logger.error(f"Ошибка при завершении сессий: {str(e)}")
             return 0
 
+    def save_warm_state(self):
+        """Теплая остановка: фиксирует дельты и сохраняет состояние вместо завершения сессий"""
+        try:
+            if self.pending_traffic:
+                self.flush_pending()
+
+            # Базы сессий уже в active_sessions; нужен только момент остановки (updated_at)
+            db.set_monitor_state('warm_state', json.dumps({'saved_at': time.time()}))
+            logger.info(f"Состояние монитора сохранено для теплого перезапуска: "
+                        f"{len(self.base_traffic_cache)} сессий")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния монитора: {str(e)}")
+            return False
+
+    def reconcile_sessions(self, traffic_data):
+        """Сверяет сессии из БД с первым снимком ipsec: совпавшие продолжаются, остальные закрываются"""
+        self.sessions_reconciled = True
+        try:
+            # Момент остановки: теплое сохранение или последняя запись дельт (после сбоя)
+            stopped_at = db.get_monitor_stopped_at()
+
+            stopped_for = time.time() - stopped_at if stopped_at else None
+            expired = stopped_for is None or stopped_for > Config.WARM_RESTART_MAX_AGE
+
+            resumed = 0
+            gone = []
+            for username, connection_id, session_hash, last_sent, last_received in db.get_active_sessions():
+                current = traffic_data.get(username)
+                if (not expired and current and current['connection_id'] == connection_id
+                        and current['absolute_sent'] >= last_sent
+                        and current['absolute_received'] >= last_received):
+                    self.update_base_traffic(username, last_sent, last_received, connection_id)
+                    resumed += 1
+                else:
+                    gone.append((username, connection_id, session_hash))
+
+            if gone:
+                reason = "restart_expired" if expired else "restart_gone"
+                db.finalize_sessions(gone, reason)
+
+            if resumed or gone:
+                logger.info(f"Сверка сессий после запуска"
+                            f"{f' (простой {stopped_for:.0f} сек)' if stopped_for is not None else ''}: "
+                            f"продолжено {resumed}, закрыто {len(gone)}")
+            return resumed, len(gone)
+
+        except Exception as e:
+            logger.error(f"Ошибка сверки сессий после запуска: {str(e)}")
+            return 0, 0
+
+    def schedule_shutdown_backup(self):
+        """Бэкап при остановке: пропускаем, если есть свежий, иначе откладываем до следующего запуска.
+
+        Копировать БД при остановке нельзя: systemd (KillMode=control-group) убивает вместе
+        с ботом и любой запущенный им процесс. Поэтому сохраняется только отметка
+        deferred_backup, а бэкап создается после первого тика следующего запуска.
+        """
+        backup_age = db.get_last_full_backup_age()
+        if backup_age is not None and backup_age < Config.SHUTDOWN_BACKUP_MIN_AGE:
+            logger.info(f"Бэкап при остановке пропущен: последний создан {backup_age:.0f} сек назад")
+            return False
+
+        try:
+            db.set_monitor_state('deferred_backup', 'shutdown_backup')
+            logger.info("Бэкап при остановке отложен до следующего запуска")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка планирования бэкапа: {str(e)}")
+            return False
+
+    def run_deferred_backup(self):
+        """Создает бэкап, отложенный при прошлой остановке (в отдельном потоке)"""
+        try:
+            reason = db.get_monitor_state('deferred_backup')
+        except Exception as e:
+            logger.error(f"Ошибка чтения отложенного бэкапа: {str(e)}")
+            return
+
+        if not reason:
+            return
+
+        def backup_worker():
+            backup_file = db.create_full_backup(reason)
+            if backup_file:
+                db.set_monitor_state('deferred_backup', '')
+                logger.info(f"Создана отложенная резервная копия: {backup_file}")
+
+        threading.Thread(target=backup_worker, daemon=True, name="DeferredBackup").start()
+
     def get_monitor_status(self):
         """Возвращает статус монитора"""
         return {
@@ -380,7 +741,12 @@ class TrafficMonitor:
             "last_update": datetime.fromtimestamp(self.last_update).isoformat(),
             "update_interval": self.update_interval,
             "next_update_in": max(0, self.update_interval - (time.time() - self.last_update)),
-            "cache_size": len(self.base_traffic_cache)
+            "cache_size": len(self.base_traffic_cache),
+            "pending_users": len(self.pending_traffic),
+            "next_flush_in": max(0, self.flush_interval - (time.time() - self.last_flush)),
+            "journal_size": self.journal.get_size(),
+            "last_tick_spans": list(self.last_tick_spans),
+            "profiling": self.profiler.is_active()
         }
 
     def reset_traffic_counter(self, username=None):
@@ -407,9 +773,19 @@ class TrafficMonitor:
         def monitor_loop():
             logger.info(f"Запуск мониторинга трафика (интервал: {self.update_interval} сек)")
 
+            # Досчитываем трафик, оставшийся в журнале после аварийной остановки
+            self.replay_journal()
+            deferred_backup_pending = True
+
             while self.running:
                 try:
-                    self.update_traffic_stats()
+                    with self.profiler.profile_tick():
+                        self.update_traffic_stats()
+
+                    # Отложенный бэкап - после первого тика, чтобы не мешать запуску
+                    if deferred_backup_pending:
+                        deferred_backup_pending = False
+                        self.run_deferred_backup()
 
                     elapsed = time.time() - self.last_update
                     sleep_time = max(1, self.update_interval - elapsed)
@@ -418,6 +794,13 @@ class TrafficMonitor:
                         logger.warning(f"Обновление заняло {elapsed:.1f} сек")
                         sleep_time = 1
 
+                    # Обслуживание БД - только в окне простоя между тиками
+                    with span('maintenance'):
+                        maintenance_result = db_maintenance.maybe_run(sleep_time)
+                    if maintenance_result:
+                        elapsed = time.time() - self.last_update
+                        sleep_time = max(1, self.update_interval - elapsed)
+
                     time.sleep(sleep_time)
 
                 except Exception as e:
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from database import db
+from utils import format_bytes
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+QUOTA_KINDS = ('daily', 'monthly', 'total')
+
+QUOTA_NAMES = {
+    'daily': 'дневная',
+    'monthly': 'месячная',
+    'total': 'общая'
+}
+
+
+class QuotaEngine:
+    """Инкрементальная проверка квот трафика.
+
+    Счетчики расхода живут в памяти и увеличиваются на дельты тика; из БД они
+    читаются один раз при первом трафике пользователя (и после изменения квот
+    или обнуления трафика). Проверка стоит O(активных пользователей) за тик.
+    """
+
+    def __init__(self):
+        self.definitions = {}  # {username: {'created_by', 'daily', 'monthly', 'total', 'action'}}
+        self.usage = {}  # {username: {'day', 'month', 'daily', 'monthly', 'total'}}
+        self.triggered = {}  # {(username, kind): период, за который квота уже сработала}
+        self.last_enforced = {}  # {username: время последнего отключения}
+        self.version = None
+        self.notifier = None
+        self.lock = threading.Lock()
+
+    def set_notifier(self, callback):
+        """callback(chat_id, text) - доставка предупреждений администраторам"""
+        self.notifier = callback
+
+    def _sync(self):
+        """Перечитывает определения квот, если они менялись в БД"""
+        if self.version == db.quota_version:
+            return
+        self.version = db.quota_version
+        previous = self.definitions
+        self.definitions = db.get_user_quotas()
+        self.usage = {}
+
+        # Срабатывание сохраняется, только если лимит и действие этой квоты не менялись:
+        # иначе новый лимит (например, поднятая общая квота) не сработал бы в том же периоде
+        def unchanged(username, kind):
+            old, new = previous.get(username), self.definitions.get(username)
+            return (old is not None and new is not None and
+                    old[kind] == new[kind] and old['action'] == new['action'])
+
+        self.triggered = {key: period for key, period in self.triggered.items() if unchanged(*key)}
+
+    def _get_usage(self, username, now, pending_bytes):
+        day = now.strftime("%Y-%m-%d")
+        month = now.strftime("%Y-%m")
+        usage = self.usage.get(username)
+
+        if usage is None:
+            daily, monthly, total = db.get_quota_usage(username, day, f"{month}-01")
+            # Дельты, еще не записанные в БД, тоже расход
+            usage = {
+                'day': day,
+                'month': month,
+                'daily': daily + pending_bytes,
+                'monthly': monthly + pending_bytes,
+                'total': total + pending_bytes
+            }
+            self.usage[username] = usage
+        else:
+            if usage['day'] != day:
+                usage['day'] = day
+                usage['daily'] = 0
+            if usage['month'] != month:
+                usage['month'] = month
+                usage['monthly'] = 0
+
+        return usage
+
+    def consume(self, username, connection_id, delta_bytes, pending_bytes=0):
+        """Учитывает дельту тика. Возвращает список нарушений для enforce()"""
+        try:
+            with self.lock:
+                self._sync()
+                quota = self.definitions.get(username)
+                if quota is None:
+                    return []
+
+                now = datetime.now()
+                usage = self._get_usage(username, now, pending_bytes)
+                usage['daily'] += delta_bytes
+                usage['monthly'] += delta_bytes
+                usage['total'] += delta_bytes
+
+                periods = {'daily': usage['day'], 'monthly': usage['month'], 'total': 'total'}
+                violations = []
+                for kind in QUOTA_KINDS:
+                    limit = quota[kind]
+                    if not limit or usage[kind] < limit:
+                        continue
+
+                    first_time = self.triggered.get((username, kind)) != periods[kind]
+                    self.triggered[(username, kind)] = periods[kind]
+                    violations.append({
+                        'username': username,
+                        'connection_id': connection_id,
+                        'kind': kind,
+                        'used': usage[kind],
+                        'limit': limit,
+                        'action': quota['action'],
+                        'created_by': quota['created_by'],
+                        'first_time': first_time
+                    })
+                return violations
+        except Exception as e:
+            logger.error(f"Ошибка проверки квоты {username}: {str(e)}")
+            return []
+
+    def enforce(self, violations):
+        """Выполняет действия по нарушениям в отдельном потоке, не задерживая тик"""
+        actions = []
+        now = time.time()
+
+        for violation in violations:
+            username = violation['username']
+            action = violation['action']
+
+            if action == 'warn' or action not in Config.QUOTA_ACTIONS:
+                if violation['first_time']:
+                    actions.append(violation)
+            elif violation['first_time'] or now - self.last_enforced.get(username, 0) >= Config.QUOTA_ENFORCE_INTERVAL:
+                # Клиент может переподключиться сам - отключаем повторно, пока квота превышена
+                self.last_enforced[username] = now
+                actions.append(violation)
+
+        if actions:
+            threading.Thread(target=self._run_actions, args=(actions,), daemon=True,
+                             name="QuotaActions").start()
+        return len(actions)
+
+    def _run_actions(self, actions):
+        handled = set()
+        for violation in actions:
+            username = violation['username']
+            action = violation['action']
+
+            result_text = ""
+            if username not in handled and action in ('disconnect', 'revoke'):
+                handled.add(username)
+                try:
+                    from vpn_manager import vpn_manager
+                    results = []
+                    if action == 'revoke' and violation['first_time']:
+                        success, msg = vpn_manager.revoke_user(username)
+                        results.append("сертификат отозван" if success else f"ошибка отзыва: {msg}")
+                    success, msg = vpn_manager.disconnect_user(username, violation['connection_id'])
+                    results.append("отключен" if success else f"ошибка отключения: {msg}")
+                    result_text = ", ".join(results)
+                except Exception as e:
+                    result_text = f"ошибка: {str(e)}"
+                    logger.error(f"Ошибка применения квоты к {username}: {str(e)}")
+
+            logger.warning(f"Превышена {QUOTA_NAMES[violation['kind']]} квота {username}: "
+                           f"{format_bytes(violation['used'])} из {format_bytes(violation['limit'])}"
+                           f"{', ' + result_text if result_text else ''}")
+
+            if violation['first_time']:
+                self._notify(violation, result_text)
+
+    def _notify(self, violation, result_text):
+        if self.notifier is None:
+            return
+
+        text = (f"⚠️ Превышена {QUOTA_NAMES[violation['kind']]} квота\n\n"
+                f"👤 {violation['username']}\n"
+                f"📊 {format_bytes(violation['used'])} из {format_bytes(violation['limit'])}")
+        if result_text:
+            text += f"\n🔧 Действие: {result_text}"
+
+        recipients = {violation['created_by'], Config.SUPER_ADMIN_ID}
+        for chat_id in recipients:
+            if not chat_id:
+                continue
+            try:
+                self.notifier(chat_id, text)
+            except Exception as e:
+                logger.error(f"Ошибка отправки предупреждения о квоте: {str(e)}")
+
+    def get_usage(self, username):
+        """Текущий расход по квотам из памяти (None, если счетчики еще не загружены)"""
+        with self.lock:
+            usage = self.usage.get(username)
+            return dict(usage) if usage else None
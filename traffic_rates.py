@@ -0,0 +1,121 @@
+import time
+import threading
+from array import array
+from config import Config
+
+
+class SampleRing:
+    """Кольцевой буфер последних отсчетов счетчиков одной сессии на массивах array"""
+
+    __slots__ = ('connection_id', 'capacity', 'times', 'sent', 'received', 'start', 'size')
+
+    def __init__(self, connection_id, capacity):
+        self.connection_id = connection_id
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.sent = array('Q', bytes(8 * capacity))
+        self.received = array('Q', bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def append(self, ts, sent, received):
+        if self.size:
+            last = (self.start + self.size - 1) % self.capacity
+            # Счетчик уменьшился - новая сессия с тем же ID, старые отсчеты не годятся
+            if sent < self.sent[last] or received < self.received[last]:
+                self.clear()
+
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+
+        self.times[index] = ts
+        self.sent[index] = sent
+        self.received[index] = received
+
+    def rate(self, window=None):
+        """Скорость (байт/с) между последним отсчетом и самым старым в пределах window секунд.
+
+        window=None - между двумя последними отсчетами (текущая скорость).
+        """
+        if self.size < 2:
+            return 0.0, 0.0
+
+        capacity = self.capacity
+        last = (self.start + self.size - 1) % capacity
+        last_ts = self.times[last]
+
+        if window is None:
+            first = (last - 1) % capacity
+        else:
+            first = last
+            for offset in range(self.size - 2, -1, -1):
+                index = (self.start + offset) % capacity
+                first = index
+                if last_ts - self.times[index] >= window:
+                    break
+
+        elapsed = last_ts - self.times[first]
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return ((self.sent[last] - self.sent[first]) / elapsed,
+                (self.received[last] - self.received[first]) / elapsed)
+
+
+class RateTracker:
+    """Живые скорости по пользователям из последовательных снимков ipsec (только память)"""
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or Config.RATE_SAMPLES
+        self.rings = {}  # {username: SampleRing}
+        self.lock = threading.Lock()
+
+    def record(self, traffic_data, ts=None, scope=None):
+        """Добавляет снимок тика; пользователи, пропавшие из снимка, забываются.
+
+        scope - пользователи, которых покрывает снимок (снимок одного узла флота);
+        по умолчанию снимок считается полным.
+        """
+        ts = ts or time.time()
+        with self.lock:
+            for username in list(self.rings if scope is None else scope):
+                if username not in traffic_data:
+                    self.rings.pop(username, None)
+
+            for username, data in traffic_data.items():
+                ring = self.rings.get(username)
+                if ring is None or ring.connection_id != data['connection_id']:
+                    ring = SampleRing(data['connection_id'], self.capacity)
+                    self.rings[username] = ring
+                ring.append(ts, data['absolute_sent'], data['absolute_received'])
+
+    def get_rates(self, username):
+        """Возвращает скорости пользователя: текущая, за 1 и за 5 минут (байт/с)"""
+        with self.lock:
+            ring = self.rings.get(username)
+            if ring is None:
+                return None
+            return {
+                'current': ring.rate(),
+                '1m': ring.rate(60),
+                '5m': ring.rate(300)
+            }
+
+    def top_talkers(self, limit=10, window=None):
+        """Топ пользователей по суммарной скорости: [(username, sent_bps, received_bps)]"""
+        with self.lock:
+            rates = [(username,) + ring.rate(window) for username, ring in self.rings.items()]
+        rates.sort(key=lambda item: item[1] + item[2], reverse=True)
+        return rates[:limit]
+
+    def total_rate(self, window=None):
+        with self.lock:
+            rates = [ring.rate(window) for ring in self.rings.values()]
+        return sum(r[0] for r in rates), sum(r[1] for r in rates)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Замер задержки "обновление -> обработчик" в режимах polling и webhook.
+
+Поднимает локальный фейковый Telegram Bot API (getUpdates с long polling,
+setWebhook/deleteWebhook, sendMessage), подает одинаковый поток обновлений
+и печатает p50/p95/max задержки до вызова обработчика.
+
+    python3 update_latency_benchmark.py [количество_обновлений]
+"""
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import statistics
+import urllib.request
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import telebot
+from telebot import apihelper
+
+from webhook import WebhookServer
+
+TOKEN = "123456:BENCHMARK"
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = "benchmark-secret"
+
+
+class FakeTelegramAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeTelegramHandler)
+        self.updates = []
+        self.cond = threading.Condition()
+        self.next_update_id = 1
+
+    def push_update(self, update):
+        with self.cond:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update
+
+    def reset(self):
+        with self.cond:
+            self.updates = []
+
+    def get_updates(self, offset, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                result = [u for u in self.updates if u['update_id'] >= offset]
+                remaining = deadline - time.time()
+                if result or remaining <= 0:
+                    return result
+                self.cond.wait(remaining)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def _params(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8', 'ignore')
+            params.update({key: values[0] for key, values in parse_qs(body).items()})
+        return params
+
+    def _reply(self, result):
+        body = json.dumps({"ok": True, "result": result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        params = self._params()
+
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0) or 0)
+            timeout = float(params.get('timeout', 0) or 0)
+            self._reply(self.server.get_updates(offset, timeout))
+        elif method == 'getMe':
+            self._reply({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        elif method in ('setWebhook', 'deleteWebhook'):
+            self._reply(True)
+        else:
+            self._reply({"message_id": 1, "date": int(time.time()),
+                         "chat": {"id": 1, "type": "private"}, "text": "ok"})
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_update(text):
+    return {
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+            "text": text
+        }
+    }
+
+
+def make_bot(latencies, done):
+    bot = telebot.TeleBot(TOKEN, num_threads=4, validate_token=False)
+
+    @bot.message_handler(commands=['ping'])
+    def ping(message):
+        sent_at = float(message.text.split()[1])
+        latencies.append(time.time() - sent_at)
+        done.release()
+
+    return bot
+
+
+def feed(count, deliver):
+    """Подает обновления со случайными паузами, как живые пользователи"""
+    for _ in range(count):
+        time.sleep(random.uniform(0.05, 0.6))
+        deliver(make_update(f"/ping {time.time()}"))
+
+
+def run_polling(api, count, interval):
+    latencies = []
+    done = threading.Semaphore(0)
+    bot = make_bot(latencies, done)
+
+    thread = threading.Thread(
+        target=bot.polling,
+        kwargs={'non_stop': True, 'interval': interval, 'timeout': 10, 'long_polling_timeout': 5},
+        daemon=True
+    )
+    thread.start()
+
+    feed(count, api.push_update)
+    for _ in range(count):
+        done.acquire(timeout=10)
+    bot.stop_polling()
+    api.reset()
+    return latencies
+
+
+def run_webhook(count):
+    latencies = []
+    done = threading.Semaphore(0)
+    bot = make_bot(latencies, done)
+
+    server = WebhookServer(bot, '127.0.0.1', 0, WEBHOOK_PATH, secret=WEBHOOK_SECRET)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}{WEBHOOK_PATH}"
+
+    def deliver(update):
+        # Так Telegram вызывает webhook: POST JSON с secret_token в заголовке
+        update['update_id'] = 1
+        request = urllib.request.Request(
+            url, data=json.dumps(update).encode('utf-8'), method='POST',
+            headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+        )
+        urllib.request.urlopen(request, timeout=5).read()
+
+    feed(count, deliver)
+    for _ in range(count):
+        done.acquire(timeout=10)
+    server.shutdown()
+    return latencies
+
+
+def report(name, latencies):
+    if not latencies:
+        print(f"{name:<22} нет данных")
+        return
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<22} n={len(ordered):<4} p50={statistics.median(ordered) * 1000:7.1f} мс  "
+          f"p95={p95 * 1000:7.1f} мс  max={ordered[-1] * 1000:7.1f} мс")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    logging.basicConfig(level=logging.CRITICAL)
+
+    api = FakeTelegramAPI()
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    apihelper.API_URL = f"http://127.0.0.1:{api.server_address[1]}/bot{{0}}/{{1}}"
+
+    print(f"📡 Задержка обновление -> обработчик, обновлений: {count}\n")
+    report("polling interval=1", run_polling(api, count, interval=1))
+    report("polling interval=0", run_polling(api, count, interval=0))
+    report("webhook", run_webhook(count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import re
+from utils import format_bytes
+
+SEARCH_HELP = """🔍 Поиск: часть имени и фильтры через пробел
+abc - имя начинается с abc
+*abc - имя содержит abc
+admin:@ivan или admin:123456 - кем создан
+active / inactive - подключен сейчас или нет
+seen:7d - подключался за последние 7 дней (h - часы)
+unseen:30d - не подключался 30 дней или ни разу"""
+
+DURATION_PATTERN = re.compile(r'^(\d+)([dh]?)$')
+
+
+def _parse_duration(value):
+    match = DURATION_PATTERN.match(value)
+    if not match or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * (3600 if match.group(2) == 'h' else 86400)
+
+
+def parse_query(text):
+    """Разбирает строку поиска в аргументы db.search_users: (filters, ошибка)"""
+    filters = {}
+    for token in (text or "").split():
+        lowered = token.lower()
+        if lowered in ('active', 'inactive'):
+            filters['is_active'] = lowered == 'active'
+        elif lowered.startswith('admin:'):
+            admin = token[6:]
+            if not admin:
+                return None, "Укажите администратора: admin:@ivan или admin:123456"
+            filters['admin'] = int(admin) if admin.isdigit() else admin
+        elif lowered.startswith(('seen:', 'unseen:')):
+            key, value = lowered.split(':', 1)
+            seconds = _parse_duration(value)
+            if seconds is None:
+                return None, f"Неверный период в {token}: используйте, например, {key}:7d или {key}:12h"
+            filters['seen_within' if key == 'seen' else 'unseen_for'] = seconds
+        elif 'name' in filters:
+            return None, f"Имя можно указать только одно: {filters['name']} и {token}"
+        elif token.startswith('*'):
+            if not token.strip('*'):
+                return None, "После * укажите часть имени"
+            filters['name'] = token.strip('*')
+            filters['substring'] = True
+        else:
+            filters['name'] = token.rstrip('*')
+    return filters, None
+
+
+def format_user_card(user):
+    """Короткая карточка пользователя для inline-режима"""
+    status = "🟢 подключен" if user.is_active else "⚪ не подключен"
+    total_traffic = user.total_bytes_sent + user.total_bytes_received
+    text = (f"👤 {user.username} - {status}\n"
+            f"Создан: {user.created_at[:10] if user.created_at else 'Неизвестно'} "
+            f"администратором {user.created_by_username}\n"
+            f"Подключений: {user.total_connections}, трафик: {format_bytes(total_traffic)}")
+    if user.last_connected:
+        text += f"\nПоследнее подключение: {user.last_connected[:16]}"
+    return text
@@ -47,6 +47,29 @@ def format_bytes(bytes_size):
         return f"{bytes_size / (1024 ** 4):.2f} TB"
 
 
+def parse_size(text):
+    """Разбирает размер вида 500MB, 10GB, 1.5TB (без единиц - байты). Возвращает байты или None"""
+    match = re.match(r'^\s*(\d+(?:[.,]\d+)?)\s*([KMGT]?)B?\s*$', (text or '').upper())
+    if not match:
+        return None
+    value = float(match.group(1).replace(',', '.'))
+    multipliers = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    return int(value * multipliers[match.group(2)])
+
+
+def format_rate(bytes_per_second):
+    """Форматирует скорость в читаемый вид (биты в секунду, как у провайдеров)"""
+    bits = (bytes_per_second or 0) * 8
+    if bits < 1000:
+        return f"{bits:.0f} бит/с"
+    elif bits < 1000 ** 2:
+        return f"{bits / 1000:.1f} Кбит/с"
+    elif bits < 1000 ** 3:
+        return f"{bits / 1000 ** 2:.1f} Мбит/с"
+    else:
+        return f"{bits / 1000 ** 3:.2f} Гбит/с"
+
+
 def format_traffic_stats(stats):
     """Форматирует статистику трафика для отображения"""
     if not stats:
@@ -114,17 +137,29 @@ def format_database_info():
     """Форматирует информацию о базе данных"""
     from database import db
 
+    from db_maintenance import db_maintenance
+
     user_count = db.get_user_count()
     active_count = db.get_active_users_count()
-    db_size = db.get_database_size()
+    db_sizes = db.get_database_files_size()
+    freelist, page_size, _ = db.get_freelist_info()
     backup_info = db.get_backup_info()
+    maintenance = db_maintenance.get_status()
 
     text = f"""🗄️ Информация о базе данных:
 
 👥 Пользователей: {user_count} ({active_count} активных)
-📏 Размер БД: {format_bytes(db_size)}
+📏 Размер БД на диске: {format_bytes(db_sizes['total'])}
+├─ Основной файл: {format_bytes(db_sizes['db'])}
+├─ WAL: {format_bytes(db_sizes['wal'])} (пик: {format_bytes(maintenance['wal_peak_size'])})
+├─ SHM: {format_bytes(db_sizes['shm'])}
+└─ Свободно внутри файла: {format_bytes(freelist * page_size)}
 💾 Резервных копий: {backup_info.get('total_backups', 0)} ({format_bytes(backup_info.get('total_size', 0))})
 
+🧹 Обслуживание БД: {maintenance['last_run'][:19] if maintenance['last_run'] else 'еще не выполнялось'}
+Следующее через: {format_time_delta(maintenance['next_run_in'])}
+🗃️ Политика хранения: {maintenance['last_retention'][:19] if maintenance['last_retention'] else 'еще не применялась'}{' (есть необработанные строки)' if maintenance['retention_pending'] else ''}
+
 📁 Директория бэкапов: {Config.BACKUP_DIR}"""
 
     return text
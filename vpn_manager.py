@@ -70,12 +70,11 @@ class VPNManager:
             logger.error(error_msg)
             return False, error_msg
 
-    def delete_user(self, username):
-        """Удаляет VPN пользователя"""
+    def revoke_user(self, username):
+        """Отзывает сертификат VPN пользователя (файлы конфигурации не трогает)"""
         safe_username = re.sub(r'[^a-zA-Z0-9_-]', '', username)
 
         try:
-            # Отзываем сертификат
             revoke_command = [self.script_path, '--revokeclient', safe_username]
             logger.info(f"Выполнение отзыва: {' '.join(revoke_command)}")
 
@@ -89,28 +88,75 @@ class VPNManager:
 
             if revoke_result.returncode == 0:
                 logger.info(f"VPN пользователь {safe_username} отозван")
+                return True, "Сертификат пользователя отозван"
+            else:
+                error_msg = f"Ошибка отзыва: {revoke_result.stderr}"
+                logger.error(error_msg)
+                return False, error_msg
 
-                # Удаляем файлы конфигурации
-                config_files = [
-                    f"{self.profiles_path}{safe_username}.mobileconfig",
-                    f"{self.profiles_path}{safe_username}.p12",
-                    f"{self.profiles_path}{safe_username}.sswan"
-                ]
+        except Exception as e:
+            error_msg = f"Ошибка при отзыве: {str(e)}"
+            logger.error(error_msg)
+            return False, error_msg
 
-                for file_path in config_files:
-                    if os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                            logger.info(f"Файл удален: {os.path.basename(file_path)}")
-                        except Exception as e:
-                            logger.warning(f"Не удалось удалить файл {file_path}: {e}")
+    def disconnect_user(self, username, connection_id=None):
+        """Разрывает текущее подключение пользователя (сертификат остается действующим)"""
+        safe_username = re.sub(r'[^a-zA-Z0-9_-]', '', username)
+
+        try:
+            if connection_id and str(connection_id).isdigit():
+                command = ['ipsec', 'whack', '--deletestate', str(connection_id)]
+            else:
+                command = ['ipsec', 'whack', '--deleteid', '--name', f"CN={safe_username}"]
+            logger.info(f"Выполнение отключения: {' '.join(command)}")
 
-                return True, "Пользователь VPN удален"
+            result = subprocess.run(
+                command,
+                capture_output=True,
+                text=True,
+                timeout=15
+            )
+
+            if result.returncode == 0:
+                logger.info(f"VPN пользователь {safe_username} отключен")
+                return True, "Пользователь отключен"
             else:
-                error_msg = f"Ошибка удаления: {revoke_result.stderr}"
+                error_msg = f"Ошибка отключения: {result.stderr}"
                 logger.error(error_msg)
                 return False, error_msg
 
+        except Exception as e:
+            error_msg = f"Ошибка при отключении: {str(e)}"
+            logger.error(error_msg)
+            return False, error_msg
+
+    def delete_user(self, username):
+        """Удаляет VPN пользователя"""
+        safe_username = re.sub(r'[^a-zA-Z0-9_-]', '', username)
+
+        try:
+            # Отзываем сертификат
+            success, msg = self.revoke_user(username)
+            if not success:
+                return False, msg
+
+            # Удаляем файлы конфигурации
+            config_files = [
+                f"{self.profiles_path}{safe_username}.mobileconfig",
+                f"{self.profiles_path}{safe_username}.p12",
+                f"{self.profiles_path}{safe_username}.sswan"
+            ]
+
+            for file_path in config_files:
+                if os.path.exists(file_path):
+                    try:
+                        os.remove(file_path)
+                        logger.info(f"Файл удален: {os.path.basename(file_path)}")
+                    except Exception as e:
+                        logger.warning(f"Не удалось удалить файл {file_path}: {e}")
+
+            return True, "Пользователь VPN удален"
+
         except Exception as e:
             error_msg = f"Ошибка при удалении: {str(e)}"
             logger.error(error_msg)
@@ -135,5 +181,9 @@ class VPNManager:
         return file_path if os.path.exists(file_path) else None
 
 
-# Глобальный экземпляр VPN менеджера
-vpn_manager = VPNManager()
\ No newline at end of file
+# Глобальный экземпляр VPN менеджера; у агрегатора флота команды уходят на узлы
+if Config.FLEET_ROLE == 'aggregator':
+    from fleet import FleetVPNManager
+    vpn_manager = FleetVPNManager()
+else:
+    vpn_manager = VPNManager()
\ No newline at end of file
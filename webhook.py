@@ -0,0 +1,124 @@
+import ssl
+import time
+import hmac
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telebot import types
+from metrics import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP(S)-сервер приема обновлений Telegram.
+
+    Запрос только разбирается и передается в пул потоков бота
+    (bot.process_new_updates), поэтому ответ Telegram уходит сразу.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, bot, host, port, path, secret=None, ssl_cert=None, ssl_key=None):
+        super().__init__((host, port), WebhookRequestHandler)
+        self.bot = bot
+        self.webhook_path = path
+        self.secret = secret
+        self.updates_count = 0
+
+        if ssl_cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(ssl_cert, ssl_key or None)
+            # Рукопожатие TLS - в потоке запроса, а не в принимающем потоке
+            self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+
+        if self.path.split('?')[0] != server.webhook_path:
+            self.send_error(404)
+            return
+
+        if server.secret:
+            token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token, server.secret):
+                logger.warning(f"Webhook: запрос с неверным secret_token от {self.client_address[0]}")
+                self.send_error(403)
+                return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except Exception as e:
+            logger.error(f"Webhook: ошибка разбора обновления: {str(e)}")
+            self.send_error(400)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+        server.updates_count += 1
+        metrics.inc('vpnbot_webhook_updates_total')
+        server.bot.process_new_updates([update])
+
+    def log_message(self, format, *args):
+        logger.debug(f"webhook: {format % args}")
+
+
+def get_webhook_url():
+    return Config.WEBHOOK_URL.rstrip('/') + Config.WEBHOOK_PATH
+
+
+def create_webhook_server(bot):
+    return WebhookServer(
+        bot,
+        Config.WEBHOOK_LISTEN,
+        Config.WEBHOOK_PORT,
+        Config.WEBHOOK_PATH,
+        secret=Config.WEBHOOK_SECRET,
+        ssl_cert=Config.WEBHOOK_SSL_CERT,
+        ssl_key=Config.WEBHOOK_SSL_KEY
+    )
+
+
+def register_webhook(bot):
+    """Регистрирует webhook в Telegram (самоподписанный сертификат загружается вместе с ним)"""
+    certificate = None
+    if Config.WEBHOOK_SSL_CERT and Config.WEBHOOK_UPLOAD_CERT:
+        certificate = open(Config.WEBHOOK_SSL_CERT, 'rb')
+
+    try:
+        bot.remove_webhook()
+        time.sleep(0.5)
+        bot.set_webhook(
+            url=get_webhook_url(),
+            certificate=certificate,
+            max_connections=Config.WEBHOOK_MAX_CONNECTIONS,
+            secret_token=Config.WEBHOOK_SECRET or None,
+            drop_pending_updates=True
+        )
+    finally:
+        if certificate:
+            certificate.close()
+
+
+def run_webhook(bot):
+    """Запускает прием обновлений через webhook (блокирует до остановки сервера)"""
+    if not Config.WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL не задан - webhook-режим невозможен")
+
+    server = create_webhook_server(bot)
+    register_webhook(bot)
+
+    scheme = 'https' if Config.WEBHOOK_SSL_CERT else 'http'
+    logger.info(f"Webhook {get_webhook_url()} -> {scheme}://{Config.WEBHOOK_LISTEN}:{Config.WEBHOOK_PORT}"
+                f"{Config.WEBHOOK_PATH}, потоков обработки: {Config.BOT_WORKERS}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+